@@ -0,0 +1,136 @@
+"""
+本地OCR与Dify视觉识别对比测试
+对截图目录中保存的 *.png 逐张运行本地OCR（可选同时调用Dify视觉工作流），
+统计耗时、置信度以及与参考文本的相似度，用来选择OCR后端和 local_ocr.min_confidence。
+
+参考文本：与截图同名的 .txt 文件；没有时使用Dify视觉识别的结果（需要 --dify）
+
+用法:
+    python benchmark_ocr.py --dir screenshots --backend rapidocr --dify
+"""
+import os
+import glob
+import json
+import time
+import argparse
+import difflib
+
+from screenshot_io import encode_image, open_image
+from text_extractor import OCR_BACKENDS, TextExtractor
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, round(percent / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def similarity(text, reference):
+    """字符级相似度，忽略空白"""
+    a = "".join(text.split())
+    b = "".join(reference.split())
+    if not a and not b:
+        return 1.0
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def load_dify_client(config_path):
+    from dify_client import create_dify_client
+
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    return create_dify_client(config['dify']), config.get('screenshot', {})
+
+
+def dify_extract(client, image, screenshot_config, name):
+    """与机器人相同的两次请求：上传截图 + 运行视觉工作流"""
+    content, extension, mime_type = encode_image(image, screenshot_config)
+    upload = client.upload_file(f"benchmark_{name}.{extension}", content, "benchmark", mime_type)
+    inputs = {
+        "input": {
+            "transfer_method": "local_file",
+            "upload_file_id": upload.get("id"),
+            "type": "image"
+        }
+    }
+    result = client.run_workflow(inputs, "benchmark")
+    return result.get("data", {}).get("outputs", "")
+
+
+def print_latency(label, values):
+    if values:
+        print(f"{label}: 平均 {sum(values) / len(values):.3f}秒  p50 {percentile(values, 50):.3f}秒  "
+              f"p95 {percentile(values, 95):.3f}秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地OCR与Dify视觉识别对比测试")
+    parser.add_argument("--dir", default="screenshots", help="截图目录")
+    parser.add_argument("--backend", default="rapidocr", choices=sorted(OCR_BACKENDS), help="OCR后端")
+    parser.add_argument("--min-confidence", type=float, default=0.85, help="本地结果可用的最低置信度")
+    parser.add_argument("--dify", action="store_true", help="同时调用Dify视觉工作流对比")
+    parser.add_argument("--config", default="config.json", help="配置文件（--dify时使用）")
+    parser.add_argument("--limit", type=int, default=0, help="最多测试多少张截图，0表示全部")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.dir, "*.png")))
+    if args.limit:
+        paths = paths[:args.limit]
+    if not paths:
+        print(f"目录中没有截图: {args.dir}")
+        return
+
+    extractor = TextExtractor(backend=args.backend, min_confidence=args.min_confidence)
+    client, screenshot_config = load_dify_client(args.config) if args.dify else (None, None)
+
+    ocr_times, dify_times = [], []
+    all_scores, fast_scores = [], []
+    fast_path = 0
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        image = open_image(path)
+
+        start = time.perf_counter()
+        text, confidence = extractor.extract(image)
+        ocr_times.append(time.perf_counter() - start)
+        reliable = extractor.is_reliable(text, confidence)
+        fast_path += reliable
+
+        reference = None
+        reference_path = os.path.splitext(path)[0] + ".txt"
+        if os.path.exists(reference_path):
+            with open(reference_path, 'r', encoding='utf-8') as f:
+                reference = f.read()
+        if client:
+            start = time.perf_counter()
+            try:
+                dify_text = dify_extract(client, image, screenshot_config, name)
+                dify_times.append(time.perf_counter() - start)
+                if reference is None:
+                    reference = dify_text
+            except Exception as e:
+                print(f"{name}: Dify视觉识别失败: {str(e)}")
+
+        line = f"{name}: 置信度 {confidence:.2f} {'本地' if reliable else '回退'}  耗时 {ocr_times[-1]:.3f}秒"
+        if reference is not None:
+            score = similarity(text, reference)
+            all_scores.append(score)
+            if reliable:
+                fast_scores.append(score)
+            line += f"  相似度 {score:.2f}"
+        print(line)
+
+    print(f"\n共 {len(paths)} 张截图，后端 {args.backend}，置信度阈值 {args.min_confidence}")
+    print(f"走本地快速通道: {fast_path} 张（{fast_path / len(paths):.0%}）")
+    print_latency("本地OCR耗时", ocr_times)
+    print_latency("Dify视觉识别耗时（上传+工作流）", dify_times)
+    if all_scores:
+        print(f"全部截图平均相似度: {sum(all_scores) / len(all_scores):.3f}")
+    if fast_scores:
+        print(f"快速通道截图平均相似度: {sum(fast_scores) / len(fast_scores):.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,553 @@
+"""
+离线回放测试
+用保存的聊天截图代替千牛窗口、用本地模拟Dify服务代替真实Dify，在普通Linux机器上跑通机器人的完整处理流程，
+统计吞吐量（客户/分钟）、每轮和各阶段耗时分位数、Dify各接口调用次数，用来验证性能改动。
+
+- 模拟屏幕：替换 pyautogui / pyperclip / clicknium 模块，截屏返回由截图合成的画面，点击和键盘操作只做记录
+- 截图语料：截图目录下的 *.png（机器人保存的 客户ID_日期_时间.png），同一客户的截图按时间顺序作为多轮消息回放；
+  同名 .txt 文件作为该截图的视觉识别结果（模拟工作流返回）
+- 机器人在临时目录中运行（config.json、模板、数据库都在其中），不会影响正式运行的数据
+
+用法:
+    python benchmark_replay.py --dir screenshots --bot pyautogui --latency upload=0.2,workflow=1.5,chat=2
+    python benchmark_replay.py --bot clicknium --workers 4 --error-rate 0.05 --output result.json
+"""
+import os
+import sys
+import glob
+import json
+import time
+import types
+import shutil
+import tempfile
+import argparse
+import importlib
+import threading
+import contextlib
+from collections import Counter, namedtuple
+
+import numpy as np
+from PIL import Image
+
+from screenshot_io import open_image
+from mock_dify_server import MockDifyServer, parse_latency
+
+# 模拟屏幕布局
+SCREEN_SIZE = (1600, 1000)
+# pyautogui机器人找不到聊天窗口模板时使用的固定聊天区域，两个机器人都把截图放在这里
+CHAT_REGION = (400, 200, 800, 600)
+# 会话列表：每个客户占一行，有新消息的客户在行内显示新消息图标
+LIST_ORIGIN = (40, 120)
+LIST_ROW_HEIGHT = 48
+LIST_ROWS = 16
+TEMPLATE_SIZE = (48, 28)
+# 模板名 -> 在屏幕上的位置（新消息图标画在客户所在的行）
+CONTROL_POSITIONS = {
+    "input_box.png": (420, 840),
+    "send_button.png": (1120, 900),
+    "transfer_button.png": (1260, 120),
+    "close_chat.png": (1260, 60),
+}
+# 输入框中的文字画在输入框模板右侧（每个字一小段），发送引擎据此确认粘贴和发送
+INPUT_TEXT_ORIGIN = (472, 846)
+INPUT_TEXT_MAX_WIDTH = 600
+# 输入框的文字区域，对应配置 reply_sender.input_region
+INPUT_TEXT_REGION = (INPUT_TEXT_ORIGIN[0], INPUT_TEXT_ORIGIN[1] - 4, INPUT_TEXT_MAX_WIDTH, 20)
+# clicknium定位器 -> 模拟屏幕上的控件
+CLICKNIUM_CONTROLS = {
+    "reply_text": "input_box.png",
+    "button_send": "send_button.png",
+    "button_transfer": "transfer_button.png",
+    "button_接待关闭": "close_chat.png",
+}
+
+Turn = namedtuple("Turn", "customer_id image text")
+
+
+def synthetic_template(name):
+    """生成固定的随机纹理作为模板图片，各模板之间不会互相误匹配"""
+    seed = sum(name.encode("utf-8"))
+    pixels = np.random.RandomState(seed).randint(0, 256, (TEMPLATE_SIZE[1], TEMPLATE_SIZE[0]), dtype=np.uint8)
+    return Image.fromarray(pixels).convert("RGB")
+
+
+class FakeScreen:
+    """
+    模拟千牛界面：会话列表 + 聊天区域 + 输入框和按钮
+    新消息排队的客户在会话列表中显示新消息图标（一次只显示排在最前面的客户），
+    点击后打开该客户的聊天，聊天区域显示该轮的截图
+    """
+
+    def __init__(self, on_open=None):
+        """on_open: 打开某一轮聊天时的回调，参数为Turn"""
+        self.on_open = on_open
+        self.templates = {name: synthetic_template(name) for name in list(CONTROL_POSITIONS) + ["new_message.png"]}
+
+        self._lock = threading.RLock()
+        # 等待接待的消息（按到达顺序）
+        self.queue = []
+        # 客户ID -> 会话列表中的行号
+        self._rows = {}
+        # 客户ID -> 最近一次打开的Turn
+        self._opened = {}
+        # 本轮回放循环中已打开的消息，settle() 时从等待队列中移除（消息已读）
+        self._read = []
+        self.current = None
+        self.clipboard = ""
+        self.input_text = ""
+        self.sent = []
+        self.transfers = []
+        self.actions = Counter()
+        self._frame = None
+
+    # ---- 回放控制 ----
+
+    def push(self, turn):
+        """客户发来新消息"""
+        with self._lock:
+            if turn.customer_id not in self._rows:
+                self._rows[turn.customer_id] = len(self._rows) % LIST_ROWS
+            self.queue.append(turn)
+            self._frame = None
+
+    def settle(self):
+        """一次轮询结束：已打开过的客户的新消息变为已读，不再显示新消息图标"""
+        with self._lock:
+            self.queue = [turn for turn in self.queue if not any(turn is read for read in self._read)]
+            self._read.clear()
+            self._frame = None
+
+    def _row_box(self, customer_id):
+        row = self._rows[customer_id]
+        x, y = LIST_ORIGIN
+        return x, y + row * LIST_ROW_HEIGHT, TEMPLATE_SIZE[0], TEMPLATE_SIZE[1]
+
+    def notification_box(self):
+        """返回: 新消息图标的 (x, y, width, height)，没有等待的客户时返回None"""
+        with self._lock:
+            return self._row_box(self.queue[0].customer_id) if self.queue else None
+
+    def control_box(self, name):
+        x, y = CONTROL_POSITIONS[name]
+        return x, y, TEMPLATE_SIZE[0], TEMPLATE_SIZE[1]
+
+    def _open(self, customer_id):
+        turn = next((turn for turn in self.queue if turn.customer_id == customer_id), None)
+        if turn is not None:
+            self._opened[customer_id] = turn
+            if not any(turn is read for read in self._read):
+                self._read.append(turn)
+            if self.on_open:
+                self.on_open(turn)
+        self.current = customer_id
+        self.input_text = ""
+        self._frame = None
+
+    # ---- 截屏 ----
+
+    def _render(self):
+        with self._lock:
+            if self._frame is not None:
+                return self._frame
+            frame = Image.new("RGB", SCREEN_SIZE, (236, 236, 236))
+            for name, (x, y) in CONTROL_POSITIONS.items():
+                frame.paste(self.templates[name], (x, y))
+            box = self.notification_box()
+            if box:
+                frame.paste(self.templates["new_message.png"], box[:2])
+            turn = self._opened.get(self.current)
+            if turn is not None:
+                x, y, width, height = CHAT_REGION
+                frame.paste(turn.image.crop((0, 0, min(width, turn.image.width), min(height, turn.image.height))), (x, y))
+            if self.input_text:
+                x, y = INPUT_TEXT_ORIGIN
+                frame.paste((40, 40, 40), (x, y, x + min(len(self.input_text) * 8, INPUT_TEXT_MAX_WIDTH), y + 12))
+            self._frame = frame
+            return frame
+
+    def screenshot(self, region=None):
+        self.actions["screenshot"] += 1
+        frame = self._render()
+        if region is None:
+            return frame.copy()
+        x, y, width, height = region
+        return frame.crop((x, y, x + width, y + height))
+
+    def grab(self, bbox=None):
+        """代替 PIL.ImageGrab.grab"""
+        if bbox is None:
+            return self.screenshot()
+        left, top, right, bottom = bbox
+        return self.screenshot((left, top, right - left, bottom - top))
+
+    # ---- 鼠标和键盘 ----
+
+    def _hit(self, box, x, y):
+        return box[0] <= x < box[0] + box[2] and box[1] <= y < box[1] + box[3]
+
+    def click(self, x=None, y=None):
+        with self._lock:
+            self.actions["click"] += 1
+            for customer_id in self._rows:
+                if self._hit(self._row_box(customer_id), x, y):
+                    self._open(customer_id)
+                    return
+            if self._hit(self.control_box("send_button.png"), x, y):
+                self._send()
+            elif self._hit(self.control_box("transfer_button.png"), x, y):
+                self.transfers.append(self.current)
+            elif self._hit(self.control_box("close_chat.png"), x, y):
+                self.current = None
+                self._frame = None
+
+    def hotkey(self, *keys):
+        with self._lock:
+            self.actions["hotkey"] += 1
+            if keys[-1].lower() == "v":
+                self.input_text = self.clipboard
+                self._frame = None
+
+    def press(self, key):
+        with self._lock:
+            self.actions["press"] += 1
+            if key == "enter":
+                self._send()
+            elif key in ("backspace", "delete"):
+                # 只在全选之后使用，直接清空
+                self.input_text = ""
+                self._frame = None
+
+    def copy(self, text):
+        self.clipboard = text
+
+    def _send(self):
+        if self.input_text:
+            self.sent.append((self.current, self.input_text))
+            self.input_text = ""
+            self._frame = None
+
+
+def fake_pyautogui(screen):
+    module = types.ModuleType("pyautogui")
+
+    class FailSafeException(Exception):
+        pass
+
+    module.FailSafeException = FailSafeException
+    module.FAILSAFE = False
+    module.PAUSE = 0
+    module.screenshot = screen.screenshot
+    module.click = lambda x=None, y=None, *args, **kwargs: screen.click(x, y)
+    module.hotkey = lambda *keys, **kwargs: screen.hotkey(*keys)
+    module.press = lambda key, *args, **kwargs: screen.press(key)
+    module.size = lambda: SCREEN_SIZE
+    return module
+
+
+def fake_pyperclip(screen):
+    module = types.ModuleType("pyperclip")
+    module.copy = screen.copy
+    module.paste = lambda: screen.clipboard
+    return module
+
+
+class FakeRect:
+    def __init__(self, box):
+        x, y, width, height = box
+        self.left, self.top, self.right, self.bottom = x, y, x + width, y + height
+
+
+class FakeElement:
+    """代替clicknium的 ui(locator)，按定位器名称映射到模拟屏幕上的区域"""
+
+    def __init__(self, screen, name):
+        self.screen = screen
+        self.name = name
+
+    def _box(self):
+        if self.name == "new_message":
+            box = self.screen.notification_box()
+            if box is None:
+                raise LookupError("没有新消息")
+            return box
+        if self.name == "chat_window":
+            return CHAT_REGION
+        if self.name in CLICKNIUM_CONTROLS:
+            return self.screen.control_box(CLICKNIUM_CONTROLS[self.name])
+        # 当前客户昵称、跳转接待中心等没有对应图标的控件
+        return 0, 0, 1, 1
+
+    def get_position(self):
+        return FakeRect(self._box())
+
+    def click(self):
+        x, y, width, height = self._box()
+        self.screen.click(x + width // 2, y + height // 2)
+
+    def get_text(self):
+        if self.name != "current_user":
+            return ""
+        # 打开了聊天窗口时是当前客户，否则是有新消息的客户
+        with self.screen._lock:
+            if self.screen.current:
+                return self.screen.current
+            return self.screen.queue[0].customer_id if self.screen.queue else ""
+
+    def send_hotkey(self, keys):
+        if keys == "^v":
+            self.screen.hotkey("ctrl", "v")
+
+    def save_to_image(self, path):
+        self.screen.screenshot(self._box()).save(path)
+
+
+def fake_clicknium(screen):
+    module = types.ModuleType("clicknium")
+
+    class Locators:
+        def __getattr__(self, name):
+            return name
+
+    locator = types.SimpleNamespace(aliworkbench=Locators())
+
+    def is_existing(name):
+        return name != "new_message" or screen.notification_box() is not None
+
+    module.clicknium = types.SimpleNamespace(
+        is_existing=is_existing,
+        mouse=types.SimpleNamespace(click=lambda x, y: screen.click(x, y)),
+        config=types.SimpleNamespace(set_license=lambda key: None)
+    )
+    module.locator = locator
+    module.ui = lambda name: FakeElement(screen, name)
+    return module
+
+
+class ScaledTime:
+    """替换机器人模块中的time，按比例缩短界面等待（time.sleep），其余函数不变"""
+
+    def __init__(self, scale):
+        self.scale = scale
+
+    def sleep(self, seconds):
+        if seconds > 0 and self.scale > 0:
+            time.sleep(seconds * self.scale)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def load_corpus(directory, limit=0):
+    """
+    返回: [Turn]，按截图时间排序；文件名形如 客户ID_日期_时间.png 时同一客户的截图归为同一客户的多轮消息
+    """
+    turns = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.png"))):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        parts = stem.rsplit("_", 2)
+        customer_id = parts[0] if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit() else stem
+        timestamp = "_".join(parts[1:]) if customer_id != stem else ""
+        text = None
+        text_path = os.path.splitext(path)[0] + ".txt"
+        if os.path.exists(text_path):
+            with open(text_path, "r", encoding="utf-8") as f:
+                text = f.read().strip()
+        turns.append((timestamp, stem, Turn(customer_id, open_image(path).convert("RGB"), text)))
+    turns = [turn for _, _, turn in sorted(turns, key=lambda item: item[:2])]
+    return turns[:limit] if limit else turns
+
+
+def prepare_sandbox(sandbox, base_config, mock, workers, screen):
+    """在临时目录中写入指向模拟服务的config.json和模拟屏幕使用的模板"""
+    config = json.loads(json.dumps(base_config))
+    config["dify"] = mock.dify_config(config.get("dify"))
+    config.setdefault("settings", {})["pipeline_workers"] = workers
+    # 模拟屏幕上所有客户的头像相同，回放时按截图文件名区分客户
+    config["customer_identity"] = {"enabled": False}
+    # 回放不需要空闲时降低轮询频率
+    config["change_detection"] = {"enabled": False}
+    config["tracing"] = {"enabled": True, "log_path": "traces.jsonl"}
+    if config.get("reply_sender", {}).get("enabled"):
+        config["reply_sender"]["input_region"] = list(INPUT_TEXT_REGION)
+    config.setdefault("clicknium", {}).setdefault("license_key", "")
+    with open(os.path.join(sandbox, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+
+    templates_dir = os.path.join(sandbox, "templates")
+    os.makedirs(templates_dir, exist_ok=True)
+    for name, template in screen.templates.items():
+        template.save(os.path.join(templates_dir, name))
+
+
+def import_bot(bot_name, screen):
+    """用模拟模块导入机器人（在当前工作目录读取config.json）"""
+    sys.modules["pyperclip"] = fake_pyperclip(screen)
+    if bot_name == "clicknium":
+        sys.modules["clicknium"] = fake_clicknium(screen)
+        bot = importlib.import_module("qianniu_bot")
+        # grab_screen 通过模块中的ImageGrab截屏
+        bot.ImageGrab = screen
+    else:
+        sys.modules["pyautogui"] = fake_pyautogui(screen)
+        bot = importlib.import_module("qianniu_bot_pyautogui")
+    return bot
+
+
+def replay(bot, bot_name, screen, turns, pipeline):
+    """
+    按机器人主循环的方式处理全部消息（不含空闲等待）
+    返回: 耗时秒数
+    """
+    for turn in turns:
+        screen.push(turn)
+
+    start = time.perf_counter()
+    while screen.queue or (pipeline and pipeline.pending_count()) or bot.DEFERRED:
+        if bot_name == "clicknium":
+            bot.scan_and_process_customers(pipeline)
+        else:
+            if pipeline:
+                bot.finish_customers(pipeline)
+            bot.retry_deferred_turns(pipeline)
+            if screen.queue and pipeline:
+                bot.start_customer(pipeline, screen.queue[0].customer_id)
+            elif screen.queue:
+                bot.handle_customer(screen.queue[0].customer_id)
+        screen.settle()
+        if not screen.queue:
+            # 只剩工作线程中的请求或等待限流的客户时，与主循环一样短暂等待后再处理
+            time.sleep(0.05)
+    return time.perf_counter() - start
+
+
+def summarize(bot, mock, screen, turns, elapsed):
+    metrics = bot.METRICS
+    outcomes = {dict(labels).get("outcome"): value for labels, value in metrics.counters("turns_total").items()}
+    stages = {
+        dict(labels).get("stage"): values
+        for labels, values in metrics.percentiles("stage_duration_seconds").items()
+    }
+    turn_latency = metrics.percentiles("turn_duration_seconds").get((), {})
+    return {
+        "turns": len(turns),
+        "customers": len({turn.customer_id for turn in turns}),
+        "elapsed_seconds": round(elapsed, 3),
+        "customers_per_minute": round(len(turns) / elapsed * 60, 2) if elapsed else 0.0,
+        "outcomes": outcomes,
+        "turn_latency": turn_latency,
+        "stage_latency": stages,
+        "dify_calls": mock.stats(),
+        "ui": {
+            "replies_sent": len(screen.sent),
+            "transfers": len(screen.transfers),
+            "screenshots": screen.actions["screenshot"],
+            "clicks": screen.actions["click"],
+        },
+    }
+
+
+def print_summary(summary):
+    print(f"\n共回放 {summary['turns']} 轮消息（{summary['customers']} 个客户），耗时 {summary['elapsed_seconds']:.1f}秒，"
+          f"吞吐 {summary['customers_per_minute']:.1f} 客户/分钟")
+    print("处理结果: " + "  ".join(f"{outcome} {count}" for outcome, count in sorted(summary["outcomes"].items())))
+    if summary["turn_latency"]:
+        latency = summary["turn_latency"]
+        print(f"每轮耗时: p50 {latency[50]:.3f}秒  p95 {latency[95]:.3f}秒  p99 {latency[99]:.3f}秒")
+    print("各阶段耗时:")
+    for stage, latency in sorted(summary["stage_latency"].items(), key=lambda item: -item[1][50]):
+        print(f"  {stage:<10} p50 {latency[50]:.3f}秒  p95 {latency[95]:.3f}秒  p99 {latency[99]:.3f}秒")
+    calls = summary["dify_calls"]
+    print("Dify调用: " + "  ".join(
+        f"{endpoint} {calls[endpoint]['calls']}次（注入错误 {calls[endpoint]['errors']}）"
+        for endpoint in ("upload", "workflow", "chat")
+    ) + f"  token {calls['total_tokens']}")
+    ui = summary["ui"]
+    print(f"界面操作: 发送回复 {ui['replies_sent']} 条，转人工 {ui['transfers']} 次，"
+          f"截屏 {ui['screenshots']} 次，点击 {ui['clicks']} 次")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线回放测试（模拟屏幕 + 模拟Dify）")
+    parser.add_argument("--dir", default="screenshots", help="截图语料目录")
+    parser.add_argument("--bot", default="pyautogui", choices=("pyautogui", "clicknium"), help="回放哪个机器人")
+    parser.add_argument("--config", default="config.json", help="基础配置，不存在时使用config.example.json")
+    parser.add_argument("--workers", type=int, default=1, help="流水线工作线程数，1表示逐个客户处理")
+    parser.add_argument("--latency", default="upload=0.2,workflow=1.5,chat=2",
+                        help='模拟Dify各接口延迟秒数，如 "upload=0.2,workflow=1.5,chat=2"')
+    parser.add_argument("--jitter", type=float, default=0.2, help="延迟随机浮动比例")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟Dify注入错误的请求比例")
+    parser.add_argument("--error-status", type=int, default=500, help="注入错误的HTTP状态码")
+    parser.add_argument("--transfer-rate", type=float, default=0.05, help="回复带转人工标记的比例")
+    parser.add_argument("--ui-delay-scale", type=float, default=1.0,
+                        help="界面等待（点击后的sleep）的缩放比例，0表示不等待，只测代码本身的开销")
+    parser.add_argument("--limit", type=int, default=0, help="最多回放多少张截图，0表示全部")
+    parser.add_argument("--seed", type=int, default=0, help="模拟服务的随机种子")
+    parser.add_argument("--output", help="把统计结果写入JSON文件，便于比较不同版本")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录（trace日志、数据库、截图）")
+    parser.add_argument("--verbose", action="store_true", help="显示机器人的日志输出")
+    args = parser.parse_args()
+
+    turns = load_corpus(args.dir, args.limit)
+    if not turns:
+        print(f"目录中没有截图: {args.dir}")
+        return
+
+    config_path = args.config if os.path.exists(args.config) else "config.example.json"
+    with open(config_path, "r", encoding="utf-8") as f:
+        base_config = json.load(f)
+    output = os.path.abspath(args.output) if args.output else None
+
+    mock = MockDifyServer(
+        latency=parse_latency(args.latency),
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        transfer_rate=args.transfer_rate,
+        seed=args.seed
+    ).start()
+
+    def on_open(turn):
+        if turn.text:
+            mock.vision_texts[turn.customer_id] = turn.text
+        else:
+            mock.vision_texts.pop(turn.customer_id, None)
+
+    screen = FakeScreen(on_open)
+    sandbox = tempfile.mkdtemp(prefix="qianniu_replay_")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    cwd = os.getcwd()
+    pipeline = None
+    try:
+        prepare_sandbox(sandbox, base_config, mock, args.workers, screen)
+        os.chdir(sandbox)
+        print(f"回放 {len(turns)} 张截图，机器人: {args.bot}，工作线程: {args.workers}，临时目录: {sandbox}")
+
+        log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+        with log:
+            bot = import_bot(args.bot, screen)
+            bot.time = ScaledTime(args.ui_delay_scale)
+            if args.workers > 1:
+                pipeline = bot.CustomerPipeline(bot.process_customer_message, max_workers=args.workers,
+                                                retry_on=(bot.RateLimitedError,), max_retries=bot.MAX_THROTTLED_RETRIES)
+            elapsed = replay(bot, args.bot, screen, turns, pipeline)
+            bot.TRACER.close()
+
+        summary = summarize(bot, mock, screen, turns, elapsed)
+        print_summary(summary)
+        if output:
+            with open(output, "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+            print(f"统计结果已写入: {output}")
+    finally:
+        if pipeline:
+            pipeline.shutdown()
+        os.chdir(cwd)
+        mock.stop()
+        if args.keep:
+            print(f"临时目录已保留: {sandbox}")
+        else:
+            shutil.rmtree(sandbox, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+聊天气泡分割
+把聊天区域截图按OpenCV轮廓切分成气泡，按颜色（配置了己方气泡颜色时）或左右位置区分客户与己方的气泡，
+只裁剪出最后一条己方回复之后的客户气泡交给识别，视觉输入更小，对话提示也不会重复包含我们之前的回复
+"""
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+# own: 是否为己方（客服）发送的气泡
+Bubble = namedtuple("Bubble", ["x", "y", "width", "height", "own"])
+
+
+class BubbleSegmenter:
+    """聊天区域截图 -> 气泡列表 -> 尚未回复的客户消息"""
+
+    def __init__(self, own_color=None, color_tolerance=24, background_tolerance=4,
+                 min_width=24, min_height=16, merge_gap=8, side_split=0.5, padding=4):
+        """
+        own_color: 己方气泡的底色 [R, G, B]，为空时按气泡位置判断（右侧为己方）
+        color_tolerance: 气泡底色与 own_color 每个通道允许的差值
+        background_tolerance: 与背景色每个通道相差超过该值的像素视为前景
+        min_width / min_height: 小于该尺寸的轮廓（图标、噪点）不算气泡
+        merge_gap: 小于该距离的前景合并为同一个气泡（同一气泡内的文字行）
+        side_split: 气泡中心位于宽度的该比例右侧时视为己方气泡
+        padding: 裁剪时四周多保留的像素
+        """
+        self.own_color = np.array(own_color, dtype=np.int16) if own_color else None
+        self.color_tolerance = color_tolerance
+        self.background_tolerance = background_tolerance
+        self.min_width = min_width
+        self.min_height = min_height
+        self.merge_gap = merge_gap
+        self.side_split = side_split
+        self.padding = padding
+
+    def _dominant_color(self, pixels):
+        """出现次数最多的颜色（按4级量化后统计，避免抗锯齿像素分散计数）"""
+        quantized = (pixels.reshape(-1, 3) >> 2).astype(np.int32)
+        keys = (quantized[:, 0] << 12) | (quantized[:, 1] << 6) | quantized[:, 2]
+        key = int(np.bincount(keys).argmax())
+        return np.array([(key >> 12) << 2, ((key >> 6) & 63) << 2, (key & 63) << 2], dtype=np.int16)
+
+    def _is_own(self, array, x, y, width, height):
+        if self.own_color is not None:
+            fill = self._dominant_color(array[y:y + height, x:x + width])
+            return bool(np.abs(fill - self.own_color).max() <= self.color_tolerance)
+        return x + width / 2 > array.shape[1] * self.side_split
+
+    def segment(self, image):
+        """
+        返回: 按从上到下排列的气泡列表
+        """
+        array = np.asarray(image.convert("RGB"))
+        background = self._dominant_color(array[::4, ::4])
+        foreground = np.abs(array.astype(np.int16) - background).max(axis=2) > self.background_tolerance
+        mask = foreground.astype(np.uint8) * 255
+
+        # 横向合并范围大于纵向：同一行的文字连成一片，相邻气泡之间的间距保留下来
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (self.merge_gap * 2 + 1, self.merge_gap + 1))
+        closed = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+        contours, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        bubbles = []
+        for contour in contours:
+            x, y, width, height = cv2.boundingRect(contour)
+            if width < self.min_width or height < self.min_height:
+                continue
+            bubbles.append(Bubble(x, y, width, height, self._is_own(array, x, y, width, height)))
+        bubbles.sort(key=lambda bubble: (bubble.y, bubble.x))
+        return bubbles
+
+    def unanswered(self, bubbles):
+        """最后一条己方气泡之后的客户气泡"""
+        for index in range(len(bubbles) - 1, -1, -1):
+            if bubbles[index].own:
+                return [bubble for bubble in bubbles[index + 1:] if not bubble.own]
+        return [bubble for bubble in bubbles if not bubble.own]
+
+    def crop_unanswered(self, image):
+        """
+        返回: 包含所有未回复客户气泡的裁剪图；最后一条消息是己方回复时返回None；
+             无法分割出任何气泡时返回原图，交给视觉识别整张图
+        """
+        bubbles = self.segment(image)
+        if not bubbles:
+            return image
+        pending = self.unanswered(bubbles)
+        if not pending:
+            return None
+
+        left = max(0, min(bubble.x for bubble in pending) - self.padding)
+        top = max(0, pending[0].y - self.padding)
+        right = min(image.width, max(bubble.x + bubble.width for bubble in pending) + self.padding)
+        bottom = min(image.height, max(bubble.y + bubble.height for bubble in pending) + self.padding)
+        return image.crop((left, top, right, bottom))
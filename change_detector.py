@@ -0,0 +1,82 @@
+"""
+屏幕变化检测
+每次轮询只截取通知区域并缩成很小的灰度缩略图比较，区域没有变化时跳过模板匹配/控件查询；
+轮询间隔随活跃程度自适应：检测到变化后立即缩短，持续空闲时逐步放长到上限
+"""
+import time
+
+import numpy as np
+from PIL import Image
+
+
+class ChangeDetector:
+    """通知区域的降采样哈希比较 + 自适应轮询间隔"""
+
+    def __init__(self, grab_func, region=None, hash_size=32, pixel_delta=3, threshold=0,
+                 min_interval=0.2, max_interval=2.0, backoff=1.5, force_check_seconds=30):
+        """
+        grab_func: 截屏函数，参数为 region=(x, y, width, height) 或 None（整个屏幕），返回PIL图片
+        region: 通知区域，为空时比较整个屏幕
+        hash_size: 缩略图边长，区域越大需要越大才能察觉小的红点/角标
+        pixel_delta: 缩略图格子的平均灰度变化超过该值才算这个格子变化，过滤抗锯齿等细微差别
+        threshold: 超过该数量的格子变化才算区域变化，用于过滤光标闪烁等噪声
+        min_interval / max_interval: 轮询间隔的下限和上限（秒）
+        backoff: 每次空闲轮询后间隔放大的倍数
+        force_check_seconds: 区域长时间没有变化时也强制完整检查一次，避免漏掉上次处理失败的通知
+        """
+        self.grab_func = grab_func
+        self.region = tuple(region) if region else None
+        self.hash_size = hash_size
+        self.pixel_delta = pixel_delta
+        self.threshold = threshold
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.force_check_seconds = force_check_seconds
+
+        self._previous = None
+        self._last_check = 0
+        self._interval = min_interval
+        self.checks = 0
+        self.skipped = 0
+
+    def _signature(self, image):
+        """缩成 hash_size x hash_size 的灰度图（每格取平均值）"""
+        small = image.convert("L").resize((self.hash_size, self.hash_size), Image.BOX)
+        return np.asarray(small, dtype=np.int16)
+
+    def changed(self):
+        """
+        截取通知区域并与上一次比较
+        返回: 区域有变化（或到了强制检查时间）时返回True，调用方随后执行完整检查
+        """
+        signature = self._signature(self.grab_func(region=self.region))
+        previous, self._previous = self._previous, signature
+        now = time.monotonic()
+
+        if previous is None or int((np.abs(signature - previous) > self.pixel_delta).sum()) > self.threshold:
+            changed = True
+        else:
+            changed = now - self._last_check >= self.force_check_seconds
+
+        if changed:
+            self._last_check = now
+            self.checks += 1
+        else:
+            self.skipped += 1
+        return changed
+
+    def next_interval(self, active):
+        """
+        active: 本轮是否检测到变化或正在处理客户
+        返回: 下一次轮询前应等待的秒数
+        """
+        if active:
+            self._interval = self.min_interval
+        else:
+            self._interval = min(self.max_interval, self._interval * self.backoff)
+        return self._interval
+
+    def reset(self):
+        """界面被机器人自己操作过（点击、发送）后丢弃基准，下次轮询重新比较"""
+        self._previous = None
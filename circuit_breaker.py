@@ -0,0 +1,170 @@
+"""
+Dify熔断器
+Dify变慢或宕机时，每个客户都要先等完整的超时和重试才拿到错误，整个队列会被拖住。
+熔断器按时间窗口统计失败（连接错误、超时、5xx/429）和慢请求的比例，超过阈值后断开：
+断开期间直接抛出 CircuitOpenError，调用方立即转人工（或使用缓存的回复），不再请求Dify；
+open_seconds 之后进入半开状态，只放行一个探测请求，成功则恢复，失败则继续断开
+"""
+import time
+import threading
+from collections import deque
+
+from dify_client import http_status
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 接口 -> 熔断器：上传和视觉工作流通常一起失败，上传被拒绝时就不必再等工作流
+BREAKER_GROUPS = {
+    "upload": "vision",
+    "workflow": "vision",
+    "chat": "chat",
+}
+
+# 拒绝请求时告知调用方的最短重新请求间隔
+MIN_RETRY_SECONDS = 1.0
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于断开状态，请求没有发出；retry_in为预计多少秒后可以重新请求"""
+
+    def __init__(self, message, retry_in=MIN_RETRY_SECONDS):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+def is_failure(error):
+    """连接错误、超时、服务端错误和限流算失败；其他4xx（如会话不存在）说明服务本身正常"""
+    status = http_status(error)
+    return status is None or status >= 500 or status == 429
+
+
+class CircuitBreaker:
+    """按时间窗口统计失败率的熔断器，线程安全"""
+
+    def __init__(self, name, failure_rate=0.5, min_calls=5, window_seconds=60,
+                 slow_call_seconds=30, open_seconds=30):
+        """
+        failure_rate: 窗口内失败（含慢请求）比例达到该值时断开
+        min_calls: 窗口内请求数少于该值时不断开，避免一两次偶发错误就熔断
+        slow_call_seconds: 耗时超过该值的请求即使成功也计为失败
+        open_seconds: 断开多久之后放行探测请求
+        """
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        # (结束时间, 是否失败)
+        self._calls = deque()
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+        self.rejected = 0
+
+    def _trim(self, now):
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+
+    def _open(self, now, reason):
+        self.state = OPEN
+        self._opened_at = now
+        self._probing = False
+        print(f"Dify {self.name} 熔断器断开（{reason}），{self.open_seconds}秒后重新探测")
+
+    def before_call(self):
+        """请求前调用；断开期间（或半开状态已有探测请求）抛出CircuitOpenError"""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN and now - self._opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                self._probe_started = now
+                return
+            self.rejected += 1
+            if self.state == OPEN:
+                retry_in = self.open_seconds - (now - self._opened_at)
+            else:
+                # 探测请求还没有结果，最晚在它超过慢请求阈值时按失败处理
+                retry_in = self.slow_call_seconds - (now - self._probe_started)
+            retry_in = max(MIN_RETRY_SECONDS, retry_in)
+        raise CircuitOpenError(f"Dify {self.name} 暂时不可用（熔断中，{retry_in:.0f}秒后重新探测）",
+                               retry_in=retry_in)
+
+    def record(self, duration, failed):
+        """请求结束后调用，duration为耗时秒数"""
+        now = time.monotonic()
+        failed = failed or duration > self.slow_call_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._open(now, "探测请求失败")
+                else:
+                    self.state = CLOSED
+                    self._calls.clear()
+                    self._probing = False
+                    print(f"Dify {self.name} 熔断器恢复")
+                return
+            if self.state == OPEN:
+                # 断开前已经发出的请求，结果不再影响状态
+                return
+
+            self._calls.append((now, failed))
+            self._trim(now)
+            failures = sum(1 for _, call_failed in self._calls if call_failed)
+            if len(self._calls) >= self.min_calls and failures / len(self._calls) >= self.failure_rate:
+                self._open(now, f"最近{len(self._calls)}次请求失败{failures}次")
+
+    def call(self, func, *args, **kwargs):
+        self.before_call()
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.record(time.monotonic() - start, is_failure(e))
+            raise
+        self.record(time.monotonic() - start, False)
+        return result
+
+
+class CircuitBreakerClient:
+    """在Dify客户端（同步或异步门面）外面加上熔断器，接口与DifyClient相同"""
+
+    def __init__(self, client, breaker_config):
+        self.client = client
+        settings = {
+            key: breaker_config[key]
+            for key in ("failure_rate", "min_calls", "window_seconds", "slow_call_seconds", "open_seconds")
+            if key in breaker_config
+        }
+        self.breakers = {name: CircuitBreaker(name, **settings) for name in set(BREAKER_GROUPS.values())}
+
+    def breaker(self, endpoint):
+        return self.breakers[BREAKER_GROUPS[endpoint]]
+
+    def upload_file(self, file_name, content, user, mime_type='image/png'):
+        return self.breaker("upload").call(self.client.upload_file, file_name, content, user, mime_type)
+
+    def run_workflow(self, inputs, user):
+        return self.breaker("workflow").call(self.client.run_workflow, inputs, user)
+
+    def chat(self, query, user, inputs=None, on_need_human=None, conversation_id=None):
+        return self.breaker("chat").call(
+            self.client.chat, query, user,
+            inputs=inputs, on_need_human=on_need_human, conversation_id=conversation_id
+        )
+
+    def states(self):
+        """返回: {熔断器名称: 状态}"""
+        return {name: breaker.state for name, breaker in self.breakers.items()}
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,93 @@
+"""
+客户会话映射
+保存 客户 -> Dify conversation_id，后续轮次带上conversation_id继续同一个会话，
+Dify自己保存对话历史，每轮只需要发送客户新发的消息。
+映射保存在内存中并持久化到SQLite，超过TTL没有使用的会话视为过期
+"""
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class ConversationStore:
+    """客户ID -> conversation_id 的映射，线程安全"""
+
+    def __init__(self, db_path="conversations.db", ttl_seconds=86400, max_entries=5000):
+        """
+        ttl_seconds: 会话超过该时间没有新的对话就重新开始
+        max_entries: 最多保存的客户数，超出后淘汰最久未使用的
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        # 客户ID -> (conversation_id, 最后使用时间)，按最近使用顺序排列
+        self._entries = OrderedDict()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "customer_id TEXT PRIMARY KEY, conversation_id TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        """启动时载入未过期的会话"""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            self._conn.execute("DELETE FROM conversations WHERE last_used < ?", (cutoff,))
+            rows = self._conn.execute(
+                "SELECT customer_id, conversation_id, last_used FROM conversations ORDER BY last_used"
+            ).fetchall()
+            self._conn.commit()
+            for customer_id, conversation_id, last_used in rows:
+                self._entries[customer_id] = (conversation_id, last_used)
+            self._evict_overflow()
+        if rows:
+            print(f"已载入 {len(self._entries)} 个客户会话")
+
+    def _evict_overflow(self):
+        while len(self._entries) > self.max_entries:
+            customer_id, _ = self._entries.popitem(last=False)
+            self._conn.execute("DELETE FROM conversations WHERE customer_id = ?", (customer_id,))
+        self._conn.commit()
+
+    def get(self, customer_id):
+        """
+        返回: 该客户未过期的conversation_id，没有时返回None
+        """
+        with self._lock:
+            entry = self._entries.get(customer_id)
+            if entry is None:
+                return None
+            conversation_id, last_used = entry
+            if time.time() - last_used > self.ttl_seconds:
+                del self._entries[customer_id]
+                self._conn.execute("DELETE FROM conversations WHERE customer_id = ?", (customer_id,))
+                self._conn.commit()
+                return None
+            return conversation_id
+
+    def set(self, customer_id, conversation_id):
+        """保存（或刷新）客户的会话，每次对话成功后调用"""
+        now = time.time()
+        with self._lock:
+            self._entries[customer_id] = (conversation_id, now)
+            self._entries.move_to_end(customer_id)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO conversations (customer_id, conversation_id, last_used) VALUES (?, ?, ?)",
+                (customer_id, conversation_id, now)
+            )
+            self._evict_overflow()
+
+    def forget(self, customer_id):
+        """丢弃客户的会话（例如Dify端会话已被删除）"""
+        with self._lock:
+            self._entries.pop(customer_id, None)
+            self._conn.execute("DELETE FROM conversations WHERE customer_id = ?", (customer_id,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,141 @@
+"""
+客户身份识别
+按聊天窗口顶部的昵称（OCR）和头像（感知哈希）给每个客户分配稳定的客户ID，
+同一个客户在不同轮次、程序重启之后得到相同的ID，按客户缓存的截图、识别结果和Dify会话才能生效。
+昵称是主键；头像只用来确认OCR错字造成的近似昵称。很多客户使用平台默认头像，所以从不只凭头像识别，
+被多个客户共用的头像也不能用来确认。索引保存在内存中并持久化到SQLite
+"""
+import time
+import uuid
+import hashlib
+import sqlite3
+import difflib
+import threading
+import unicodedata
+
+from vision_cache import dhash, hamming_distance
+
+# 无法识别身份的客户这一轮使用一次性ID：不会与其他客户重复，也不保存会话和处理日志（下一轮无法对应到同一个客户）
+UNIDENTIFIED_PREFIX = "unidentified_"
+
+
+def unidentified_customer_id():
+    return f"{UNIDENTIFIED_PREFIX}{uuid.uuid4().hex[:12]}"
+
+
+def is_identified(customer_id):
+    return not customer_id.startswith(UNIDENTIFIED_PREFIX)
+
+
+def normalize_nickname(nickname):
+    """全角转半角并去掉空白，减少OCR带来的差异"""
+    if not nickname:
+        return None
+    nickname = "".join(unicodedata.normalize("NFKC", nickname).split())
+    return nickname or None
+
+
+class CustomerIdentityIndex:
+    """昵称/头像 -> 客户ID 的索引，线程安全"""
+
+    def __init__(self, db_path="customers.db", min_name_similarity=0.85, max_avatar_distance=6):
+        """
+        min_name_similarity: 昵称没有完全相同的记录时，相似度达到该值（且头像一致）视为同一客户，用于容忍OCR错字
+        max_avatar_distance: 头像哈希（64位）的汉明距离不超过该值视为同一头像
+        """
+        self.min_name_similarity = min_name_similarity
+        self.max_avatar_distance = max_avatar_distance
+
+        self._lock = threading.Lock()
+        # 昵称 -> 客户ID（包括OCR识别出的错字变体）
+        self._names = {}
+        # 客户ID -> 头像哈希
+        self._avatars = {}
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS customer_keys ("
+            "key TEXT PRIMARY KEY, customer_id TEXT NOT NULL, last_seen REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        rows = self._conn.execute("SELECT key, customer_id FROM customer_keys").fetchall()
+        for key, customer_id in rows:
+            kind, value = key.split(":", 1)
+            if kind == "name":
+                self._names[value] = customer_id
+            elif kind == "avatar":
+                # 键为 avatar:哈希:客户ID（旧版本为 avatar:哈希）
+                self._avatars[customer_id] = int(value.split(":", 1)[0], 16)
+        if rows:
+            print(f"已载入 {len(set(customer_id for _, customer_id in rows))} 个客户身份")
+
+    def _avatar_owners(self, avatar_hash):
+        """返回: 头像与之相同的所有客户ID"""
+        return [
+            customer_id for customer_id, known_avatar in self._avatars.items()
+            if hamming_distance(avatar_hash, known_avatar) <= self.max_avatar_distance
+        ]
+
+    def _fuzzy_name(self, nickname, avatar_hash):
+        """
+        按相似度从高到低查找昵称相近的客户；淘宝昵称常常只差一位数字，所以必须头像也一致才算同一客户。
+        没有头像，或者头像同时属于多个客户（平台默认头像）时不做模糊匹配，宁可当作新客户
+        """
+        if avatar_hash is None:
+            return None
+        owners = self._avatar_owners(avatar_hash)
+        if len(owners) != 1:
+            return None
+        candidates = []
+        for name, customer_id in self._names.items():
+            if abs(len(name) - len(nickname)) > max(1, len(nickname) // 4):
+                continue
+            ratio = difflib.SequenceMatcher(None, name, nickname).ratio()
+            if ratio >= self.min_name_similarity:
+                candidates.append((ratio, customer_id))
+        for _, customer_id in sorted(candidates, reverse=True):
+            if customer_id == owners[0]:
+                return customer_id
+        return None
+
+    def _remember(self, customer_id, nickname, avatar_hash):
+        now = time.time()
+        keys = []
+        if nickname:
+            self._names[nickname] = customer_id
+            keys.append(f"name:{nickname}")
+        if avatar_hash is not None:
+            self._avatars[customer_id] = avatar_hash
+            keys.append(f"avatar:{avatar_hash:016x}:{customer_id}")
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO customer_keys (key, customer_id, last_seen) VALUES (?, ?, ?)",
+            [(key, customer_id, now) for key in keys]
+        )
+        self._conn.commit()
+
+    def identify(self, nickname=None, avatar=None):
+        """
+        nickname: 聊天窗口顶部OCR出的昵称
+        avatar: 头像截图（PIL图片）
+        返回: 稳定的客户ID；没有识别出昵称时返回None（不只凭头像识别）
+        昵称完全相同即为同一客户；近似昵称（OCR错字）需要头像也一致
+        """
+        nickname = normalize_nickname(nickname)
+        if nickname is None:
+            return None
+        avatar_hash = dhash(avatar, hash_size=8) if avatar is not None else None
+
+        with self._lock:
+            customer_id = self._names.get(nickname) or self._fuzzy_name(nickname, avatar_hash)
+            if customer_id is None:
+                # 新客户：ID由首次见到的昵称决定，即使索引文件丢失也能得到相同的ID
+                customer_id = f"customer_{hashlib.md5(f'name:{nickname}'.encode('utf-8')).hexdigest()[:12]}"
+
+            self._remember(customer_id, nickname, avatar_hash)
+            return customer_id
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,107 @@
+"""
+多客户并发处理流水线
+界面自动化（截图、粘贴回复）只能由一个UI线程执行，Dify网络调用（上传、识别、对话）交给工作线程池并发处理，
+处理结果通过队列按客户ID返回给UI线程；暂时无法处理（本地限流）的客户过一会儿重新放回工作线程池
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CustomerPipeline:
+    """UI线程提交截图，工作线程池并发调用Dify，UI线程轮询取回回复"""
+
+    def __init__(self, process_func, max_workers=4, retry_on=(), max_retries=3, retry_delay=1.0):
+        """
+        process_func: 在工作线程中执行的函数，签名为 process_func(customer_id, *args)，
+                      不能操作界面，返回值原样交给UI线程
+        retry_on: process_func抛出这些异常时，等待异常的retry_in秒（没有时为retry_delay秒）后重新处理，
+                  最多max_retries次；等待期间不占用工作线程，客户仍算作未完成。
+                  异常带有retry_args时（例如已完成阶段的结果）用它代替原来的参数重新处理
+        """
+        self._process_func = process_func
+        self._retry_on = tuple(retry_on)
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dify-worker")
+        self._results = queue.Queue()
+        # 已提交但UI线程尚未取回结果的客户
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def submit(self, customer_id, *args):
+        """
+        提交一个客户的处理任务
+        同一客户已有任务未完成时不重复提交，返回False
+        """
+        with self._lock:
+            if customer_id in self._in_flight:
+                return False
+            self._in_flight.add(customer_id)
+        self._executor.submit(self._run, customer_id, args)
+        return True
+
+    def _run(self, customer_id, args, attempt=0):
+        try:
+            result = self._process_func(customer_id, *args)
+        except self._retry_on as e:
+            if attempt < self._max_retries:
+                delay = getattr(e, "retry_in", None) or self._retry_delay
+                args = getattr(e, "retry_args", None) or args
+                print(f"后台处理客户 {customer_id} 暂时无法进行（{str(e)}），{delay:.1f}秒后重新处理")
+                timer = threading.Timer(delay, self._resubmit, (customer_id, args, attempt + 1))
+                timer.daemon = True
+                timer.start()
+                return
+            print(f"后台处理客户 {customer_id} 失败: {str(e)}")
+            result = None
+        except Exception as e:
+            print(f"后台处理客户 {customer_id} 失败: {str(e)}")
+            result = None
+        self._results.put((customer_id, result))
+
+    def _resubmit(self, customer_id, args, attempt):
+        try:
+            self._executor.submit(self._run, customer_id, args, attempt)
+        except RuntimeError:
+            # 流水线已经关闭
+            self._results.put((customer_id, None))
+
+    def poll_results(self, timeout=0):
+        """
+        取回所有已完成的结果（由UI线程调用）
+        timeout: 没有结果时最多等待的秒数，0表示不等待
+        返回: {客户ID: 处理结果}
+        """
+        results = {}
+        try:
+            customer_id, result = self._results.get(timeout=timeout) if timeout else self._results.get_nowait()
+            results[customer_id] = result
+            while True:
+                customer_id, result = self._results.get_nowait()
+                results[customer_id] = result
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            self._in_flight.difference_update(results)
+        return results
+
+    def requeue(self, customer_id, result):
+        """结果暂时无法投递（例如聊天窗口没打开）时放回队列，下次轮询再取"""
+        with self._lock:
+            self._in_flight.add(customer_id)
+        self._results.put((customer_id, result))
+
+    def is_pending(self, customer_id):
+        """客户是否还有未取回的任务"""
+        with self._lock:
+            return customer_id in self._in_flight
+
+    def pending_count(self):
+        """未取回结果的客户数量"""
+        with self._lock:
+            return len(self._in_flight)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
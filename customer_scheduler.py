@@ -0,0 +1,94 @@
+"""
+等待客户调度
+记录每个客户从打开聊天窗口起到发出回复的等待时间。流水线模式下同时有多个已生成的回复要发送时，
+待转人工的客户优先，其余按打开的先后发送。
+下一个接待哪个客户由千牛的新消息通知决定（一次只显示一个，打开之前无法识别客户），这里不参与；
+还没有打开的客户也不在统计之内，只统计处理中的客户数量和已回复客户的等待时间分位数
+"""
+import math
+import time
+import threading
+from collections import deque
+
+
+def percentile(values, percent):
+    """最近秩法求分位数，values需已排序"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, math.ceil(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+class CustomerScheduler:
+    """处理中的客户 -> (打开时间, 是否待转人工)，线程安全"""
+
+    def __init__(self, history_size=1000):
+        """
+        history_size: 用于计算等待时间分位数的最近完成数量
+        """
+        self._lock = threading.Lock()
+        self._waiting = {}
+        self._waits = deque(maxlen=history_size)
+
+    def arrive(self, customer_id, arrived_at=None):
+        """登记已打开聊天窗口、等待回复的客户，已在等待的客户保留原来的到达时间"""
+        arrived_at = arrived_at or time.time()
+        with self._lock:
+            if customer_id not in self._waiting:
+                self._waiting[customer_id] = {"arrived_at": arrived_at, "transfer": False}
+
+    def mark_transfer(self, customer_id):
+        """客户需要转人工：转人工越晚客户体验越差，优先处理"""
+        with self._lock:
+            entry = self._waiting.get(customer_id)
+            if entry:
+                entry["transfer"] = True
+
+    def _key(self, customer_id):
+        entry = self._waiting.get(customer_id)
+        if entry is None:
+            # 没有登记过的客户排在最后
+            return (1, float("inf"))
+        return (0 if entry["transfer"] else 1, entry["arrived_at"])
+
+    def order(self, customer_ids):
+        """待转人工的在前，其余按到达先后排序"""
+        with self._lock:
+            return sorted(customer_ids, key=self._key)
+
+    def complete(self, customer_id):
+        """客户本轮已回复（或已转人工），记录等待时间"""
+        with self._lock:
+            entry = self._waiting.pop(customer_id, None)
+            if entry is None:
+                return None
+            wait = time.time() - entry["arrived_at"]
+            self._waits.append(wait)
+            return wait
+
+    def discard(self, customer_id):
+        """客户不需要回复（没有新消息、处理失败），不计入等待统计"""
+        with self._lock:
+            self._waiting.pop(customer_id, None)
+
+    def queue_depth(self):
+        with self._lock:
+            return len(self._waiting)
+
+    def stats(self):
+        """
+        返回: 处理中的客户数量、其中最长的等待、已完成客户等待时间的 p50/p90/p99/最大值
+        """
+        now = time.time()
+        with self._lock:
+            waits = sorted(self._waits)
+            oldest = max((now - entry["arrived_at"] for entry in self._waiting.values()), default=0.0)
+            return {
+                "queue_depth": len(self._waiting),
+                "oldest_wait": oldest,
+                "completed": len(waits),
+                "p50": percentile(waits, 50),
+                "p90": percentile(waits, 90),
+                "p99": percentile(waits, 99),
+                "max": waits[-1] if waits else 0.0,
+            }
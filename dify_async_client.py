@@ -0,0 +1,235 @@
+"""
+Dify API 异步客户端
+基于asyncio + aiohttp，一个事件循环即可同时保持大量进行中的请求；
+每个应用密钥用信号量限制并发数，收到429时按Retry-After暂停该密钥的所有请求。
+SyncDifyFacade 提供与 DifyClient 相同的同步方法，两个机器人脚本无需改动调用方式
+"""
+import time
+import queue
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+from dify_client import (
+    DEFAULT_TIMEOUTS,
+    IDEMPOTENT_ENDPOINTS,
+    ChatStreamCollector,
+    DifyStreamError,
+    compute_backoff,
+    should_retry_status,
+)
+
+# 连接阶段失败，请求一定没有发出，任何接口都可以重试
+CONNECT_ERRORS = (aiohttp.ClientConnectorError,)
+if hasattr(aiohttp, "ConnectionTimeoutError"):
+    CONNECT_ERRORS += (aiohttp.ConnectionTimeoutError,)
+
+
+class AsyncDifyClient:
+    """asyncio版Dify客户端，方法与DifyClient一一对应，均为协程"""
+
+    def __init__(self, dify_config):
+        self.vision_api_url = dify_config['vision_api_url']
+        self.chat_api_url = dify_config['chat_api_url']
+        self.file_upload_url = dify_config['file_upload_url']
+        self.chat_api_key = dify_config['api_key']
+        self.vision_api_key = dify_config['vision_api_key']
+
+        timeouts = dict(DEFAULT_TIMEOUTS)
+        for endpoint, timeout in dify_config.get('timeouts', {}).items():
+            timeouts[endpoint] = tuple(timeout)
+        self.timeouts = {
+            endpoint: aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+            for endpoint, (connect, read) in timeouts.items()
+        }
+
+        self.max_retries = dify_config.get('max_retries', 2)
+        self.retry_backoff = dify_config.get('retry_backoff', 0.5)
+        # 开启限流时为False：429由限流器处理，不在这里重试和暂停
+        self.retry_throttled = dify_config.get('retry_throttled', True)
+        self.pool_size = dify_config.get('pool_size', 10)
+        self.chat_response_mode = dify_config.get('chat_response_mode', 'blocking')
+        # 每个应用密钥同时进行中的请求数上限
+        self.max_concurrency_per_key = dify_config.get('max_concurrency_per_key', 8)
+
+        self.chat_headers = {"Authorization": f"Bearer {self.chat_api_key}"}
+        self.vision_headers = {"Authorization": f"Bearer {self.vision_api_key}"}
+
+        self._session = None
+        self._semaphores = {}
+        # 应用密钥 -> 收到429后允许再次发送请求的时间点（time.monotonic）
+        self._blocked_until = {}
+
+    def _get_session(self):
+        """在事件循环内惰性创建共享的ClientSession"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size * 4, limit_per_host=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def _get_semaphore(self, api_key):
+        semaphore = self._semaphores.get(api_key)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrency_per_key)
+            self._semaphores[api_key] = semaphore
+        return semaphore
+
+    async def _acquire(self, api_key):
+        """占用该密钥的一个并发名额；该密钥处于429冷却期时先等待，等待期间不占用名额"""
+        semaphore = self._get_semaphore(api_key)
+        while True:
+            delay = self._blocked_until.get(api_key, 0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await semaphore.acquire()
+            # 排队期间其他请求可能收到了429
+            if self._blocked_until.get(api_key, 0) <= time.monotonic():
+                return semaphore
+            semaphore.release()
+
+    @asynccontextmanager
+    async def _post(self, endpoint, url, api_key, headers, make_kwargs):
+        """
+        发送POST请求，对可安全重试的失败进行退避重试；用法: async with self._post(...) as response
+        每次尝试占用该密钥的一个并发名额直到正文读取完毕，退避等待期间不占用
+        make_kwargs: 每次尝试都重新生成请求参数（FormData只能发送一次）
+        """
+        session = self._get_session()
+        attempt = 0
+        while True:
+            retry_after = None
+            semaphore = await self._acquire(api_key)
+            try:
+                response = await session.post(
+                    url,
+                    headers=headers,
+                    timeout=self.timeouts[endpoint],
+                    **make_kwargs()
+                )
+            except CONNECT_ERRORS:
+                if attempt >= self.max_retries:
+                    raise
+            except aiohttp.ClientConnectionError:
+                if endpoint not in IDEMPOTENT_ENDPOINTS or attempt >= self.max_retries:
+                    raise
+            else:
+                if attempt >= self.max_retries or not should_retry_status(endpoint, response.status, self.retry_throttled):
+                    # 出错时raise_for_status会先释放连接再抛出异常
+                    response.raise_for_status()
+                    async with response:
+                        yield response
+                    return
+                retry_after = response.headers.get("Retry-After")
+                response.release()
+            finally:
+                semaphore.release()
+
+            wait = compute_backoff(attempt, self.retry_backoff, retry_after)
+            if retry_after:
+                # 429/503带Retry-After时，同一密钥的其他请求也一起暂停
+                self._blocked_until[api_key] = max(self._blocked_until.get(api_key, 0), time.monotonic() + wait)
+            attempt += 1
+            print(f"Dify {endpoint} 请求失败，{wait:.1f}秒后进行第{attempt}次重试")
+            await asyncio.sleep(wait)
+
+    async def upload_file(self, file_name, content, user, mime_type='image/png'):
+        """
+        上传文件内容到Dify
+        返回: 上传接口的响应JSON
+        """
+        def make_kwargs():
+            form = aiohttp.FormData()
+            form.add_field('file', content, filename=file_name, content_type=mime_type)
+            form.add_field('user', user)
+            return {"data": form}
+
+        async with self._post("upload", self.file_upload_url, self.vision_api_key, self.vision_headers, make_kwargs) as response:
+            return await response.json(content_type=None)
+
+    async def run_workflow(self, inputs, user):
+        """
+        以阻塞模式运行视觉工作流
+        返回: 工作流接口的响应JSON
+        """
+        payload = {
+            "inputs": inputs,
+            "response_mode": "blocking",
+            "user": user
+        }
+        async with self._post("workflow", self.vision_api_url, self.vision_api_key, self.vision_headers, lambda: {"json": payload}) as response:
+            return await response.json(content_type=None)
+
+    async def chat(self, query, user, inputs=None, on_need_human=None, conversation_id=None):
+        """
+        调用对话流，按配置选择阻塞或流式模式
+        on_need_human: 流式模式下回复中一出现转人工标记就立即调用，在事件循环线程中执行
+        conversation_id: 继续之前的会话，为空时开始新会话
+        返回: 对话接口的响应JSON，流式模式下组装成与阻塞模式相同的结构
+        """
+        streaming = self.chat_response_mode == 'streaming'
+        payload = {
+            "inputs": inputs or {},
+            "query": query,
+            "user": user,
+            "response_mode": "streaming" if streaming else "blocking"
+        }
+        if conversation_id:
+            payload["conversation_id"] = conversation_id
+        async with self._post("chat", self.chat_api_url, self.chat_api_key, self.chat_headers, lambda: {"json": payload}) as response:
+            if not streaming:
+                return await response.json(content_type=None)
+
+            collector = ChatStreamCollector(on_need_human)
+            # StreamReader按行迭代，收到message_end立即返回
+            async for line in response.content:
+                result = collector.feed_line(line)
+                if result is not None:
+                    return result
+            raise DifyStreamError("流式响应在message_end之前中断")
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class SyncDifyFacade:
+    """在后台线程中运行事件循环，对外提供与DifyClient相同的同步方法，可被多个线程同时调用"""
+
+    def __init__(self, dify_config):
+        self._client = AsyncDifyClient(dify_config)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="dify-asyncio", daemon=True)
+        self._thread.start()
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def upload_file(self, file_name, content, user, mime_type='image/png'):
+        return self._run(self._client.upload_file(file_name, content, user, mime_type))
+
+    def run_workflow(self, inputs, user):
+        return self._run(self._client.run_workflow(inputs, user))
+
+    def chat(self, query, user, inputs=None, on_need_human=None, conversation_id=None):
+        if on_need_human is None:
+            return self._run(self._client.chat(query, user, inputs, conversation_id=conversation_id))
+
+        # 回调可能要操作界面，必须回到调用方线程执行：事件循环只负责发信号
+        signals = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self._client.chat(query, user, inputs, on_need_human=lambda: signals.put(True),
+                              conversation_id=conversation_id),
+            self._loop
+        )
+        future.add_done_callback(lambda f: signals.put(False))
+        while signals.get():
+            on_need_human()
+        return future.result()
+
+    def close(self):
+        """关闭连接并停止事件循环"""
+        self._run(self._client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
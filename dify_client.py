@@ -0,0 +1,345 @@
+"""
+Dify API 客户端
+上传、视觉工作流、对话三个接口共用按域名划分的连接池，统一设置超时和重试策略
+"""
+import time
+import json
+import random
+import threading
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+# 各接口默认超时：(连接超时, 读取超时)，单位秒
+DEFAULT_TIMEOUTS = {
+    "upload": (5, 30),
+    "workflow": (5, 60),
+    "chat": (5, 120),
+}
+
+# 服务端明确表示未处理请求的状态码，任何接口都可以安全重试
+RETRY_ALWAYS_STATUS = (429, 503)
+# 网关错误时上游可能已经处理过请求，只对幂等接口重试
+RETRY_IDEMPOTENT_STATUS = (502, 504)
+# 重复执行不会产生额外副作用的接口：上传会再保存一份文件，工作流和对话会重复计费，都不是。
+# 这些接口只在连接阶段失败（请求一定没有发出）或服务端明确未处理时重试
+IDEMPOTENT_ENDPOINTS = ()
+
+# 重试等待时间上限，单位秒
+MAX_BACKOFF = 10
+
+# Dify对话回复中表示需要转人工的标记，长的放前面，避免只删掉一半
+TRANSFER_MARKERS = ("需要转人工", "转人工")
+
+
+class DifyStreamError(Exception):
+    """流式对话返回error事件或在message_end之前中断"""
+
+
+def split_transfer_marker(reply):
+    """
+    检查回复中的转人工标记
+    返回: (去除标记后的回复, 是否需要转人工)
+    """
+    need_human = any(marker in reply for marker in TRANSFER_MARKERS)
+    if need_human:
+        for marker in TRANSFER_MARKERS:
+            reply = reply.replace(marker, "")
+        reply = reply.strip()
+    return reply, need_human
+
+
+def http_status(error):
+    """从requests或aiohttp的异常中取出HTTP状态码，不是HTTP错误时返回None"""
+    response = getattr(error, "response", None)
+    if response is not None and hasattr(response, "status_code"):
+        return response.status_code
+    return getattr(error, "status", None)
+
+
+def is_connect_error(error):
+    """连接阶段失败（连接超时、拒绝连接、域名解析失败），请求一定没有发出"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def should_retry_status(endpoint, status_code, retry_throttled=True):
+    """
+    判断某个接口收到该状态码时是否可以重试
+    retry_throttled: 为False时429不在这里重试，交给外层的限流器处理
+    """
+    if status_code == 429 and not retry_throttled:
+        return False
+    if status_code in RETRY_ALWAYS_STATUS:
+        return True
+    return endpoint in IDEMPOTENT_ENDPOINTS and status_code in RETRY_IDEMPOTENT_STATUS
+
+
+def compute_backoff(attempt, retry_backoff, retry_after=None):
+    """计算重试等待时间：优先使用Retry-After，否则使用带抖动的指数退避"""
+    if retry_after:
+        try:
+            return min(float(retry_after), MAX_BACKOFF)
+        except ValueError:
+            pass
+    return random.uniform(0, min(retry_backoff * (2 ** attempt), MAX_BACKOFF))
+
+
+class ChatStreamCollector:
+    """
+    逐行解析对话流的SSE事件，只累积回复文本，同步和异步客户端共用
+    回复中一出现转人工标记就调用on_need_human（每次对话只调用一次）
+    marker_found: 当前回复中是否有转人工标记（message_replace替换回复后重新判断）
+    """
+
+    def __init__(self, on_need_human=None):
+        self.on_need_human = on_need_human
+        self.answer_parts = []
+        # 保留上一段末尾的几个字符，防止标记被拆在两个事件里
+        self._tail_size = max(len(marker) for marker in TRANSFER_MARKERS) - 1
+        self._tail = ""
+        self.marker_found = False
+        self._notified = False
+
+    def feed_line(self, line):
+        """
+        处理一行SSE数据（bytes）
+        返回: 收到message_end时返回与阻塞模式结构相同的结果，否则返回None
+        """
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            return None
+        event = json.loads(line[5:].decode("utf-8"))
+        event_type = event.get("event")
+
+        if event_type in ("message", "agent_message"):
+            chunk = event.get("answer", "")
+            self.answer_parts.append(chunk)
+            self._scan(self._tail + chunk)
+        elif event_type == "message_replace":
+            # 内容审查命中时Dify会替换整段回复，之前的文本（包括保留的末尾）都作废
+            answer = event.get("answer", "")
+            self.answer_parts = [answer]
+            self.marker_found = False
+            self._tail = ""
+            self._scan(answer)
+        elif event_type == "message_end":
+            return {
+                "event": "message",
+                "message_id": event.get("message_id"),
+                "conversation_id": event.get("conversation_id"),
+                "answer": "".join(self.answer_parts),
+                "metadata": event.get("metadata", {})
+            }
+        elif event_type == "error":
+            raise DifyStreamError(f"{event.get('code')}: {event.get('message')}")
+        return None
+
+    def _scan(self, window):
+        """在上一段末尾加上新文本中查找转人工标记"""
+        if not self.marker_found and any(marker in window for marker in TRANSFER_MARKERS):
+            self.marker_found = True
+            if self.on_need_human and not self._notified:
+                self._notified = True
+                self.on_need_human()
+        self._tail = window[-self._tail_size:]
+
+
+class DifyClient:
+    """共享的Dify HTTP客户端，线程安全，可在多个客户之间复用"""
+
+    def __init__(self, dify_config):
+        self.vision_api_url = dify_config['vision_api_url']
+        self.chat_api_url = dify_config['chat_api_url']
+        self.file_upload_url = dify_config['file_upload_url']
+
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        for endpoint, timeout in dify_config.get('timeouts', {}).items():
+            self.timeouts[endpoint] = tuple(timeout)
+
+        self.max_retries = dify_config.get('max_retries', 2)
+        self.retry_backoff = dify_config.get('retry_backoff', 0.5)
+        # 开启限流时由create_dify_client设为False：429由限流器暂停整个接口，不再各自重试
+        self.retry_throttled = dify_config.get('retry_throttled', True)
+        self.pool_size = dify_config.get('pool_size', 10)
+        # blocking: 等待完整回复; streaming: 通过SSE逐段接收回复
+        self.chat_response_mode = dify_config.get('chat_response_mode', 'blocking')
+
+        # 请求头只构造一次，之后每次请求直接复用
+        self.chat_headers = {
+            "Authorization": f"Bearer {dify_config['api_key']}",
+            "Content-Type": "application/json"
+        }
+        self.vision_headers = {
+            "Authorization": f"Bearer {dify_config['vision_api_key']}",
+            "Content-Type": "application/json"
+        }
+        # 文件上传使用multipart，Content-Type由requests自动生成
+        self.upload_headers = {
+            "Authorization": f"Bearer {dify_config['vision_api_key']}"
+        }
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _get_session(self, url):
+        """按域名获取（或创建）保持长连接的Session"""
+        parts = urlsplit(url)
+        base_url = f"{parts.scheme}://{parts.netloc}"
+        with self._lock:
+            session = self._sessions.get(base_url)
+            if session is None:
+                session = requests.Session()
+                # 重试由_post统一控制，这里关闭urllib3自带的重试
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size,
+                    max_retries=0
+                )
+                session.mount(base_url, adapter)
+                self._sessions[base_url] = session
+            return session
+
+    def _post(self, endpoint, url, headers, **kwargs):
+        """发送POST请求，对可安全重试的失败进行退避重试"""
+        session = self._get_session(url)
+        attempt = 0
+        while True:
+            try:
+                response = session.post(
+                    url,
+                    headers=headers,
+                    timeout=self.timeouts[endpoint],
+                    **kwargs
+                )
+            except requests.exceptions.ConnectionError as e:
+                # 连接建立之后断开的，请求可能已经被处理，只有幂等接口重试
+                if not (is_connect_error(e) or endpoint in IDEMPOTENT_ENDPOINTS) or attempt >= self.max_retries:
+                    raise
+                wait = compute_backoff(attempt, self.retry_backoff)
+            else:
+                if attempt >= self.max_retries or not should_retry_status(endpoint, response.status_code, self.retry_throttled):
+                    response.raise_for_status()
+                    return response
+                wait = compute_backoff(attempt, self.retry_backoff, response.headers.get("Retry-After"))
+                response.close()
+
+            attempt += 1
+            print(f"Dify {endpoint} 请求失败，{wait:.1f}秒后进行第{attempt}次重试")
+            time.sleep(wait)
+
+    def upload_file(self, file_name, content, user, mime_type='image/png'):
+        """
+        上传文件内容到Dify
+        返回: 上传接口的响应JSON
+        """
+        # 使用bytes而不是文件对象，重试时无需回退文件指针
+        files = {
+            'file': (file_name, content, mime_type)
+        }
+        data = {
+            'user': user
+        }
+        response = self._post("upload", self.file_upload_url, self.upload_headers, files=files, data=data)
+        return response.json()
+
+    def run_workflow(self, inputs, user):
+        """
+        以阻塞模式运行视觉工作流
+        返回: 工作流接口的响应JSON
+        """
+        payload = {
+            "inputs": inputs,
+            "response_mode": "blocking",
+            "user": user
+        }
+        response = self._post("workflow", self.vision_api_url, self.vision_headers, json=payload)
+        return response.json()
+
+    def chat(self, query, user, inputs=None, on_need_human=None, conversation_id=None):
+        """
+        调用对话流，按配置选择阻塞或流式模式
+        on_need_human: 流式模式下回复中一出现转人工标记就立即调用（只调用一次）
+        conversation_id: 继续之前的会话，Dify会带上该会话的历史，为空时开始新会话
+        返回: 对话接口的响应JSON，流式模式下组装成与阻塞模式相同的结构
+        """
+        if self.chat_response_mode == 'streaming':
+            return self.chat_streaming(query, user, inputs, on_need_human, conversation_id)
+
+        payload = {
+            "inputs": inputs or {},
+            "query": query,
+            "user": user,
+            "response_mode": "blocking"
+        }
+        if conversation_id:
+            payload["conversation_id"] = conversation_id
+        response = self._post("chat", self.chat_api_url, self.chat_headers, json=payload)
+        return response.json()
+
+    def chat_streaming(self, query, user, inputs=None, on_need_human=None, conversation_id=None):
+        """
+        以流式模式调用对话流，逐行解析SSE事件，只累积回复文本
+        收到message_end后立即返回，不等待连接关闭
+        """
+        payload = {
+            "inputs": inputs or {},
+            "query": query,
+            "user": user,
+            "response_mode": "streaming"
+        }
+        if conversation_id:
+            payload["conversation_id"] = conversation_id
+        response = self._post("chat", self.chat_api_url, self.chat_headers, json=payload, stream=True)
+
+        collector = ChatStreamCollector(on_need_human)
+        try:
+            # chunk_size=None 按服务端分块到达的节奏读取，不等待固定大小的缓冲区
+            for line in response.iter_lines(chunk_size=None):
+                result = collector.feed_line(line)
+                if result is not None:
+                    return result
+        finally:
+            response.close()
+
+        raise DifyStreamError("流式响应在message_end之前中断")
+
+    def close(self):
+        """关闭所有连接池"""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+def create_dify_client(dify_config):
+    """
+    按配置创建Dify客户端
+    dify.client 为 "async" 时使用基于asyncio的同步门面（需要安装aiohttp），否则使用requests实现
+    dify.circuit_breaker.enabled 为true时在外面加上熔断器，Dify不可用时请求立即失败
+    dify.rate_limit.enabled 为true时在最外层加上限流和每日预算（排队等待不计入熔断器的慢请求），
+    429由限流器统一处理，内层客户端不再重试429
+    """
+    limit_config = dify_config.get('rate_limit', {})
+    if limit_config.get('enabled', False):
+        dify_config = dict(dify_config, retry_throttled=False)
+
+    if dify_config.get('client', 'sync') == 'async':
+        from dify_async_client import SyncDifyFacade
+        client = SyncDifyFacade(dify_config)
+    else:
+        client = DifyClient(dify_config)
+
+    breaker_config = dify_config.get('circuit_breaker', {})
+    if breaker_config.get('enabled', False):
+        from circuit_breaker import CircuitBreakerClient
+        client = CircuitBreakerClient(client, breaker_config)
+
+    if limit_config.get('enabled', False):
+        from rate_limiter import RateLimitedClient
+        client = RateLimitedClient(client, limit_config)
+    return client
@@ -0,0 +1,127 @@
+"""
+聊天截图增量比较
+按客户缓存上一次截图的逐行哈希，新截图与之对齐（聊天区域会整体上滚），
+只裁剪出新增的行交给视觉识别，内容没有变化时直接跳过识别。
+新截图先暂存，这一轮回复发出（或转人工）后才成为比较基准；处理失败时下次仍与原来的基准比较，新消息不会丢
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class FrameDiffCache:
+    """按客户保存上一帧的行哈希（不保存整张图），计算新增内容条带"""
+
+    def __init__(self, max_customers=500, min_overlap_ratio=0.5, margin=4):
+        """
+        max_customers: 最多缓存多少个客户的上一帧，超出后淘汰最久未使用的
+        min_overlap_ratio: 对齐后重叠区域中至少有这个比例的非空白行相同，才认为是同一段对话
+        margin: 裁剪新内容时向上多保留的像素行，避免切掉文字上沿
+        """
+        self.max_customers = max_customers
+        self.min_overlap_ratio = min_overlap_ratio
+        self.margin = margin
+        self._frames = OrderedDict()
+        # 已截图但这一轮还没有完成的帧，commit后才替换_frames中的基准
+        self._staged = {}
+        self._weights = {}
+        self._lock = threading.Lock()
+
+    def _row_hashes(self, gray):
+        """
+        对每一行像素计算64位哈希（随机权重点积，uint64溢出即取模）
+        返回: (行哈希数组, 空白行掩码)
+        """
+        height, width = gray.shape
+        weights = self._weights.get(width)
+        if weights is None:
+            rng = np.random.RandomState(width)
+            weights = rng.randint(1, 2 ** 62, size=width, dtype=np.uint64)
+            self._weights[width] = weights
+        hashes = gray.astype(np.uint64) @ weights
+        # 整行颜色一致视为空白行（背景、分隔线），不参与对齐打分
+        blank = gray.min(axis=1) == gray.max(axis=1)
+        return hashes, blank
+
+    def _best_shift(self, previous, current, prev_blank, cur_blank):
+        """
+        寻找滚动偏移s，使重叠区域内 current[k] == previous[k + s] 的非空白行比例最高
+        （气泡边框等重复行在错误的偏移下也会大量相同，所以比较比例而不是行数）
+        返回: 偏移行数，找不到可信的对齐时返回None
+        """
+        # 重叠区域太小时比例没有意义
+        min_rows = max(8, int((~cur_blank).sum()) // 10)
+        best_shift, best_key = None, None
+        for shift in range(len(previous)):
+            overlap = min(len(previous) - shift, len(current))
+            valid = ~cur_blank[:overlap] & ~prev_blank[shift:shift + overlap]
+            valid_count = int(valid.sum())
+            if valid_count < min_rows:
+                continue
+            score = int(((current[:overlap] == previous[shift:shift + overlap]) & valid).sum())
+            ratio = score / valid_count
+            if ratio < self.min_overlap_ratio or score < min_rows:
+                continue
+            key = (ratio, score)
+            if best_key is None or key > best_key:
+                best_shift, best_key = shift, key
+        return best_shift
+
+    def new_content(self, customer_id, image):
+        """
+        与该客户上一帧比较，新截图暂存到commit时再作为基准
+        返回: 新增内容的裁剪图；首次截图或无法对齐时返回原图；内容没有变化时返回None
+        """
+        gray = np.asarray(image.convert("L"))
+        hashes, blank = self._row_hashes(gray)
+
+        with self._lock:
+            previous = self._frames.get(customer_id)
+            self._staged[customer_id] = (gray.shape[1], hashes, blank)
+
+        if previous is None or previous[0] != gray.shape[1]:
+            return image
+
+        _, prev_hashes, prev_blank = previous
+        shift = self._best_shift(prev_hashes, hashes, prev_blank, blank)
+        if shift is None:
+            return image
+
+        # 重叠区域内第一条变化的非空白行就是新内容的起点（包括原来空白处新出现的消息）；
+        # 重叠区域完全相同时，新内容只可能在滚动后露出的底部
+        overlap = min(len(prev_hashes) - shift, len(hashes))
+        changed = ~blank[:overlap] & (hashes[:overlap] != prev_hashes[shift:shift + overlap])
+        changed_rows = np.flatnonzero(changed)
+        if len(changed_rows):
+            start = int(changed_rows[0])
+        else:
+            bottom_rows = np.flatnonzero(~blank[overlap:])
+            if len(bottom_rows) == 0:
+                return None
+            start = overlap + int(bottom_rows[0])
+
+        top = max(0, start - self.margin)
+        return image.crop((0, top, image.width, image.height))
+
+    def commit(self, customer_id):
+        """该客户这一轮已回复或已转人工：暂存的截图成为下次比较的基准"""
+        with self._lock:
+            frame = self._staged.pop(customer_id, None)
+            if frame is None:
+                return
+            self._frames.pop(customer_id, None)
+            self._frames[customer_id] = frame
+            while len(self._frames) > self.max_customers:
+                self._frames.popitem(last=False)
+
+    def rollback(self, customer_id):
+        """该客户这一轮没有发出回复：丢弃暂存的截图，下次仍与原来的基准比较"""
+        with self._lock:
+            self._staged.pop(customer_id, None)
+
+    def forget(self, customer_id):
+        """丢弃某个客户的缓存（例如无法识别文本，下次重新识别完整截图）"""
+        with self._lock:
+            self._frames.pop(customer_id, None)
+            self._staged.pop(customer_id, None)
@@ -0,0 +1,55 @@
+"""
+客户消息防抖
+客户常常连续发几条短消息，打开聊天窗口后先等聊天区域安静下来（quiet_seconds内没有新内容），
+再截图交给识别和对话，一阵连发的消息合并为一轮处理，最长等待max_wait秒
+"""
+import time
+
+from change_detector import ChangeDetector
+
+
+class MessageDebouncer:
+    """等待客户的聊天区域稳定后再处理"""
+
+    def __init__(self, grab_func, quiet_seconds=1.5, max_wait=6.0, poll_interval=0.3,
+                 hash_size=32, pixel_delta=3):
+        """
+        grab_func: 截屏函数，参数为 region=(x, y, width, height)，返回PIL图片
+        quiet_seconds: 聊天区域持续这么久没有变化才开始处理
+        max_wait: 客户一直在发消息时最多等待的秒数
+        poll_interval: 检查聊天区域的间隔
+        hash_size / pixel_delta: 变化检测的缩略图边长和灰度阈值，含义同 ChangeDetector
+        """
+        self.grab_func = grab_func
+        self.quiet_seconds = quiet_seconds
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.hash_size = hash_size
+        self.pixel_delta = pixel_delta
+
+    def wait(self, region):
+        """
+        region: 聊天区域 (x, y, width, height)
+        返回: (等待的秒数, 等待期间聊天区域变化的次数)
+        """
+        detector = ChangeDetector(
+            self.grab_func,
+            region=region,
+            hash_size=self.hash_size,
+            pixel_delta=self.pixel_delta,
+            force_check_seconds=float("inf")
+        )
+        # 第一次调用只记录基准
+        detector.changed()
+
+        start = last_change = time.monotonic()
+        changes = 0
+        while True:
+            now = time.monotonic()
+            if now - last_change >= self.quiet_seconds or now - start >= self.max_wait:
+                break
+            time.sleep(min(self.poll_interval, self.max_wait - (now - start)))
+            if detector.changed():
+                changes += 1
+                last_change = time.monotonic()
+        return time.monotonic() - start, changes
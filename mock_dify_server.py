@@ -0,0 +1,279 @@
+"""
+本地模拟Dify服务
+实现机器人用到的三个接口：/files/upload、/workflows/run、/chat-messages（阻塞和流式），
+可以设置各接口的延迟和出错比例，并统计调用次数，用于离线回放测试（benchmark_replay.py）
+或在没有真实Dify的机器上调试机器人。
+
+用法:
+    python mock_dify_server.py --port 5001 --latency upload=0.2,workflow=1.5,chat=2.0 --error-rate 0.05
+"""
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ENDPOINTS = ("upload", "workflow", "chat")
+
+# 没有指定视觉识别结果时工作流返回的文本
+DEFAULT_VISION_TEXT = "你好，请问今天下单什么时候发货？"
+
+
+def parse_latency(text):
+    """
+    "upload=0.2,workflow=1.5,chat=2" 或 "0.5"（所有接口相同）
+    返回: {接口: 秒数}
+    """
+    if not text:
+        return {}
+    if "=" not in text:
+        return {endpoint: float(text) for endpoint in ENDPOINTS}
+    latency = {}
+    for item in text.split(","):
+        endpoint, value = item.split("=", 1)
+        latency[endpoint.strip()] = float(value)
+    return latency
+
+
+class MockDifyServer:
+    """在后台线程中运行的模拟Dify服务，线程安全"""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=None, jitter=0.2, error_rate=0.0,
+                 error_status=500, transfer_rate=0.0, stream_chunk_size=8, seed=None):
+        """
+        latency: {接口: 平均延迟秒数}，接口为 upload / workflow / chat
+        jitter: 延迟的随机浮动比例，0.2表示在平均值的 ±20% 内均匀分布
+        error_rate: 每个请求返回 error_status 的概率（429/503会被客户端重试）
+        transfer_rate: 对话回复中带转人工标记的概率；问题中提到"人工"时总是带标记
+        stream_chunk_size: 流式模式下每个message事件的字数
+        """
+        self.latency = dict(latency or {})
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.transfer_rate = transfer_rate
+        self.stream_chunk_size = stream_chunk_size
+        self._random = random.Random(seed)
+
+        # 客户（Dify的user参数）-> 视觉工作流返回的文本，回放测试按截图的参考文本设置
+        self.vision_texts = {}
+
+        self._lock = threading.Lock()
+        self._conversations = set()
+        self._calls = {endpoint: 0 for endpoint in ENDPOINTS}
+        self._errors = {endpoint: 0 for endpoint in ENDPOINTS}
+        self._tokens = 0
+
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def dify_config(self, base=None):
+        """返回指向本服务的dify配置，其余设置（超时、重试、流式等）沿用base"""
+        config = dict(base or {})
+        config.update({
+            "vision_api_url": f"{self.base_url}/workflows/run",
+            "chat_api_url": f"{self.base_url}/chat-messages",
+            "file_upload_url": f"{self.base_url}/files/upload",
+            "api_key": config.get("api_key", "app-mock"),
+            "vision_api_key": config.get("vision_api_key", "app-mock"),
+        })
+        return config
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-dify", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        """返回: {接口: {"calls": 调用次数, "errors": 注入的错误次数}}，以及累计token数"""
+        with self._lock:
+            stats = {
+                endpoint: {"calls": self._calls[endpoint], "errors": self._errors[endpoint]}
+                for endpoint in ENDPOINTS
+            }
+            stats["total_tokens"] = self._tokens
+            return stats
+
+    def _delay(self, endpoint):
+        mean = self.latency.get(endpoint, 0)
+        if mean > 0:
+            with self._lock:
+                factor = self._random.uniform(1 - self.jitter, 1 + self.jitter)
+            time.sleep(max(0.0, mean * factor))
+
+    def _begin(self, endpoint):
+        """记录一次调用，返回: 需要注入的错误状态码，不注入时返回None"""
+        with self._lock:
+            self._calls[endpoint] += 1
+            if self.error_rate and self._random.random() < self.error_rate:
+                self._errors[endpoint] += 1
+                return self.error_status
+        return None
+
+    def _answer(self, query):
+        with self._lock:
+            transfer = "人工" in query or (self.transfer_rate and self._random.random() < self.transfer_rate)
+        answer = f"您好，关于您的问题“{query[:20]}”，我们会尽快为您处理。"
+        if transfer:
+            answer += "需要转人工"
+        return answer
+
+    def _usage(self, query, answer):
+        prompt_tokens = len(query) + 200
+        completion_tokens = len(answer)
+        with self._lock:
+            self._tokens += prompt_tokens + completion_tokens
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def _conversation(self, conversation_id):
+        """返回: 会话ID；请求的会话不存在时返回None（Dify返回404）"""
+        with self._lock:
+            if conversation_id:
+                return conversation_id if conversation_id in self._conversations else None
+            conversation_id = uuid.uuid4().hex
+            self._conversations.add(conversation_id)
+            return conversation_id
+
+    def _handler_class(self):
+        server = self
+
+        class MockDifyHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _send_json(self, status, body):
+                content = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def _read_body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def do_POST(self):
+                path = self.path.split("?")[0].rstrip("/")
+                body = self._read_body()
+                if path.endswith("/files/upload"):
+                    endpoint = "upload"
+                elif path.endswith("/workflows/run"):
+                    endpoint = "workflow"
+                elif path.endswith("/chat-messages"):
+                    endpoint = "chat"
+                else:
+                    self._send_json(404, {"code": "not_found", "message": path})
+                    return
+
+                server._delay(endpoint)
+                error_status = server._begin(endpoint)
+                if error_status:
+                    self._send_json(error_status, {"code": "mock_error", "message": "injected error"})
+                    return
+
+                if endpoint == "upload":
+                    self._send_json(201, {"id": str(uuid.uuid4()), "size": len(body)})
+                elif endpoint == "workflow":
+                    payload = json.loads(body or b"{}")
+                    text = server.vision_texts.get(payload.get("user"), DEFAULT_VISION_TEXT)
+                    self._send_json(200, {
+                        "workflow_run_id": str(uuid.uuid4()),
+                        "data": {"status": "succeeded", "outputs": text}
+                    })
+                else:
+                    self._chat(json.loads(body or b"{}"))
+
+            def _chat(self, payload):
+                conversation_id = server._conversation(payload.get("conversation_id"))
+                if conversation_id is None:
+                    self._send_json(404, {"code": "not_found", "message": "Conversation Not Exists."})
+                    return
+                query = payload.get("query", "")
+                answer = server._answer(query)
+                message_id = str(uuid.uuid4())
+                metadata = {"usage": server._usage(query, answer)}
+
+                if payload.get("response_mode") != "streaming":
+                    self._send_json(200, {
+                        "event": "message",
+                        "message_id": message_id,
+                        "conversation_id": conversation_id,
+                        "answer": answer,
+                        "metadata": metadata
+                    })
+                    return
+
+                # 流式模式：分段发送message事件，最后发送message_end，连接保持到响应结束
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                size = server.stream_chunk_size
+                events = [{"event": "message", "answer": answer[i:i + size]} for i in range(0, len(answer), size)]
+                events.append({
+                    "event": "message_end",
+                    "message_id": message_id,
+                    "conversation_id": conversation_id,
+                    "metadata": metadata
+                })
+                for event in events:
+                    self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        return MockDifyHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟Dify服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--latency", default="", help='各接口延迟秒数，如 "upload=0.2,workflow=1.5,chat=2"')
+    parser.add_argument("--jitter", type=float, default=0.2, help="延迟随机浮动比例")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入错误的请求比例")
+    parser.add_argument("--error-status", type=int, default=500, help="注入错误的HTTP状态码")
+    parser.add_argument("--transfer-rate", type=float, default=0.0, help="回复带转人工标记的比例")
+    args = parser.parse_args()
+
+    server = MockDifyServer(
+        host=args.host,
+        port=args.port,
+        latency=parse_latency(args.latency),
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        transfer_rate=args.transfer_rate
+    ).start()
+    print(f"模拟Dify服务已启动: {server.base_url}")
+    print("config.json 中的dify地址可改为:")
+    print(json.dumps({key: value for key, value in server.dify_config().items() if key.endswith("_url")},
+                     indent=4, ensure_ascii=False))
+    try:
+        while True:
+            time.sleep(10)
+            print(f"调用统计: {server.stats()}")
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
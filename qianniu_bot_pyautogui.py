@@ -1,22 +1,38 @@
 import time
 import json
-import requests
 import os
-import glob
 import pyperclip
 import pyautogui
-import cv2
-import numpy as np
-from datetime import datetime, timedelta
+from datetime import datetime
 from PIL import Image
+from dify_client import create_dify_client, http_status, split_transfer_marker
+from circuit_breaker import CircuitOpenError
+from rate_limiter import BudgetExceededError, RateLimitedError
+from customer_pipeline import CustomerPipeline
+from frame_diff import FrameDiffCache
+from screenshot_io import ScreenshotArchiver, encode_image
+from screenshot_retention import ScreenshotRetention
+from vision_cache import VisionCache
+from template_matcher import TemplateMatcher
+from change_detector import ChangeDetector
+from customer_scheduler import CustomerScheduler
+from tracing import Metrics, Tracer, start_metrics_server
+from message_debouncer import MessageDebouncer
+from text_extractor import TextExtractor
+from bubble_segmenter import BubbleSegmenter
+from conversation_store import ConversationStore
+from customer_identity import CustomerIdentityIndex, is_identified, unidentified_customer_id
+from reply_cache import ReplyCache
+from turn_journal import TurnJournal
+from reply_sender import DEFAULT_MAX_LENGTH, ReplySender
 
 # 设置pyautogui安全机制
 pyautogui.FAILSAFE = True  # 鼠标移到屏幕左上角会停止
 pyautogui.PAUSE = 0.5      # 每次操作间隔
 
-# 创建截图保存目录
-SCREENSHOTS_DIR = "screenshots"
-TEMPLATES_DIR = "templates"  # 存放模板图片的目录
+# 创建截图保存目录（多店铺运行时由supervisor通过环境变量给每个店铺指定单独的目录）
+SCREENSHOTS_DIR = os.environ.get("QIANNIU_SCREENSHOTS_DIR", "screenshots")
+TEMPLATES_DIR = os.environ.get("QIANNIU_TEMPLATES_DIR", "templates")  # 存放模板图片的目录
 if not os.path.exists(SCREENSHOTS_DIR):
     os.makedirs(SCREENSHOTS_DIR)
 if not os.path.exists(TEMPLATES_DIR):
@@ -24,8 +40,9 @@ if not os.path.exists(TEMPLATES_DIR):
 
 # 加载配置
 def load_config():
+    config_path = os.environ.get("QIANNIU_CONFIG", "config.json")
     try:
-        with open('config.json', 'r', encoding='utf-8') as f:
+        with open(config_path, 'r', encoding='utf-8') as f:
             return json.load(f)
     except Exception as e:
         print(f"加载配置文件失败: {str(e)}")
@@ -35,50 +52,218 @@ CONFIG = load_config()
 if not CONFIG:
     raise Exception("无法加载配置文件，请确保config.json文件存在且格式正确")
 
-# 从配置文件获取参数
-DIFY_VISION_API_URL = CONFIG['dify']['vision_api_url']
-DIFY_CHAT_API_URL = CONFIG['dify']['chat_api_url']
-DIFY_API_KEY = CONFIG['dify']['api_key']
-DIFY_VISION_API_KEY = CONFIG['dify']['vision_api_key']
-DIFY_FILE_UPLOAD_URL = CONFIG['dify']['file_upload_url']
+# 所有Dify接口共享同一个客户端（连接池、超时、重试）
+DIFY_CLIENT = create_dify_client(CONFIG['dify'])
+# Dify熔断期间不再请求，直接转人工并发送这句话
+DEGRADED_REPLY = CONFIG['dify'].get('circuit_breaker', {}).get('fallback_reply', "抱歉，系统暂时无法回答您的问题。")
+# 请求没有发出的异常（熔断、预算用完、本地限流），不计入Dify错误，由上层决定转人工还是稍后重新处理
+DIFY_REJECTED_ERRORS = (CircuitOpenError, BudgetExceededError, RateLimitedError)
+# 本地限流时最多重新处理的次数
+MAX_THROTTLED_RETRIES = 3
 
-# API请求头
-DIFY_HEADERS = {
-    "Authorization": f"Bearer {DIFY_API_KEY}",
-    "Content-Type": "application/json"
-}
+# 耗时追踪与指标：每轮处理一个trace ID，各阶段耗时写入直方图，可导出JSON-lines日志和 /metrics 端点
+TRACING_CONFIG = CONFIG.get('tracing', {})
+METRICS = Metrics()
+TRACER = Tracer(METRICS, log_path=TRACING_CONFIG.get('log_path') if TRACING_CONFIG.get('enabled', False) else None)
 
-DIFY_VISION_HEADERS = {
-    "Authorization": f"Bearer {DIFY_VISION_API_KEY}",
-    "Content-Type": "application/json"
-}
+# 截图方式：file 先保存PNG再上传；memory 在内存中编码后直接上传，可选在后台留档
+SCREENSHOT_CONFIG = CONFIG.get('screenshot', {})
+SCREENSHOT_IN_MEMORY = SCREENSHOT_CONFIG.get('mode', 'file') == 'memory'
 
-def find_image_on_screen(template_path, confidence=0.8):
+# 截图留档的保留策略：保存时登记到索引，后台线程分批删除过期截图、控制总大小，可按天打包归档
+RETENTION_CONFIG = CONFIG.get('screenshot_retention', {})
+RETENTION = None
+if RETENTION_CONFIG.get('enabled', CONFIG['settings'].get('cleanup_screenshots', False)):
+    RETENTION = ScreenshotRetention(
+        SCREENSHOTS_DIR,
+        max_age_days=RETENTION_CONFIG.get('max_age_days', CONFIG['settings'].get('cleanup_after_days', 7)),
+        max_total_mb=RETENTION_CONFIG.get('max_total_mb', 0),
+        archive_after_days=RETENTION_CONFIG.get('archive_after_days', 0),
+        batch_size=RETENTION_CONFIG.get('batch_size', 200),
+        interval_seconds=RETENTION_CONFIG.get('interval_seconds', 300)
+    )
+
+ARCHIVER = None
+if SCREENSHOT_IN_MEMORY and SCREENSHOT_CONFIG.get('archive', True):
+    ARCHIVER = ScreenshotArchiver(on_saved=RETENTION.record if RETENTION else None)
+
+# 每个客户上一次聊天截图的行哈希，用于只识别新增的聊天内容
+FRAME_DIFF = FrameDiffCache() if CONFIG['settings'].get('incremental_screenshots', False) else None
+
+# 客户 -> Dify会话ID，后续轮次继续同一个会话
+CONVERSATION_CONFIG = CONFIG.get('conversations', {})
+CONVERSATIONS = None
+if CONVERSATION_CONFIG.get('enabled', False):
+    CONVERSATIONS = ConversationStore(
+        db_path=CONVERSATION_CONFIG.get('db_path', 'conversations.db'),
+        ttl_seconds=CONVERSATION_CONFIG.get('ttl_seconds', 86400),
+        max_entries=CONVERSATION_CONFIG.get('max_entries', 5000)
+    )
+
+# 客户处理日志：记录每轮处理到了哪个阶段，进程重启后从最后完成的阶段继续，不漏回也不重复回复
+JOURNAL_CONFIG = CONFIG.get('turn_journal', {})
+JOURNAL = None
+if JOURNAL_CONFIG.get('enabled', False):
+    JOURNAL = TurnJournal(
+        db_path=JOURNAL_CONFIG.get('db_path', 'turns.db'),
+        resume_seconds=JOURNAL_CONFIG.get('resume_seconds', 600),
+        retention_days=JOURNAL_CONFIG.get('retention_days', 7)
+    )
+
+# 常见问题回复缓存：允许列表中的问题（及其近似问法）直接使用缓存的回复
+REPLY_CACHE_CONFIG = CONFIG.get('reply_cache', {})
+REPLY_CACHE = None
+if REPLY_CACHE_CONFIG.get('enabled', False):
+    REPLY_CACHE = ReplyCache(
+        db_path=REPLY_CACHE_CONFIG.get('db_path', 'reply_cache.db'),
+        allow_list_path=REPLY_CACHE_CONFIG.get('allow_list_path', 'faq_allow_list.json'),
+        max_entries=REPLY_CACHE_CONFIG.get('max_entries', 1000),
+        ttl_seconds=REPLY_CACHE_CONFIG.get('ttl_seconds', 86400),
+        min_similarity=REPLY_CACHE_CONFIG.get('min_similarity', 0.8),
+        ngram=REPLY_CACHE_CONFIG.get('ngram', 2)
+    )
+
+# 聊天气泡分割：只识别最后一条我方回复之后的客户消息
+BUBBLE_CONFIG = CONFIG.get('bubble_segmentation', {})
+BUBBLE_SEGMENTER = None
+if BUBBLE_CONFIG.get('enabled', False):
+    BUBBLE_SEGMENTER = BubbleSegmenter(
+        own_color=BUBBLE_CONFIG.get('own_color'),
+        color_tolerance=BUBBLE_CONFIG.get('color_tolerance', 24),
+        background_tolerance=BUBBLE_CONFIG.get('background_tolerance', 4),
+        min_width=BUBBLE_CONFIG.get('min_width', 24),
+        min_height=BUBBLE_CONFIG.get('min_height', 16),
+        merge_gap=BUBBLE_CONFIG.get('merge_gap', 8),
+        side_split=BUBBLE_CONFIG.get('side_split', 0.5),
+        padding=BUBBLE_CONFIG.get('padding', 4)
+    )
+
+# 视觉识别结果缓存：相同或几乎相同的截图直接复用上次提取的文本
+VISION_CACHE_CONFIG = CONFIG.get('vision_cache', {})
+VISION_CACHE = None
+if VISION_CACHE_CONFIG.get('enabled', False):
+    VISION_CACHE = VisionCache(
+        db_path=VISION_CACHE_CONFIG.get('db_path', 'vision_cache.db'),
+        max_entries=VISION_CACHE_CONFIG.get('max_entries', 2000),
+        ttl_seconds=VISION_CACHE_CONFIG.get('ttl_seconds', 86400),
+        max_distance=VISION_CACHE_CONFIG.get('max_distance', 4),
+        hash_size=VISION_CACHE_CONFIG.get('hash_size', 32),
+        max_profile_diff=VISION_CACHE_CONFIG.get('max_profile_diff', 0)
+    )
+
+# 本地OCR快速通道：置信度足够时直接使用本地识别结果，不再上传截图调用视觉工作流
+OCR_CONFIG = CONFIG.get('local_ocr', {})
+TEXT_EXTRACTOR = None
+if OCR_CONFIG.get('enabled', False):
+    try:
+        TEXT_EXTRACTOR = TextExtractor(
+            backend=OCR_CONFIG.get('backend', 'rapidocr'),
+            min_confidence=OCR_CONFIG.get('min_confidence', 0.85),
+            min_chars=OCR_CONFIG.get('min_chars', 1),
+            backend_options=OCR_CONFIG.get('backend_options')
+        )
+    except ImportError as e:
+        print(f"本地OCR后端不可用，将全部使用Dify视觉识别: {str(e)}")
+
+# 客户身份：按昵称（OCR）和头像给客户分配跨轮次、跨重启不变的ID
+IDENTITY_CONFIG = CONFIG.get('customer_identity', {})
+IDENTITY = None
+NICKNAME_OCR = None
+if IDENTITY_CONFIG.get('enabled', False):
+    IDENTITY = CustomerIdentityIndex(
+        db_path=IDENTITY_CONFIG.get('db_path', 'customers.db'),
+        min_name_similarity=IDENTITY_CONFIG.get('min_name_similarity', 0.85),
+        max_avatar_distance=IDENTITY_CONFIG.get('max_avatar_distance', 6)
+    )
+    # 昵称OCR优先复用本地OCR，未启用时单独创建
+    if IDENTITY_CONFIG.get('nickname_region'):
+        NICKNAME_OCR = TEXT_EXTRACTOR
+        if NICKNAME_OCR is None:
+            try:
+                NICKNAME_OCR = TextExtractor(
+                    backend=OCR_CONFIG.get('backend', 'rapidocr'),
+                    min_confidence=OCR_CONFIG.get('min_confidence', 0.85),
+                    backend_options=OCR_CONFIG.get('backend_options')
+                )
+            except ImportError as e:
+                print(f"本地OCR后端不可用，无法识别昵称，客户将按未识别处理: {str(e)}")
+
+# 模板匹配引擎：启动时预载所有模板，同一次轮询中的多个模板共用一帧截图
+MATCHER_CONFIG = CONFIG.get('template_matcher', {})
+MATCHER = TemplateMatcher(
+    TEMPLATES_DIR,
+    pyautogui.screenshot,
+    scales=MATCHER_CONFIG.get('scales', [1.0]),
+    roi_padding=MATCHER_CONFIG.get('roi_padding', 80)
+)
+
+# 回复发送引擎：缓存输入框和发送按钮坐标，按输入框变化确认粘贴和发送，超长回复分段
+SENDER_CONFIG = CONFIG.get('reply_sender', {})
+SENDER = None
+if SENDER_CONFIG.get('enabled', False):
+    SENDER = ReplySender(
+        pyautogui,
+        pyperclip.copy,
+        lambda name: find_image_on_screen(f"{TEMPLATES_DIR}/{name}"),
+        max_length=SENDER_CONFIG.get('max_length', DEFAULT_MAX_LENGTH),
+        input_region=SENDER_CONFIG.get('input_region'),
+        settle_timeout=SENDER_CONFIG.get('settle_timeout', 0.3),
+        paste_timeout=SENDER_CONFIG.get('paste_timeout', 1.0),
+        send_timeout=SENDER_CONFIG.get('send_timeout', 2.0),
+        max_attempts=SENDER_CONFIG.get('max_attempts', 3),
+        retry_backoff=SENDER_CONFIG.get('retry_backoff', 0.2),
+        use_send_button=SENDER_CONFIG.get('use_send_button', True)
+    )
+
+# 等待客户调度：发送已生成的回复时待转人工的客户优先，其余按打开的先后，并统计等待时间
+SCHEDULER = CustomerScheduler()
+METRICS.gauge("waiting_customers", SCHEDULER.queue_depth)
+
+# 开启Dify限流和预算时导出当天用量
+if hasattr(DIFY_CLIENT, 'usage'):
+    METRICS.gauge("dify_tokens_today", lambda: DIFY_CLIENT.usage()["tokens"])
+    METRICS.gauge("dify_cost_today", lambda: DIFY_CLIENT.usage()["cost"])
+
+# 客户消息防抖：等聊天区域安静下来再处理，连发的多条消息合并为一轮
+DEBOUNCE_CONFIG = CONFIG.get('message_debounce', {})
+DEBOUNCER = None
+if DEBOUNCE_CONFIG.get('enabled', False):
+    DEBOUNCER = MessageDebouncer(
+        pyautogui.screenshot,
+        quiet_seconds=DEBOUNCE_CONFIG.get('quiet_seconds', 1.5),
+        max_wait=DEBOUNCE_CONFIG.get('max_wait', 6),
+        poll_interval=DEBOUNCE_CONFIG.get('poll_interval', 0.3)
+    )
+
+# 通知区域变化检测：区域没有变化时跳过模板匹配，轮询间隔随活跃程度自适应
+CHANGE_CONFIG = CONFIG.get('change_detection', {})
+CHANGE_DETECTOR = None
+if CHANGE_CONFIG.get('enabled', False):
+    CHANGE_DETECTOR = ChangeDetector(
+        pyautogui.screenshot,
+        region=CHANGE_CONFIG.get('region'),
+        hash_size=CHANGE_CONFIG.get('hash_size', 32),
+        pixel_delta=CHANGE_CONFIG.get('pixel_delta', 3),
+        threshold=CHANGE_CONFIG.get('threshold', 0),
+        min_interval=CHANGE_CONFIG.get('min_interval', 0.2),
+        max_interval=CHANGE_CONFIG.get('max_interval', CONFIG['settings']['check_interval']),
+        backoff=CHANGE_CONFIG.get('backoff', 1.5),
+        force_check_seconds=CHANGE_CONFIG.get('force_check_seconds', 30)
+    )
+
+def find_image_on_screen(template_path, confidence=0.8, frame=None):
     """
     在屏幕上查找模板图片
+    frame: 本次轮询已截取的灰度屏幕帧，为空时重新截屏
     返回: (x, y, width, height) 或 None
     """
     try:
-        # 截取屏幕
-        screenshot = pyautogui.screenshot()
-        screenshot_np = np.array(screenshot)
-        screenshot_gray = cv2.cvtColor(screenshot_np, cv2.COLOR_RGB2GRAY)
-        
-        # 读取模板图片
-        template = cv2.imread(template_path, 0)
-        if template is None:
-            print(f"无法读取模板图片: {template_path}")
-            return None
-            
-        # 模板匹配
-        result = cv2.matchTemplate(screenshot_gray, template, cv2.TM_CCOEFF_NORMED)
-        locations = np.where(result >= confidence)
-        
-        if len(locations[0]) > 0:
-            # 返回第一个匹配位置
-            y, x = locations[0][0], locations[1][0]
-            h, w = template.shape
+        template_name = os.path.basename(template_path)
+        location = MATCHER.find(template_name, confidence, frame)
+        if location:
+            x, y, w, h, _ = location
             return (x, y, w, h)
+        METRICS.inc("template_misses_total", template=template_name)
         return None
     except Exception as e:
         print(f"图像识别失败: {str(e)}")
@@ -87,6 +272,7 @@ def find_image_on_screen(template_path, confidence=0.8):
 def click_image(template_path, confidence=0.8, timeout=10):
     """
     查找并点击图片
+    返回: 点击位置 (x, y)，未找到时返回False
     """
     start_time = time.time()
     while time.time() - start_time < timeout:
@@ -98,7 +284,7 @@ def click_image(template_path, confidence=0.8, timeout=10):
             center_y = y + h // 2
             pyautogui.click(center_x, center_y)
             print(f"点击了图片 {template_path} 在位置 ({center_x}, {center_y})")
-            return True
+            return center_x, center_y
         time.sleep(0.5)
     
     print(f"未找到图片: {template_path}")
@@ -107,162 +293,259 @@ def click_image(template_path, confidence=0.8, timeout=10):
 def capture_screen_area(x, y, width, height, filename):
     """
     截取屏幕指定区域
+    内存模式下不写文件（需要留档时交给后台线程），文件模式下同步保存
+    返回: 截图（PIL图片）
     """
     try:
         screenshot = pyautogui.screenshot(region=(x, y, width, height))
-        screenshot.save(filename)
-        print(f"已保存截图: {filename}")
-        return filename
+        if SCREENSHOT_IN_MEMORY:
+            if ARCHIVER:
+                ARCHIVER.archive(screenshot, filename)
+        else:
+            screenshot.save(filename)
+            print(f"已保存截图: {filename}")
+            if RETENTION:
+                RETENTION.record(filename)
+        return screenshot
     except Exception as e:
         print(f"截图失败: {str(e)}")
         return None
 
-def capture_chat_screenshot(customer_id):
+def chat_area_region():
     """
-    截取聊天区域并保存为图片
+    聊天区域的屏幕坐标 (x, y, width, height)
     这里需要根据千牛界面调整坐标
     """
+    # 先查找聊天窗口区域（需要预先保存聊天窗口的模板图片）
+    chat_area = find_image_on_screen(f"{TEMPLATES_DIR}/chat_window.png")
+    if chat_area:
+        x, y, w, h = chat_area
+        # 扩大截图区域以包含更多聊天内容
+        return max(0, x - 50), max(0, y - 50), w + 100, h + 200
+    # 如果找不到聊天窗口，使用固定坐标（需要根据实际情况调整）
+    return 400, 200, 800, 600
+
+@TRACER.traced("capture")
+def capture_chat_screenshot(customer_id):
+    """
+    截取聊天区域
+    返回: 截图（PIL图片），失败时返回None
+    """
     if not CONFIG['settings'].get('use_screenshot', True):
         return None
         
     try:
-        # 先查找聊天窗口区域（需要预先保存聊天窗口的模板图片）
-        chat_area = find_image_on_screen(f"{TEMPLATES_DIR}/chat_window.png")
-        if chat_area:
-            x, y, w, h = chat_area
-            # 扩大截图区域以包含更多聊天内容
-            expanded_x = max(0, x - 50)
-            expanded_y = max(0, y - 50)
-            expanded_w = w + 100
-            expanded_h = h + 200
-            
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"{SCREENSHOTS_DIR}/{customer_id}_{timestamp}.png"
-            
-            return capture_screen_area(expanded_x, expanded_y, expanded_w, expanded_h, filename)
-        else:
-            # 如果找不到聊天窗口，使用固定坐标（需要根据实际情况调整）
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"{SCREENSHOTS_DIR}/{customer_id}_{timestamp}.png"
-            # 这里的坐标需要根据千牛界面实际情况调整
-            return capture_screen_area(400, 200, 800, 600, filename)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"{SCREENSHOTS_DIR}/{customer_id}_{timestamp}.png"
+        return capture_screen_area(*chat_area_region(), filename)
     except Exception as e:
         print(f"截图失败: {str(e)}")
         return None
 
-def upload_file_to_dify(file_path, customer_id):
-    """上传文件到Dify，获取文件ID"""
-    if not file_path or not os.path.exists(file_path):
+@TRACER.traced("debounce")
+def wait_for_quiet_chat(customer_id):
+    """客户连续发送多条消息时，等聊天区域安静下来再截图，合并为一轮识别和对话"""
+    if not DEBOUNCER:
+        return
+    try:
+        waited, changes = DEBOUNCER.wait(chat_area_region())
+        if changes:
+            print(f"客户 {customer_id} 连续发送了消息，等待 {waited:.1f}秒后合并处理")
+    except Exception as e:
+        print(f"等待客户消息稳定失败: {str(e)}")
+
+@TRACER.traced("extract")
+def extract_new_content(customer_id, image):
+    """
+    与该客户上一次的截图比较，只保留新增的聊天内容，再按聊天气泡只保留尚未回复的客户消息
+    返回: 需要识别的截图；内容没有变化或没有待回复的客户消息时返回None
+    """
+    if image is None:
+        return None
+    
+    if FRAME_DIFF:
+        try:
+            new_content = FRAME_DIFF.new_content(customer_id, image)
+            if new_content is None:
+                print(f"客户 {customer_id} 的聊天内容没有变化，跳过图像识别")
+                return None
+            if new_content is not image:
+                print(f"已裁剪新增聊天内容，高度 {new_content.height}/{image.height}")
+            image = new_content
+        except Exception as e:
+            print(f"截图增量比较失败: {str(e)}")
+    
+    if BUBBLE_SEGMENTER:
+        try:
+            pending = BUBBLE_SEGMENTER.crop_unanswered(image)
+            if pending is None:
+                print(f"客户 {customer_id} 的最后一条消息是我方回复，跳过图像识别")
+                return None
+            if pending is not image:
+                print(f"已裁剪待回复的客户消息，尺寸 {pending.width}x{pending.height}")
+            image = pending
+        except Exception as e:
+            print(f"聊天气泡分割失败: {str(e)}")
+    
+    return image
+
+@TRACER.traced("upload")
+def upload_file_to_dify(image, customer_id):
+    """
+    把截图编码后上传到Dify，获取文件ID
+    返回: 上传文件的ID
+    """
+    if image is None:
         return None
     
     try:
-        headers = {
-            "Authorization": f"Bearer {DIFY_VISION_API_KEY}"
-        }
+        # 在内存中按配置编码（格式、压缩级别、缩放、灰度），不经过磁盘
+        content, extension, mime_type = encode_image(image, SCREENSHOT_CONFIG)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        file_name = f"{customer_id}_{timestamp}.{extension}"
         
-        with open(file_path, 'rb') as file_object:
-            files = {
-                'file': (os.path.basename(file_path), file_object, 'image/png')
-            }
-            
-            data = {
-                'user': customer_id
-            }
-            
-            response = requests.post(
-                DIFY_FILE_UPLOAD_URL, 
-                headers=headers,
-                files=files,
-                data=data
-            )
+        result = DIFY_CLIENT.upload_file(file_name, content, customer_id, mime_type)
         
-        response.raise_for_status()
-        result = response.json()
         file_id = result.get('id')
         
         if file_id:
-            print(f"文件上传成功，ID: {file_id}")
+            print(f"文件上传成功，ID: {file_id}，大小: {len(content) // 1024}KB")
             return file_id
         else:
             print("上传文件失败：未返回文件ID")
             return None
             
+    except DIFY_REJECTED_ERRORS:
+        raise
     except Exception as e:
         print(f"上传文件失败: {str(e)}")
+        METRICS.inc("dify_errors_total", endpoint="upload")
         return None
 
-def analyze_image_with_dify(image_path, customer_id):
+@TRACER.traced("ocr")
+def extract_text_locally(image):
+    """
+    用本地OCR识别截图
+    返回: 置信度足够时返回识别的文本，否则返回None（由调用方回退到Dify视觉识别）
+    """
+    try:
+        start = time.time()
+        text, confidence = TEXT_EXTRACTOR.extract(image)
+        elapsed = time.time() - start
+        if TEXT_EXTRACTOR.is_reliable(text, confidence):
+            print(f"本地OCR识别成功（置信度 {confidence:.2f}，耗时 {elapsed:.2f}秒）: {text}")
+            return text
+        print(f"本地OCR置信度不足（{confidence:.2f}），改用Dify视觉识别")
+    except Exception as e:
+        print(f"本地OCR识别失败: {str(e)}")
+    return None
+
+@TRACER.traced("analyze")
+def analyze_image_with_dify(image, customer_id):
     """使用Dify视觉工作流分析图像内容"""
-    if not image_path or not os.path.exists(image_path):
+    if image is None:
         return None
         
     try:
-        file_id = upload_file_to_dify(image_path, customer_id)
+        # 先查识别缓存，命中时不需要上传和调用工作流
+        if VISION_CACHE:
+            cached_text = VISION_CACHE.get(image)
+            if cached_text is not None:
+                print(f"命中识别缓存，提取的文本: {cached_text}")
+                return cached_text
+        
+        # 本地OCR置信度足够时，一次网络请求（对话）就能完成本轮回复
+        if TEXT_EXTRACTOR:
+            local_text = extract_text_locally(image)
+            if local_text:
+                if VISION_CACHE:
+                    VISION_CACHE.put(image, local_text)
+                return local_text
+        
+        file_id = upload_file_to_dify(image, customer_id)
         if not file_id:
             print("无法获取文件ID，无法进行图像分析")
             return None
         
-        payload = {
-            "inputs": {
-                "input": {
-                    "transfer_method": "local_file",
-                    "upload_file_id": file_id,
-                    "type": "image"
-                }
-            },
-            "response_mode": "blocking",
-            "user": customer_id
+        inputs = {
+            "input": {
+                "transfer_method": "local_file",
+                "upload_file_id": file_id,
+                "type": "image"
+            }
         }
         
-        response = requests.post(
-            DIFY_VISION_API_URL,
-            json=payload,
-            headers=DIFY_VISION_HEADERS
-        )
-        response.raise_for_status()
-        
-        result = response.json()
+        with TRACER.span("vision"):
+            result = DIFY_CLIENT.run_workflow(inputs, customer_id)
         extracted_text = result.get("data", {}).get("outputs", "")
         print(f"从图片中提取的文本: {extracted_text}")
         
+        if VISION_CACHE and extracted_text:
+            VISION_CACHE.put(image, extracted_text)
+        
         return extracted_text
+    except DIFY_REJECTED_ERRORS:
+        raise
     except Exception as e:
         print(f"分析图片失败: {str(e)}")
+        METRICS.inc("dify_errors_total", endpoint="workflow")
         return None
 
-def chat_with_dify(customer_id, message):
+@TRACER.traced("chat")
+def chat_with_dify(customer_id, message, on_need_human=None):
     """使用Dify对话流处理消息并获取回复"""
     try:
-        payload = {
-            "inputs": {},
-            "query": message,
-            "user": customer_id,
-            "response_mode": "blocking"
-        }
+        # 带上该客户之前的conversation_id，Dify保存历史，本轮只需发送新消息
+        conversation_id = CONVERSATIONS.get(customer_id) if CONVERSATIONS else None
+        # 常见问题先查回复缓存，命中时不调用大模型；缓存的回复同样要检查转人工标记
+        # 已有会话历史时不使用缓存（由ReplyCache判断）
+        if REPLY_CACHE:
+            cached_reply = REPLY_CACHE.get(message, conversation_id)
+            if cached_reply is not None:
+                print(f"命中回复缓存: {cached_reply}")
+                return split_transfer_marker(cached_reply)
         
-        response = requests.post(DIFY_CHAT_API_URL, json=payload, headers=DIFY_HEADERS)
-        response.raise_for_status()
+        try:
+            result = DIFY_CLIENT.chat(message, customer_id, on_need_human=on_need_human,
+                                      conversation_id=conversation_id)
+        except Exception as e:
+            # 会话在Dify端已被删除或过期时返回404，改为开始新会话
+            if not conversation_id or http_status(e) != 404:
+                raise
+            print(f"客户 {customer_id} 的会话已失效，开始新会话")
+            CONVERSATIONS.forget(customer_id)
+            result = DIFY_CLIENT.chat(message, customer_id, on_need_human=on_need_human)
         
-        result = response.json()
+        if CONVERSATIONS and result.get("conversation_id") and is_identified(customer_id):
+            CONVERSATIONS.set(customer_id, result["conversation_id"])
+        # 需要转人工的回复不会被缓存
+        if REPLY_CACHE:
+            REPLY_CACHE.put(message, result.get("answer"), conversation_id)
         reply = result.get("answer", "")
         
         # 检查是否需要转人工
-        need_human = "需要转人工" in reply or "转人工" in reply
-        
-        if need_human:
-            reply = reply.replace("需要转人工", "").replace("转人工", "").strip()
+        reply, need_human = split_transfer_marker(reply)
         
         return reply, need_human
+    except RateLimitedError:
+        raise
+    except (CircuitOpenError, BudgetExceededError) as e:
+        print(f"{str(e)}，直接转人工")
+        METRICS.inc("dify_rejected_total", endpoint="chat")
+        return DEGRADED_REPLY, True
     except Exception as e:
         print(f"调用Dify对话API出错: {str(e)}")
+        METRICS.inc("dify_errors_total", endpoint="chat")
         return "抱歉，系统暂时无法回答您的问题。", True
 
+@TRACER.traced("transfer")
 def transfer_to_human():
     """转交给人工客服处理"""
     try:
         # 点击转人工按钮（需要预先保存转人工按钮的模板图片）
         if click_image(f"{TEMPLATES_DIR}/transfer_button.png"):
             print("已转交给人工客服")
+            METRICS.inc("transfers_total")
             return True
         else:
             print("未找到转人工按钮")
@@ -271,8 +554,26 @@ def transfer_to_human():
         print(f"转人工失败: {str(e)}")
         return False
 
+@TRACER.traced("send")
 def send_reply(message):
     """在聊天窗口发送回复"""
+    if SENDER:
+        try:
+            result = SENDER.send(message)
+        except pyautogui.FailSafeException:
+            raise
+        except Exception as e:
+            print(f"发送消息失败: {str(e)}")
+            return False
+        METRICS.observe("reply_send_seconds", result["seconds"])
+        if result["retries"]:
+            METRICS.inc("reply_send_retries_total", result["retries"])
+        if not result["ok"]:
+            print(f"发送回复失败（重试 {result['retries']} 次）")
+            return False
+        print(f"发送回复: {message}（{result['chunks']}段，{result['seconds'] * 1000:.0f}ms，重试 {result['retries']} 次）")
+        return True
+    
     try:
         # 找到并点击输入框
         if click_image(f"{TEMPLATES_DIR}/input_box.png"):
@@ -302,79 +603,434 @@ def send_reply(message):
         print(f"发送消息失败: {str(e)}")
         return False
 
-def has_new_customer():
+def has_new_customer(frame=None):
     """检查是否有新的待接待客户"""
     try:
         # 查找新消息通知图标
-        new_message_location = find_image_on_screen(f"{TEMPLATES_DIR}/new_message.png")
+        new_message_location = find_image_on_screen(f"{TEMPLATES_DIR}/new_message.png", frame=frame)
         if new_message_location:
-            # 生成临时客户ID
-            customer_id = f"customer_{int(time.time())}"
-            return True, customer_id
+            # 打开聊天窗口后才能按昵称/头像识别是哪个客户
+            return True, None
         return False, None
     except Exception as e:
         print(f"检查新客户失败: {str(e)}")
         return False, None
 
-def handle_customer(customer_id):
-    """处理单个客户的咨询"""
+@TRACER.traced("identify")
+def identify_current_customer(fallback_id):
+    """
+    聊天窗口打开后按昵称和头像识别客户
+    返回: 稳定的客户ID，无法识别时返回fallback_id
+    """
+    if not IDENTITY:
+        return fallback_id
+    
     try:
-        print(f"正在处理客户: {customer_id}")
+        nickname = None
+        nickname_region = IDENTITY_CONFIG.get('nickname_region')
+        if nickname_region and NICKNAME_OCR:
+            text, confidence = NICKNAME_OCR.extract(pyautogui.screenshot(region=tuple(nickname_region)))
+            if NICKNAME_OCR.is_reliable(text, confidence):
+                nickname = text.splitlines()[0]
         
-        # 点击新消息
-        if click_image(f"{TEMPLATES_DIR}/new_message.png"):
-            time.sleep(2)  # 等待聊天窗口加载
-            
-            # 截取聊天区域图片
-            image_path = capture_chat_screenshot(customer_id)
-            
-            if image_path:
-                # 分析图片内容
-                extracted_text = analyze_image_with_dify(image_path, customer_id)
-                
-                if not extracted_text:
-                    print("无法从图片中提取文本内容")
-                    return
-                
-                message = extracted_text
-                print(f"处理客户 {customer_id} 消息: {message}")
-                
-                # 生成回复
-                reply, need_human = chat_with_dify(customer_id, message)
-                
-                # 处理回复
-                if need_human:
-                    print(f"客户 {customer_id} 需要转人工")
-                    if reply.strip():
-                        send_reply(reply)
-                    transfer_to_human()
-                else:
-                    print(f"自动回复客户 {customer_id}: {reply}")
-                    send_reply(reply)
-                
-                # 关闭当前会话（如果有关闭按钮）
-                click_image(f"{TEMPLATES_DIR}/close_chat.png", timeout=2)
+        avatar = None
+        avatar_region = IDENTITY_CONFIG.get('avatar_region')
+        if avatar_region:
+            avatar = pyautogui.screenshot(region=tuple(avatar_region))
         
+        customer_id = IDENTITY.identify(nickname=nickname, avatar=avatar)
+        if customer_id:
+            print(f"识别到客户: {nickname} -> {customer_id}")
+            return customer_id
     except Exception as e:
-        print(f"处理客户 {customer_id} 失败: {str(e)}")
+        print(f"识别客户身份失败: {str(e)}")
+    return fallback_id
 
-def cleanup_old_screenshots():
-    """清理过期的截图文件"""
-    if not CONFIG['settings'].get('cleanup_screenshots', False):
-        return
+def open_customer_chat():
+    """点击新消息通知打开聊天窗口，返回点击位置"""
+    position = click_image(f"{TEMPLATES_DIR}/new_message.png")
+    if position:
+        time.sleep(2)  # 等待聊天窗口加载
+    return position
+
+@TRACER.traced("process")
+def process_customer_message(customer_id, image, text=None):
+    """
+    分析截图并生成回复，只做Dify调用，不操作界面，可以在工作线程中执行
+    text: 上次已经识别出的文本（对话被限流后重新处理），传入时不再重新识别截图
+    返回: (回复内容, 是否需要转人工)，无法提取文本时返回None
+    对话被本地限流时抛出RateLimitedError，其retry_args为带上已识别文本的参数，重新处理时只调用对话
+    """
+    if text is not None:
+        return answer_customer_message(customer_id, image, text)
     
-    days = CONFIG['settings'].get('cleanup_after_days', 7)
-    cutoff_date = datetime.now() - timedelta(days=days)
+    # 分析图片内容
+    try:
+        extracted_text = analyze_image_with_dify(image, customer_id)
+    except (CircuitOpenError, BudgetExceededError) as e:
+        # 视觉识别熔断或预算用完（本地OCR也没有识别出来）时不等待Dify，直接转人工
+        print(f"{str(e)}，直接转人工")
+        METRICS.inc("dify_rejected_total", endpoint="vision")
+        return DEGRADED_REPLY, True
     
+    if not extracted_text:
+        print("无法从图片中提取文本内容")
+        # 下次重新识别完整截图，避免这次的新内容被当作已处理
+        if FRAME_DIFF:
+            FRAME_DIFF.forget(customer_id)
+        return None
+    
+    message = extracted_text
+    print(f"处理客户 {customer_id} 消息: {message}")
+    if JOURNAL:
+        JOURNAL.advance(customer_id, "extracted", text=message)
+    
+    return answer_customer_message(customer_id, image, message)
+
+def answer_customer_message(customer_id, image, message):
+    """根据已识别的消息生成回复"""
     try:
-        screenshot_files = glob.glob(f"{SCREENSHOTS_DIR}/*.png")
-        for file in screenshot_files:
-            file_time = datetime.fromtimestamp(os.path.getctime(file))
-            if file_time < cutoff_date:
-                os.remove(file)
-                print(f"已清理过期截图: {file}")
+        reply, need_human = chat_with_dify(customer_id, message)
+    except RateLimitedError as e:
+        # 识别结果已经有了，稍后只重新调用对话
+        e.retry_args = (image, message)
+        raise
+    if JOURNAL:
+        JOURNAL.advance(customer_id, "answered", reply=reply, need_human=need_human)
+    return reply, need_human
+
+@TRACER.traced("deliver")
+def deliver_reply(customer_id, reply, need_human, close_chat=True):
+    """
+    发送回复、按需转人工并关闭会话（操作界面，只能在UI线程执行）
+    close_chat: 发送后是否关闭当前会话
+    返回: 本轮结果 replied / transferred / failed（回复没有发出或转人工失败）
+    """
+    # 进程重启前已经发出的回复不再发送
+    sent = JOURNAL is not None and JOURNAL.stage(customer_id) == "sent"
+    if need_human:
+        print(f"客户 {customer_id} 需要转人工")
+    elif not sent and not reply.strip():
+        # 空回复不发送（发送器对空内容也会返回成功），这一轮算作没有回复
+        print(f"客户 {customer_id} 的回复为空，不发送")
+    elif not sent:
+        print(f"自动回复客户 {customer_id}: {reply}")
+    if not sent and reply.strip():
+        sent = send_reply(reply)
+        if sent and JOURNAL:
+            JOURNAL.advance(customer_id, "sent")
+    transferred = need_human and transfer_to_human()
+    
+    # 关闭当前会话（如果有关闭按钮）
+    if close_chat:
+        click_image(f"{TEMPLATES_DIR}/close_chat.png", timeout=2)
+    if need_human:
+        return "transferred" if transferred else "failed"
+    return "replied" if sent else "failed"
+
+def finish_turn(customer_id, outcome):
+    """
+    一轮处理结束：记录等待时间和本轮耗时，并在处理日志中关闭该轮
+    outcome: replied / transferred / skipped（没有新消息）/ failed
+    """
+    if outcome in ("replied", "transferred"):
+        SCHEDULER.complete(customer_id)
+        if FRAME_DIFF:
+            FRAME_DIFF.commit(customer_id)
+    else:
+        # 没有发出回复的客户不计入等待统计
+        SCHEDULER.discard(customer_id)
+        # 下次截图仍与原来的基准比较，这次没有回复的消息会再次被识别
+        if FRAME_DIFF:
+            FRAME_DIFF.rollback(customer_id)
+    TRACER.end_turn(customer_id, outcome)
+    if JOURNAL:
+        JOURNAL.finish(customer_id, outcome)
+
+# 对话被本地限流、等待重新处理的客户 -> {retry_at, attempts, position, image, text}
+# UI线程不等待名额，到期后重新打开聊天窗口，用已识别的文本只重新调用对话
+DEFERRED = {}
+
+def defer_turn(customer_id, position, error, image=None, text=None, attempts=0):
+    """本地限流（排队超过上限）时这一轮保持未完成，retry_in秒后再处理，不转人工；多次被限流时放弃这一轮"""
+    image, text = getattr(error, "retry_args", None) or (image, text)
+    if attempts >= MAX_THROTTLED_RETRIES:
+        print(f"{str(error)}，客户 {customer_id} 多次被限流，放弃这一轮")
+        finish_turn(customer_id, "failed")
+        return
+    print(f"{str(error)}，{error.retry_in:.1f}秒后重新处理客户 {customer_id}")
+    METRICS.inc("dify_throttled_total")
+    DEFERRED[customer_id] = {"retry_at": time.time() + error.retry_in, "attempts": attempts + 1,
+                             "position": position, "image": image, "text": text}
+
+def retry_deferred_turns(pipeline=None):
+    """重新处理限流等待已到期的客户：重新打开聊天窗口，确认是同一个客户后继续这一轮（UI线程执行）"""
+    now = time.time()
+    for customer_id in [customer_id for customer_id, turn in DEFERRED.items() if turn["retry_at"] <= now]:
+        turn = DEFERRED.pop(customer_id)
+        try:
+            pyautogui.click(*turn["position"])
+            time.sleep(1)
+            if identify_current_customer(None) != customer_id:
+                print(f"无法重新打开客户 {customer_id} 的聊天窗口，放弃这一轮")
+                finish_turn(customer_id, "failed")
+            else:
+                result = process_customer_message(customer_id, turn["image"], text=turn["text"])
+                finish_turn(customer_id, deliver_reply(customer_id, *result) if result else "skipped")
+        except RateLimitedError as e:
+            defer_turn(customer_id, turn["position"], e, turn["image"], turn["text"], turn["attempts"])
+        except pyautogui.FailSafeException:
+            raise
+        except Exception as e:
+            print(f"处理客户 {customer_id} 失败: {str(e)}")
+            finish_turn(customer_id, "failed")
+        # 等待期间又发来消息的，接着处理
+        if customer_id not in DEFERRED and customer_id in FOLLOW_UPS:
+            start_follow_up(pipeline, customer_id)
+
+def resume_turn(customer_id, close_chat=True, position=None):
+    """
+    该客户有进程重启前未完成的一轮（已识别出文本或已生成回复）时，在已打开的聊天窗口中从最后完成的阶段继续：
+    不重新截图识别，已有回复的不再调用Dify，已发送的回复不再发送
+    close_chat: 恢复的回复发出后是否关闭会话（之后还要处理这次的新消息时为False）
+    position: 客户的点击位置，对话被限流时据此稍后重新打开
+    返回: 恢复的这一轮的结果（对话被限流时为deferred），没有需要恢复的时返回None
+    """
+    turn = JOURNAL.resumable(customer_id) if JOURNAL else None
+    if not turn:
+        return None
+    print(f"恢复客户 {customer_id} 上次未完成的处理（已完成: {turn['stage']}）")
+    if turn["stage"] == "extracted":
+        try:
+            reply, need_human = chat_with_dify(customer_id, turn["text"])
+        except RateLimitedError as e:
+            defer_turn(customer_id, position or turn["position"], e, text=turn["text"])
+            return "deferred"
+        JOURNAL.advance(customer_id, "answered", reply=reply, need_human=need_human)
+    else:
+        reply, need_human = turn["reply"], turn["need_human"]
+    outcome = deliver_reply(customer_id, reply, need_human, close_chat=close_chat)
+    finish_turn(customer_id, outcome)
+    return outcome
+
+def resume_before_capture(customer_id, detected_at, position=None):
+    """
+    客户发来新消息时先恢复重启前未完成的一轮，再开始这次新消息的一轮
+    返回: 是否继续截图处理新消息（恢复的一轮已转人工时由人工接管，不再自动回复；
+    恢复的一轮被限流时新消息等这一轮结束后再处理）
+    """
+    outcome = resume_turn(customer_id, close_chat=False, position=position)
+    if outcome is None:
+        return True
+    if outcome == "transferred":
+        return False
+    if outcome == "deferred":
+        FOLLOW_UPS.setdefault(customer_id, (position, detected_at))
+        return False
+    SCHEDULER.arrive(customer_id, arrived_at=detected_at)
+    TRACER.begin_turn(customer_id, started=detected_at)
+    return True
+
+def resume_unfinished_turns():
+    """
+    启动时按记录的位置重新打开上次未完成的客户，确认是同一个客户后继续处理；
+    无法确认的等该客户下次发来消息时再恢复（超过resume_seconds后放弃）
+    """
+    turns = JOURNAL.unfinished() if JOURNAL else []
+    if turns and not IDENTITY:
+        print(f"有 {len(turns)} 个客户的回复未完成，未开启客户识别（customer_identity）无法确认客户，跳过恢复")
+        return
+    for turn in turns:
+        customer_id = turn["customer_id"]
+        if not turn["position"]:
+            continue
+        try:
+            pyautogui.click(*turn["position"])
+            time.sleep(1)
+            if identify_current_customer(None) != customer_id:
+                print(f"客户 {customer_id} 已不在原来的位置，等其下次发来消息时再恢复")
+                continue
+            resume_turn(customer_id, position=turn["position"])
+        except pyautogui.FailSafeException:
+            raise
+        except Exception as e:
+            print(f"恢复客户 {customer_id} 失败: {str(e)}")
+
+def handle_customer(customer_id, position=None, detected_at=None):
+    """
+    处理单个客户的咨询
+    customer_id: 已知的客户ID，为None时打开聊天窗口后按昵称/头像识别，无法识别时这一轮作为未识别客户处理
+    position: 聊天窗口已经打开并识别过客户时传入点击位置，不再点击新消息
+    """
+    detected_at = detected_at or time.time()
+    try:
+        if position is None:
+            # 点击新消息
+            position = open_customer_chat()
+            if not position:
+                return
+            customer_id = identify_current_customer(customer_id) or unidentified_customer_id()
+            print(f"正在处理客户: {customer_id}")
+        if customer_id in DEFERRED:
+            # 上一轮在等待限流，结束后再截图处理新消息
+            FOLLOW_UPS.setdefault(customer_id, (position, detected_at))
+            return
+        
+        SCHEDULER.arrive(customer_id, arrived_at=detected_at)
+        TRACER.begin_turn(customer_id, started=detected_at)
+        if not resume_before_capture(customer_id, detected_at, position):
+            return
+        wait_for_quiet_chat(customer_id)
+        # 截取聊天区域图片
+        image = extract_new_content(customer_id, capture_chat_screenshot(customer_id))
+        if image is None:
+            finish_turn(customer_id, "skipped")
+            return
+        
+        # 未识别的客户重启后无法确认，不记录处理日志
+        if JOURNAL and is_identified(customer_id):
+            JOURNAL.begin(customer_id, position)
+        try:
+            result = process_customer_message(customer_id, image)
+        except RateLimitedError as e:
+            defer_turn(customer_id, position, e, image=image)
+            return
+        if not result:
+            finish_turn(customer_id, "skipped")
+            return
+        reply, need_human = result
+        finish_turn(customer_id, deliver_reply(customer_id, reply, need_human))
+        
     except Exception as e:
-        print(f"清理截图失败: {str(e)}")
+        print(f"处理客户 {customer_id} 失败: {str(e)}")
+        finish_turn(customer_id, "failed")
+
+# 流水线模式下记录客户在会话列表中的位置，回复生成后据此重新打开聊天窗口
+CUSTOMER_CHAT_POSITIONS = {}
+# 重新打开的聊天窗口与客户不一致时，最多重试投递的次数
+MAX_DELIVERY_ATTEMPTS = 3
+DELIVERY_ATTEMPTS = {}
+# 上一条消息还在工作线程中处理时又发来消息的客户 -> (位置, 检测时间)，上一轮结束后再截图处理
+FOLLOW_UPS = {}
+
+def submit_customer(pipeline, customer_id, position):
+    """在已打开的聊天窗口中截图，有需要回复的新消息时交给工作线程池，否则结束这一轮（UI线程执行）"""
+    wait_for_quiet_chat(customer_id)
+    image = extract_new_content(customer_id, capture_chat_screenshot(customer_id))
+    if image is None:
+        finish_turn(customer_id, "skipped")
+        return
+    if JOURNAL:
+        JOURNAL.begin(customer_id, position)
+    pipeline.submit(customer_id, image)
+    CUSTOMER_CHAT_POSITIONS[customer_id] = position
+
+def start_customer(pipeline, customer_id):
+    """打开客户聊天并截图，把Dify调用交给工作线程池（UI线程执行）"""
+    detected_at = time.time()
+    try:
+        position = open_customer_chat()
+        if not position:
+            return
+        identified_id = identify_current_customer(None)
+        if identified_id is None:
+            # 没有识别出客户，回复生成后无法确认重新打开的是同一个客户，直接在当前窗口中处理
+            handle_customer(customer_id or unidentified_customer_id(), position=position, detected_at=detected_at)
+            return
+        customer_id = identified_id
+        print(f"正在处理客户: {customer_id}")
+        if pipeline.is_pending(customer_id) or customer_id in DEFERRED:
+            # 现在截图的话，新消息会和正在回复的内容一起成为比较基准，等上一轮结束后再截图
+            print(f"客户 {customer_id} 的上一条消息还在处理，回复发出后再处理新消息")
+            FOLLOW_UPS.setdefault(customer_id, (position, detected_at))
+            return
+        SCHEDULER.arrive(customer_id, arrived_at=detected_at)
+        TRACER.begin_turn(customer_id, started=detected_at)
+        if resume_before_capture(customer_id, detected_at, position):
+            submit_customer(pipeline, customer_id, position)
+    except Exception as e:
+        print(f"处理客户 {customer_id} 失败: {str(e)}")
+        if not pipeline.is_pending(customer_id):
+            finish_turn(customer_id, "failed")
+
+def start_follow_up(pipeline, customer_id):
+    """
+    客户的上一轮已结束：重新打开聊天窗口，处理上一轮期间发来的消息（UI线程执行）
+    pipeline为None时在UI线程中直接处理
+    """
+    position, detected_at = FOLLOW_UPS.pop(customer_id)
+    try:
+        pyautogui.click(*position)
+        time.sleep(1)
+        if identify_current_customer(None) != customer_id:
+            print(f"无法重新打开客户 {customer_id} 的聊天窗口，新消息等客户下次发来时再处理")
+            return
+        if pipeline is None:
+            handle_customer(customer_id, position=position, detected_at=detected_at)
+            return
+        SCHEDULER.arrive(customer_id, arrived_at=detected_at)
+        TRACER.begin_turn(customer_id, started=detected_at)
+        submit_customer(pipeline, customer_id, position)
+    except pyautogui.FailSafeException:
+        raise
+    except Exception as e:
+        print(f"处理客户 {customer_id} 失败: {str(e)}")
+        if not (pipeline and pipeline.is_pending(customer_id)):
+            finish_turn(customer_id, "failed")
+
+def finish_customers(pipeline):
+    """把工作线程已生成的回复发送给对应客户（UI线程执行），最紧急的客户先发"""
+    results = pipeline.poll_results()
+    for customer_id, result in results.items():
+        if result and result[1]:
+            SCHEDULER.mark_transfer(customer_id)
+    
+    for customer_id in SCHEDULER.order(results):
+        result = results[customer_id]
+        position = CUSTOMER_CHAT_POSITIONS.get(customer_id)
+        if not result or not position:
+            CUSTOMER_CHAT_POSITIONS.pop(customer_id, None)
+            finish_turn(customer_id, "skipped")
+            continue
+        
+        try:
+            # 重新打开该客户的聊天窗口；记录的是当时新消息通知的位置，现在可能是别的客户，必须确认
+            pyautogui.click(*position)
+            time.sleep(1)
+            if identify_current_customer(None) != customer_id:
+                attempts = DELIVERY_ATTEMPTS.get(customer_id, 0) + 1
+                if attempts < MAX_DELIVERY_ATTEMPTS:
+                    DELIVERY_ATTEMPTS[customer_id] = attempts
+                    pipeline.requeue(customer_id, result)
+                else:
+                    print(f"无法重新打开客户 {customer_id} 的聊天窗口，放弃发送回复")
+                    DELIVERY_ATTEMPTS.pop(customer_id, None)
+                    CUSTOMER_CHAT_POSITIONS.pop(customer_id, None)
+                    finish_turn(customer_id, "failed")
+                continue
+            
+            reply, need_human = result
+            finish_turn(customer_id, deliver_reply(customer_id, reply, need_human))
+        except pyautogui.FailSafeException:
+            raise
+        except Exception as e:
+            print(f"发送客户 {customer_id} 回复失败: {str(e)}")
+            finish_turn(customer_id, "failed")
+        DELIVERY_ATTEMPTS.pop(customer_id, None)
+        CUSTOMER_CHAT_POSITIONS.pop(customer_id, None)
+    
+    # 上一轮已结束的客户，接着处理这期间发来的新消息
+    for customer_id in [customer_id for customer_id in FOLLOW_UPS
+                        if not pipeline.is_pending(customer_id) and customer_id not in DEFERRED]:
+        start_follow_up(pipeline, customer_id)
+
+def print_scheduler_stats():
+    """打印处理中的客户数量和等待时间分位数"""
+    stats = SCHEDULER.stats()
+    if stats["completed"] or stats["queue_depth"]:
+        print(f"处理中客户 {stats['queue_depth']} 个，最长已等待 {stats['oldest_wait']:.1f}秒；"
+              f"等待时间 p50 {stats['p50']:.1f}秒 p90 {stats['p90']:.1f}秒 p99 {stats['p99']:.1f}秒 "
+              f"最长 {stats['max']:.1f}秒")
 
 def setup_templates():
     """设置模板图片提示"""
@@ -406,6 +1062,17 @@ def setup_templates():
         return False
     return True
 
+def print_matcher_stats():
+    """打印每个模板的区域命中统计"""
+    for name, stats in MATCHER.stats().items():
+        print(f"模板 {name}: 区域命中 {stats['roi_hits']}，全屏命中 {stats['full_hits']}，"
+              f"未找到 {stats['misses']}，区域命中率 {stats['roi_hit_rate']:.0%}")
+    if CHANGE_DETECTOR:
+        print(f"变化检测: 完整检查 {CHANGE_DETECTOR.checks} 次，跳过 {CHANGE_DETECTOR.skipped} 次")
+    if SENDER:
+        stats = SENDER.stats()
+        print(f"回复发送: {stats['sends']} 次，重试 {stats['retries']} 次，失败 {stats['failures']} 次")
+
 def main():
     print("启动千牛智能AI客服机器人 (PyAutoGUI版本)...")
     
@@ -413,13 +1080,32 @@ def main():
     if not setup_templates():
         print("请先设置模板图片后再运行程序")
         return
-    
-    # 清理旧截图
-    cleanup_old_screenshots()
+    print(f"已载入 {MATCHER.load_all()} 个模板图片")
     
     check_interval = CONFIG['settings']['check_interval']
     error_retry_interval = CONFIG['settings']['error_retry_interval']
     
+    # 工作线程数大于1时启用流水线：UI线程只负责截图和发送，Dify调用并发执行
+    pipeline_workers = CONFIG['settings'].get('pipeline_workers', 1)
+    if pipeline_workers > 1 and not IDENTITY:
+        # 回复生成后要重新打开客户的聊天窗口，只有能识别客户才能确认打开的是同一个客户
+        print("并发处理流水线需要开启客户识别（customer_identity），改为逐个处理客户")
+        pipeline_workers = 1
+    pipeline = None
+    if pipeline_workers > 1:
+        pipeline = CustomerPipeline(process_customer_message, max_workers=pipeline_workers,
+                                    retry_on=(RateLimitedError,), max_retries=MAX_THROTTLED_RETRIES)
+        print(f"已启用并发处理流水线，工作线程数: {pipeline_workers}")
+    
+    # 本地 /metrics 端点，供Prometheus抓取各阶段耗时分位数和计数器
+    if TRACING_CONFIG.get('enabled', False) and TRACING_CONFIG.get('metrics_port'):
+        metrics_host = TRACING_CONFIG.get('metrics_host', '127.0.0.1')
+        start_metrics_server(METRICS, port=TRACING_CONFIG['metrics_port'], host=metrics_host)
+        print(f"指标端点: http://{metrics_host}:{TRACING_CONFIG['metrics_port']}/metrics")
+    
+    # 上次进程退出时还没有发出的回复
+    resume_unfinished_turns()
+    
     run_count = 0
     
     print("机器人已启动，开始监控新消息...")
@@ -427,22 +1113,47 @@ def main():
     
     while True:
         try:
-            # 检查新客户
-            has_new, customer_id = has_new_customer()
-            if has_new and customer_id:
-                print(f"检测到新客户: {customer_id}")
-                handle_customer(customer_id)
+            # 流水线模式下先发送已经生成好的回复
+            if pipeline:
+                finish_customers(pipeline)
+            # 限流等待已到期的客户
+            retry_deferred_turns(pipeline)
+            
+            # 通知区域有变化时才检查新客户（本次轮询只截一帧屏幕）
+            changed = CHANGE_DETECTOR is None or CHANGE_DETECTOR.changed()
+            if changed:
+                has_new, customer_id = has_new_customer(MATCHER.grab())
+                if has_new:
+                    print("检测到新客户消息")
+                    if pipeline:
+                        start_customer(pipeline, customer_id)
+                    else:
+                        handle_customer(customer_id)
+                    # 还有其他客户排队时通知可能保持不变，下次轮询重新完整检查
+                    if CHANGE_DETECTOR:
+                        CHANGE_DETECTOR.reset()
             
-            # 定期清理
+            # 主循环心跳，多店铺运行时supervisor据此判断进程是否卡住
+            METRICS.inc("loop_iterations_total")
+            
+            # 定期打印等待统计
             run_count += 1
             if run_count >= 10:
-                cleanup_old_screenshots()
+                print_scheduler_stats()
                 run_count = 0
             
-            time.sleep(check_interval)
+            # 流水线中有待发送的回复或有等待限流的客户时缩短等待
+            pending = (pipeline is not None and pipeline.pending_count() > 0) or bool(DEFERRED)
+            if CHANGE_DETECTOR:
+                time.sleep(CHANGE_DETECTOR.next_interval(changed or pending))
+            elif pending:
+                time.sleep(min(check_interval, 0.5))
+            else:
+                time.sleep(check_interval)
             
         except pyautogui.FailSafeException:
             print("检测到紧急停止信号，程序退出")
+            print_matcher_stats()
             break
         except Exception as e:
             print(f"运行时错误: {str(e)}")
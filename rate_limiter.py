@@ -0,0 +1,240 @@
+"""
+Dify请求限流和每日用量预算
+所有客户共用同一个对话密钥和视觉密钥，高峰时几个客户同时到达就会一起打到Dify，触发429后各自重试，延迟很难预测。
+这里按密钥+接口（每个接口只使用一个密钥）设置令牌桶：请求按到达顺序排队、匀速发出，而不是集中爆发；
+收到429时（内层客户端不再重试429）整个桶暂停Retry-After秒，所有客户一起退让，这次请求按限流处理；
+排队时间超过上限时请求不发出，调用方稍后重新处理该客户。
+同时按对话响应中的 metadata.usage（以及工作流响应中的 total_tokens）累计当天的token数和费用，
+超过每日预算后请求不再发出，调用方按熔断的方式降级（转人工）
+"""
+import os
+import json
+import time
+import threading
+from datetime import datetime
+
+from dify_client import http_status
+
+# 各接口默认速率：每秒请求数和允许的突发数量
+DEFAULT_RATES = {
+    "upload": {"rate": 2, "burst": 2},
+    "workflow": {"rate": 1, "burst": 2},
+    "chat": {"rate": 1, "burst": 2},
+}
+
+
+class RateLimitedError(Exception):
+    """排队等待时间超过上限或Dify返回429，请求没有被处理；调用方应在retry_in秒后重新处理，而不是转人工"""
+
+    def __init__(self, message, retry_in=1.0):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+class BudgetExceededError(Exception):
+    """当天的token或费用预算已用完，请求没有发出"""
+
+
+def retry_after(error):
+    """从requests或aiohttp的异常中取出Retry-After秒数，没有时返回None"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None)
+    try:
+        return float(headers.get("Retry-After")) if headers else None
+    except (TypeError, ValueError):
+        return None
+
+
+def usage_of(endpoint, result):
+    """
+    返回: (token数, 费用)
+    对话响应为 metadata.usage（total_tokens、total_price），工作流响应为 data.total_tokens
+    """
+    if not isinstance(result, dict):
+        return 0, 0.0
+    if endpoint == "chat":
+        usage = (result.get("metadata") or {}).get("usage") or {}
+        return int(usage.get("total_tokens") or 0), float(usage.get("total_price") or 0)
+    if endpoint == "workflow":
+        return int((result.get("data") or {}).get("total_tokens") or 0), 0.0
+    return 0, 0.0
+
+
+class TokenBucket:
+    """
+    令牌桶（按理论到达时间实现）：每个请求预约下一个发送时刻，先到先发，线程安全
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        rate: 每秒允许的请求数
+        burst: 空闲之后允许连续发出的请求数
+        """
+        self.interval = 1.0 / rate
+        self.tolerance = (max(1, burst) - 1) * self.interval
+        self._lock = threading.Lock()
+        # 下一个请求的理论发送时刻
+        self._tat = 0.0
+        self.waited = 0.0
+
+    def reserve(self, max_wait=None):
+        """
+        预约一个发送名额
+        返回: 需要等待的秒数；超过max_wait时返回None，且不占用名额
+        """
+        now = time.monotonic()
+        with self._lock:
+            tat = max(self._tat, now)
+            wait = max(0.0, tat - self.tolerance - now)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self._tat = tat + self.interval
+            self.waited += wait
+            return wait
+
+    def delay(self):
+        """返回: 现在预约需要等待的秒数（不占用名额）"""
+        now = time.monotonic()
+        with self._lock:
+            return max(0.0, max(self._tat, now) - self.tolerance - now)
+
+    def pause(self, seconds):
+        """服务端限流（429）后，接下来seconds秒内不再发出请求"""
+        with self._lock:
+            self._tat = max(self._tat, time.monotonic() + seconds + self.tolerance)
+
+
+class DailyBudget:
+    """按自然日累计Dify的token数和费用，线程安全，可保存到文件以免重启后清零"""
+
+    def __init__(self, token_budget=0, cost_budget=0, state_path=None, warn_ratio=0.8):
+        """
+        token_budget / cost_budget: 每日token数和费用上限，0表示不限制
+        warn_ratio: 用量达到预算的该比例时打印一次提醒
+        """
+        self.token_budget = token_budget
+        self.cost_budget = cost_budget
+        self.state_path = state_path
+        self.warn_ratio = warn_ratio
+
+        self._lock = threading.Lock()
+        self._state = self._new_state()
+        if state_path and os.path.exists(state_path):
+            try:
+                with open(state_path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+                if state.get("date") == self._state["date"]:
+                    self._state = state
+                    print(f"今日Dify用量: {state['tokens']} token，费用 {state['cost']:.4f}")
+            except (ValueError, KeyError, OSError) as e:
+                print(f"读取用量记录失败: {str(e)}")
+
+    @staticmethod
+    def _new_state():
+        return {"date": datetime.now().strftime("%Y-%m-%d"), "tokens": 0, "cost": 0.0, "calls": {}, "warned": False}
+
+    def _roll(self):
+        """跨天后重新计数（调用方持有锁）"""
+        if self._state["date"] != datetime.now().strftime("%Y-%m-%d"):
+            self._state = self._new_state()
+
+    def _ratio(self):
+        ratios = [0.0]
+        if self.token_budget:
+            ratios.append(self._state["tokens"] / self.token_budget)
+        if self.cost_budget:
+            ratios.append(self._state["cost"] / self.cost_budget)
+        return max(ratios)
+
+    def check(self):
+        """请求前调用；预算已用完时抛出BudgetExceededError"""
+        with self._lock:
+            self._roll()
+            if self._ratio() < 1:
+                return
+            tokens, cost = self._state["tokens"], self._state["cost"]
+        raise BudgetExceededError(f"今日Dify预算已用完（{tokens} token，费用 {cost:.4f}）")
+
+    def record(self, endpoint, tokens, cost):
+        """请求成功后调用，累计用量并保存"""
+        with self._lock:
+            self._roll()
+            self._state["tokens"] += tokens
+            self._state["cost"] += cost
+            self._state["calls"][endpoint] = self._state["calls"].get(endpoint, 0) + 1
+            if not self._state["warned"] and self._ratio() >= self.warn_ratio:
+                self._state["warned"] = True
+                print(f"今日Dify用量已达到预算的 {self._ratio():.0%}")
+            if self.state_path:
+                temp_path = self.state_path + ".tmp"
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    json.dump(self._state, f, ensure_ascii=False)
+                os.replace(temp_path, self.state_path)
+
+    def usage(self):
+        with self._lock:
+            self._roll()
+            return {"date": self._state["date"], "tokens": self._state["tokens"], "cost": self._state["cost"],
+                    "calls": dict(self._state["calls"])}
+
+
+class RateLimitedClient:
+    """在Dify客户端外面加上限流和每日预算，接口与DifyClient相同"""
+
+    def __init__(self, client, limit_config):
+        self.client = client
+        self.max_wait = limit_config.get("max_wait", 10)
+        self.buckets = {}
+        for endpoint, defaults in DEFAULT_RATES.items():
+            rate = dict(defaults, **limit_config.get("rates", {}).get(endpoint, {}))
+            self.buckets[endpoint] = TokenBucket(rate["rate"], rate["burst"])
+        self.budget = DailyBudget(
+            token_budget=limit_config.get("daily_token_budget", 0),
+            cost_budget=limit_config.get("daily_cost_budget", 0),
+            state_path=limit_config.get("state_path"),
+            warn_ratio=limit_config.get("warn_ratio", 0.8)
+        )
+
+    def _call(self, endpoint, func, *args, **kwargs):
+        self.budget.check()
+        bucket = self.buckets[endpoint]
+        wait = bucket.reserve(self.max_wait)
+        if wait is None:
+            # 等到排队时间回到上限以内再重新处理
+            retry_in = max(bucket.delay() - self.max_wait, bucket.interval)
+            raise RateLimitedError(f"Dify {endpoint} 排队超过 {self.max_wait}秒", retry_in=retry_in)
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if http_status(e) != 429:
+                raise
+            pause = retry_after(e) or bucket.interval
+            print(f"Dify {endpoint} 被限流，暂停 {pause:.1f}秒")
+            bucket.pause(pause)
+            raise RateLimitedError(f"Dify {endpoint} 返回429", retry_in=pause) from e
+        tokens, cost = usage_of(endpoint, result)
+        self.budget.record(endpoint, tokens, cost)
+        return result
+
+    def upload_file(self, file_name, content, user, mime_type='image/png'):
+        return self._call("upload", self.client.upload_file, file_name, content, user, mime_type)
+
+    def run_workflow(self, inputs, user):
+        return self._call("workflow", self.client.run_workflow, inputs, user)
+
+    def chat(self, query, user, inputs=None, on_need_human=None, conversation_id=None):
+        return self._call(
+            "chat", self.client.chat, query, user,
+            inputs=inputs, on_need_human=on_need_human, conversation_id=conversation_id
+        )
+
+    def usage(self):
+        """返回: 当天用量和各接口累计排队等待的秒数"""
+        usage = self.budget.usage()
+        usage["waited"] = {endpoint: bucket.waited for endpoint, bucket in self.buckets.items()}
+        return usage
+
+    def close(self):
+        self.client.close()
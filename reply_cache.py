@@ -0,0 +1,257 @@
+"""
+FAQ回复缓存
+发货时间、开发票、尺码表这类重复问题不必每次都调用大模型：问题文本规范化后先按精确哈希查找，
+再用字符n-gram的TF-IDF余弦相似度（NumPy本地计算）查找近似问题。
+只有管理员维护的允许列表中的问题（及其近似问法）才会被缓存，避免缓存与具体订单相关的回答；
+缓存的回复仍由调用方做转人工检查；需要转人工的回答不缓存，带会话上下文的问题不使用缓存。缓存按条目TTL过期、按LRU淘汰，并持久化到SQLite
+"""
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from dify_client import split_transfer_marker
+
+
+def normalize_query(text):
+    """全角转半角、转小写，去掉空白、标点和符号"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return "".join(char for char in text if unicodedata.category(char)[0] not in ("P", "S", "Z", "C"))
+
+
+def query_hash(normalized):
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+class NgramIndex:
+    """字符1~n-gram的TF-IDF向量索引（特征哈希到固定维度），按余弦相似度查找最相近的文本"""
+
+    def __init__(self, ngram=2, dimensions=2048):
+        self.ngram = ngram
+        self.dimensions = dimensions
+        self._keys = []
+        self._counts = []
+        self._matrix = None
+        self._idf = None
+
+    def _count(self, text):
+        counts = np.zeros(self.dimensions, dtype=np.float32)
+        # 同时使用1到n个字符的片段，短问题多一个字也不会让相似度下降太多
+        grams = [text[i:i + size] for size in range(1, self.ngram + 1) for i in range(len(text) - size + 1)]
+        for gram in grams:
+            counts[zlib.crc32(gram.encode("utf-8")) % self.dimensions] += 1
+        return counts
+
+    def rebuild(self, items):
+        """items: [(键, 规范化文本)]"""
+        self._keys = [key for key, _ in items]
+        self._counts = [self._count(text) for _, text in items]
+        self._matrix = None
+
+    def _build(self):
+        counts = np.vstack(self._counts)
+        document_frequency = (counts > 0).sum(axis=0)
+        self._idf = np.log((1 + len(counts)) / (1 + document_frequency)).astype(np.float32) + 1
+        matrix = counts * self._idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self._matrix = matrix / np.maximum(norms, 1e-9)
+
+    def nearest(self, text):
+        """
+        返回: (键, 余弦相似度)，索引为空时返回 (None, 0.0)
+        """
+        if not self._keys:
+            return None, 0.0
+        if self._matrix is None:
+            self._build()
+        vector = self._count(text) * self._idf
+        vector /= max(float(np.linalg.norm(vector)), 1e-9)
+        scores = self._matrix @ vector
+        index = int(scores.argmax())
+        return self._keys[index], float(scores[index])
+
+
+class ReplyCache:
+    """规范化问题 -> 回复 的缓存，线程安全"""
+
+    def __init__(self, db_path="reply_cache.db", allow_list_path="faq_allow_list.json",
+                 max_entries=1000, ttl_seconds=86400, min_similarity=0.8, ngram=2):
+        """
+        allow_list_path: 允许缓存的问题列表（JSON数组，元素为问题文本或 {"question": ..., "ttl_seconds": ...}），
+                         文件修改后自动重新载入；为空时所有问题都允许缓存
+        ttl_seconds: 默认的条目有效期，允许列表中的问题可以单独指定
+        min_similarity: 近似问题的余弦相似度下限
+        """
+        self.allow_list_path = allow_list_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.min_similarity = min_similarity
+
+        self._lock = threading.Lock()
+        # 问题哈希 -> (规范化问题, 回复, 写入时间, 有效期)，按最近使用顺序排列
+        self._entries = OrderedDict()
+        self._index = NgramIndex(ngram)
+        self._index_dirty = True
+
+        # 规范化的允许问题 -> 有效期
+        self._allowed = {}
+        self._allow_index = NgramIndex(ngram)
+        self._allow_list_mtime = None
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS reply_cache ("
+            "hash TEXT PRIMARY KEY, query TEXT NOT NULL, answer TEXT NOT NULL, "
+            "created_at REAL NOT NULL, ttl REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM reply_cache WHERE created_at + ttl < ?", (now,))
+            rows = self._conn.execute(
+                "SELECT hash, query, answer, created_at, ttl FROM reply_cache ORDER BY last_used"
+            ).fetchall()
+            self._conn.commit()
+            for key, query, answer, created_at, ttl in rows:
+                self._entries[key] = (query, answer, created_at, ttl)
+            self._evict_overflow()
+        if rows:
+            print(f"已载入 {len(self._entries)} 条回复缓存")
+
+    def _reload_allow_list(self):
+        """允许列表文件有变化时重新载入"""
+        if not self.allow_list_path:
+            return
+        try:
+            mtime = os.path.getmtime(self.allow_list_path)
+        except OSError:
+            mtime = None
+        if mtime == self._allow_list_mtime:
+            return
+        self._allow_list_mtime = mtime
+
+        allowed = {}
+        if mtime is not None:
+            try:
+                with open(self.allow_list_path, "r", encoding="utf-8") as f:
+                    for item in json.load(f):
+                        if isinstance(item, str):
+                            item = {"question": item}
+                        normalized = normalize_query(item["question"])
+                        if normalized:
+                            allowed[normalized] = item.get("ttl_seconds", self.ttl_seconds)
+            except Exception as e:
+                print(f"载入回复缓存允许列表失败: {str(e)}")
+                return
+        self._allowed = allowed
+        self._allow_index.rebuild([(question, question) for question in allowed])
+        print(f"回复缓存允许列表: {len(allowed)} 个问题")
+
+    def _similar(self, a, b):
+        """问题中的数字（天数、尺码、订单号）不同时不算近似问题"""
+        return re.findall(r"\d+", a) == re.findall(r"\d+", b)
+
+    def _allowed_ttl(self, normalized):
+        """
+        返回: 问题在允许列表中（或与其中某个问题近似）时的有效期，否则返回None
+        """
+        if not self.allow_list_path:
+            return self.ttl_seconds
+        if normalized in self._allowed:
+            return self._allowed[normalized]
+        question, score = self._allow_index.nearest(normalized)
+        if question is not None and score >= self.min_similarity and self._similar(question, normalized):
+            return self._allowed[question]
+        return None
+
+    def _evict_overflow(self):
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            self._conn.execute("DELETE FROM reply_cache WHERE hash = ?", (key,))
+            self._index_dirty = True
+        self._conn.commit()
+
+    def _delete(self, key):
+        del self._entries[key]
+        self._conn.execute("DELETE FROM reply_cache WHERE hash = ?", (key,))
+        self._conn.commit()
+        self._index_dirty = True
+
+    def _find(self, normalized):
+        key = query_hash(normalized)
+        if key in self._entries:
+            return key
+        if self._index_dirty:
+            self._index.rebuild([(key, entry[0]) for key, entry in self._entries.items()])
+            self._index_dirty = False
+        key, score = self._index.nearest(normalized)
+        if key is not None and score >= self.min_similarity and self._similar(self._entries[key][0], normalized):
+            return key
+        return None
+
+    def get(self, query, conversation_id=None):
+        """
+        conversation_id: 客户已有的Dify会话，有会话历史时同一句话可能是在接着上文问（"那发顺丰呢"），不使用缓存
+        返回: 缓存的原始回复（调用方仍需检查转人工标记），未命中时返回None
+        """
+        normalized = normalize_query(query)
+        if not normalized or conversation_id:
+            return None
+        now = time.time()
+        with self._lock:
+            self._reload_allow_list()
+            if self._allowed_ttl(normalized) is None:
+                return None
+            key = self._find(normalized)
+            if key is None:
+                return None
+
+            _, answer, created_at, ttl = self._entries[key]
+            if now - created_at > ttl:
+                self._delete(key)
+                return None
+
+            self._entries.move_to_end(key)
+            self._conn.execute("UPDATE reply_cache SET last_used = ? WHERE hash = ?", (now, key))
+            self._conn.commit()
+            return answer
+
+    def put(self, query, answer, conversation_id=None):
+        """
+        保存回复；问题不在允许列表中、带会话上下文时忽略
+        需要转人工的回答不缓存，否则之后问同样问题的客户都会被转人工
+        """
+        normalized = normalize_query(query)
+        if not normalized or not answer or conversation_id or split_transfer_marker(answer)[1]:
+            return
+        now = time.time()
+        with self._lock:
+            self._reload_allow_list()
+            ttl = self._allowed_ttl(normalized)
+            if ttl is None:
+                return
+            key = query_hash(normalized)
+            self._entries[key] = (normalized, answer, now, ttl)
+            self._entries.move_to_end(key)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO reply_cache (hash, query, answer, created_at, ttl, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, normalized, answer, now, ttl, now)
+            )
+            self._index_dirty = True
+            self._evict_overflow()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
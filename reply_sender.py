@@ -0,0 +1,209 @@
+"""
+回复发送引擎（PyAutoGUI版本）
+原来每次发送都要全屏查找输入框和发送按钮（找不到时每0.5秒重试，最多10秒），再加上固定的sleep和全局的 pyautogui.PAUSE，
+一条回复要占用几秒界面时间，而界面（鼠标键盘）只能由一个线程使用。
+这里缓存输入框和发送按钮的坐标，粘贴后截取输入框文字区域比较，一出现变化就发送，发送后确认输入框恢复为空。
+粘贴没有生效时消息肯定没有发出，丢弃缓存的坐标按有限次数退避重试；点击发送之后无法确认的不再重发（可能已经发出），
+整条回复按失败处理。超过千牛单条消息长度上限的回复分段发送
+"""
+import time
+
+import numpy as np
+from PIL import Image
+
+# 千牛单条消息的默认长度上限，两个版本的机器人都使用这个默认值
+DEFAULT_MAX_LENGTH = 500
+# 分段时优先断开的位置（换行、句末标点）
+SPLIT_AT = ("\n", "。", "！", "？", "；", "!", "?", ";")
+
+INPUT_BOX = "input_box.png"
+SEND_BUTTON = "send_button.png"
+
+# 一段的发送结果
+SENT = "sent"
+# 粘贴没有生效，消息没有发出，可以重试
+NOT_PASTED = "not_pasted"
+# 已点击发送但输入框没有清空，无法确定是否发出，不能重试
+UNCONFIRMED = "unconfirmed"
+
+
+def split_reply(text, max_length):
+    """
+    按单条消息长度上限分段，尽量在换行或句末标点处断开
+    max_length: 0表示不分段
+    """
+    text = text.strip()
+    if not max_length:
+        return [text] if text else []
+    chunks = []
+    while len(text) > max_length:
+        window = text[:max_length]
+        cut = max(window.rfind(separator) for separator in SPLIT_AT) + 1
+        # 标点太靠前时直接按长度截断，避免分出很短的一段
+        if cut < max_length // 2:
+            cut = max_length
+        chunk, text = text[:cut].strip(), text[cut:].strip()
+        if chunk:
+            chunks.append(chunk)
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class ReplySender:
+    """缓存控件坐标、按输入框变化确认粘贴和发送的回复发送器（只能在UI线程使用）"""
+
+    def __init__(self, gui, copy_func, locate_func, max_length=DEFAULT_MAX_LENGTH, input_region=None, settle_timeout=0.3,
+                 paste_timeout=1.0, send_timeout=2.0, poll_interval=0.05, max_attempts=3, retry_backoff=0.2,
+                 use_send_button=True, hash_size=(32, 8), pixel_delta=8, min_changed_cells=2):
+        """
+        gui: pyautogui模块（click / hotkey / press / screenshot）
+        copy_func: 写入剪贴板的函数
+        locate_func: 按模板名查找控件，返回 (x, y, width, height) 或 None（只查找一次，不等待）
+        max_length: 千牛单条消息的长度上限，超过时分段发送，0表示不分段
+        input_region: 输入框中显示文字的区域 (x, y, width, height)，为空时使用输入框模板的范围；
+                      只包含文字区域，不要包含聊天记录、工具栏，否则它们的变化会被当作输入框的变化
+        settle_timeout: 清空输入框后等待画面稳定的最长秒数，稳定后才记录空输入框的基准
+        paste_timeout / send_timeout: 等待粘贴内容出现、发送后输入框清空的最长秒数
+        max_attempts / retry_backoff: 粘贴没有生效时每段最多尝试的次数和重试等待的初始秒数（每次翻倍）
+        use_send_button: 点击发送按钮发送，找不到按钮或为false时按Enter
+        hash_size / pixel_delta / min_changed_cells: 区域比较的缩略图尺寸、灰度阈值和最少变化格数（过滤光标闪烁）
+        """
+        self.gui = gui
+        self.copy_func = copy_func
+        self.locate_func = locate_func
+        self.max_length = max_length
+        self.input_region = tuple(input_region) if input_region else None
+        self.settle_timeout = settle_timeout
+        self.paste_timeout = paste_timeout
+        self.send_timeout = send_timeout
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.use_send_button = use_send_button
+        self.hash_size = tuple(hash_size)
+        self.pixel_delta = pixel_delta
+        self.min_changed_cells = min_changed_cells
+
+        # 模板名 -> (x, y, width, height)
+        self._controls = {}
+        self.sends = 0
+        self.retries = 0
+        self.failures = 0
+
+    def _control(self, name):
+        box = self._controls.get(name)
+        if box is None:
+            box = self.locate_func(name)
+            if box:
+                self._controls[name] = box = tuple(box[:4])
+        return box
+
+    def forget(self, name):
+        """控件位置可能变了，下次重新查找"""
+        self._controls.pop(name, None)
+
+    @staticmethod
+    def _center(box):
+        x, y, w, h = box
+        return x + w // 2, y + h // 2
+
+    def _region(self, input_box):
+        return self.input_region or input_box
+
+    def _snapshot(self, region):
+        image = self.gui.screenshot(region=region).convert("L").resize(self.hash_size, Image.BOX)
+        return np.asarray(image, dtype=np.int16)
+
+    def _differs(self, a, b):
+        return int((np.abs(a - b) > self.pixel_delta).sum()) >= self.min_changed_cells
+
+    def _settled_snapshot(self, region):
+        """等区域连续两次截图一致（界面响应完清空操作）后返回截图，超时时返回最后一次"""
+        deadline = time.monotonic() + self.settle_timeout
+        snapshot = self._snapshot(region)
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            previous, snapshot = snapshot, self._snapshot(region)
+            if not self._differs(snapshot, previous):
+                break
+        return snapshot
+
+    def _wait_for(self, region, baseline, changed, timeout):
+        """等待区域相对baseline变化（changed=True）或恢复（changed=False），返回是否在超时前满足"""
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._differs(self._snapshot(region), baseline) == changed:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+
+    def _send_chunk(self, chunk):
+        """
+        发送一段：清空输入框 -> 等画面稳定 -> 粘贴 -> 确认内容出现 -> 发送 -> 确认输入框清空
+        返回: SENT / NOT_PASTED（还没有发送，可以重试）/ UNCONFIRMED（可能已经发出，不能重试）
+        """
+        input_box = self._control(INPUT_BOX)
+        if input_box is None:
+            print("未找到输入框")
+            return NOT_PASTED
+        region = self._region(input_box)
+
+        self.gui.click(*self._center(input_box), _pause=False)
+        self.gui.hotkey('ctrl', 'a', _pause=False)
+        self.gui.press('backspace', _pause=False)
+        empty = self._settled_snapshot(region)
+
+        # 使用剪贴板粘贴内容（支持中文）
+        self.copy_func(chunk)
+        self.gui.hotkey('ctrl', 'v', _pause=False)
+        if not self._wait_for(region, empty, True, self.paste_timeout):
+            print("粘贴后输入框没有变化")
+            self.forget(INPUT_BOX)
+            return NOT_PASTED
+
+        send_button = self._control(SEND_BUTTON) if self.use_send_button else None
+        if send_button:
+            self.gui.click(*self._center(send_button), _pause=False)
+        else:
+            self.gui.press('enter', _pause=False)
+        if self._wait_for(region, empty, False, self.send_timeout):
+            return SENT
+        # 界面响应慢时再看一次文字区域是否已经清空
+        if not self._differs(self._settled_snapshot(region), empty):
+            return SENT
+        print("发送后输入框没有清空，无法确认是否已发出，不再重发")
+        self.forget(SEND_BUTTON)
+        return UNCONFIRMED
+
+    def send(self, message):
+        """
+        发送一条回复（超长时分段）
+        返回: {"ok": 是否全部发出, "chunks": 段数, "retries": 重试次数, "seconds": 耗时}
+        """
+        start = time.monotonic()
+        chunks = split_reply(message, self.max_length)
+        retries = 0
+        # 没有内容的回复不算发出
+        ok = bool(chunks)
+        for chunk in chunks:
+            for attempt in range(self.max_attempts):
+                if attempt:
+                    retries += 1
+                    time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+                state = self._send_chunk(chunk)
+                if state != NOT_PASTED:
+                    break
+            if state != SENT:
+                ok = False
+                break
+
+        self.sends += 1
+        self.retries += retries
+        if not ok:
+            self.failures += 1
+        return {"ok": ok, "chunks": len(chunks), "retries": retries, "seconds": time.monotonic() - start}
+
+    def stats(self):
+        return {"sends": self.sends, "retries": self.retries, "failures": self.failures}
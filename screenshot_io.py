@@ -0,0 +1,92 @@
+"""
+截图编码与归档
+截图在内存中编码后直接上传，不再经过 保存PNG -> 重新读取 的磁盘往返；
+需要留档时由后台线程写入截图目录，不占用主循环时间
+"""
+import io
+import os
+import queue
+import threading
+
+from PIL import Image
+
+# 上传格式 -> (PIL格式名, 扩展名, MIME类型)
+IMAGE_FORMATS = {
+    "png": ("PNG", "png", "image/png"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+}
+
+
+def open_image(image_path):
+    """读取截图并立即载入内存，避免文件句柄一直占用"""
+    with Image.open(image_path) as image:
+        image.load()
+        return image.copy()
+
+
+def encode_image(image, options=None):
+    """
+    按配置把截图编码成上传用的字节
+    options: format(png/webp/jpeg)、png_compress_level、quality、max_width（0表示不缩放）、grayscale
+    返回: (字节内容, 扩展名, MIME类型)
+    """
+    options = options or {}
+    image_format = options.get("format", "png")
+    pil_format, extension, mime_type = IMAGE_FORMATS[image_format]
+
+    max_width = options.get("max_width", 0)
+    if max_width and image.width > max_width:
+        height = round(image.height * max_width / image.width)
+        image = image.resize((max_width, height), Image.LANCZOS)
+
+    if options.get("grayscale", False):
+        image = image.convert("L")
+    elif image.mode not in ("RGB", "L"):
+        # JPEG不支持透明通道，统一转成RGB
+        image = image.convert("RGB")
+
+    buffer = io.BytesIO()
+    if pil_format == "PNG":
+        # 压缩级别越低编码越快、体积越大，上行带宽充足时可以调到1
+        image.save(buffer, pil_format, compress_level=options.get("png_compress_level", 6))
+    else:
+        image.save(buffer, pil_format, quality=options.get("quality", 80))
+    return buffer.getvalue(), extension, mime_type
+
+
+class ScreenshotArchiver:
+    """后台线程把截图保存到磁盘留档，队列满时丢弃，不阻塞调用方"""
+
+    def __init__(self, max_pending=50, on_saved=None):
+        """on_saved: 截图写入磁盘后在后台线程中调用，参数为文件路径（用于登记到截图索引）"""
+        self.on_saved = on_saved
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name="screenshot-archiver", daemon=True)
+        self._thread.start()
+
+    def archive(self, image, filename):
+        """提交一张截图，返回是否成功加入队列"""
+        try:
+            self._queue.put_nowait((image, filename))
+            return True
+        except queue.Full:
+            print(f"截图留档队列已满，丢弃: {filename}")
+            return False
+
+    def _run(self):
+        while True:
+            image, filename = self._queue.get()
+            try:
+                os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+                image.save(filename)
+                if self.on_saved:
+                    self.on_saved(filename)
+            except Exception as e:
+                print(f"截图留档失败: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """等待队列中的截图全部写完"""
+        self._queue.join()
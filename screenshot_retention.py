@@ -0,0 +1,275 @@
+"""
+截图留档保留策略
+原来每10次轮询就在主循环里对整个截图目录做一次glob和getctime，截图积累到几万张后每次清理都会卡住轮询。
+这里改为：保存截图时往只追加的索引文件写一行（时间、客户、大小），后台线程按索引从最旧的开始分批删除
+超过保存天数或超出总大小配额的截图，可选把超过若干天的截图按天打包成zip归档。全程不扫描目录（只有第一次没有索引时扫描一次）
+"""
+import os
+import json
+import time
+import zipfile
+import threading
+from collections import deque
+from datetime import datetime
+
+INDEX_NAME = "index.jsonl"
+ARCHIVE_DIR_NAME = "archive"
+SCREENSHOT_EXTENSIONS = (".png", ".webp", ".jpg")
+
+
+def customer_of(filename):
+    """截图文件名为 客户ID_日期_时间.扩展名，取出客户ID"""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    parts = stem.rsplit("_", 2)
+    return parts[0] if len(parts) == 3 else None
+
+
+class ScreenshotRetention:
+    """截图目录的索引和后台清理，线程安全"""
+
+    def __init__(self, directory, max_age_days=7, max_total_mb=0, archive_after_days=0,
+                 batch_size=200, batch_pause=0.05, interval_seconds=300):
+        """
+        max_age_days: 截图（包括归档）保存的天数
+        max_total_mb: 截图和归档的总大小上限，超出时从最旧的开始删除，0表示不限制
+        archive_after_days: 超过该天数的截图按天打包到 archive/日期.zip，0表示不归档
+        batch_size / batch_pause: 每批删除的文件数和批次之间的停顿，避免集中占用磁盘
+        interval_seconds: 后台清理的间隔
+        """
+        self.directory = directory
+        self.max_age_seconds = max_age_days * 86400
+        self.max_total_bytes = int(max_total_mb * 1024 * 1024)
+        self.archive_after_seconds = archive_after_days * 86400
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.interval_seconds = interval_seconds
+
+        self.index_path = os.path.join(directory, INDEX_NAME)
+        self.archive_dir = os.path.join(directory, ARCHIVE_DIR_NAME)
+
+        self._lock = threading.Lock()
+        # (保存时间, 文件名, 客户ID, 字节数)，按保存时间从旧到新
+        self._entries = deque()
+        self._total = 0
+        # 索引文件中已失效（已删除或已归档）的行数，超过有效行数时重写索引
+        self._dead = 0
+        # 保存时间不晚于该值的索引行都已失效；删除总是从最旧的开始，一个水位就能记录所有删除
+        self._watermark = 0.0
+
+        os.makedirs(directory, exist_ok=True)
+        needs_scan = not os.path.exists(self.index_path)
+        if not needs_scan:
+            self._load()
+        self._index_file = open(self.index_path, "a", encoding="utf-8")
+
+        self._thread = threading.Thread(target=self._run, args=(needs_scan,), name="screenshot-retention", daemon=True)
+        self._thread.start()
+
+    def _load(self):
+        entries = []
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 进程退出时写了一半的行
+                    continue
+                if "removed_until" in record:
+                    self._watermark = max(self._watermark, record["removed_until"])
+                else:
+                    entries.append((record["time"], record["file"], record.get("customer"), record.get("size", 0)))
+        live = [entry for entry in entries if entry[0] > self._watermark]
+        self._entries.extend(live)
+        self._total = sum(entry[3] for entry in live)
+        self._dead = len(entries) - len(live)
+        if live:
+            print(f"截图索引: {len(live)} 张，共 {self._total // (1024 * 1024)}MB")
+
+    def _write(self, record):
+        self._index_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._index_file.flush()
+
+    def record(self, path):
+        """截图保存到目录之后调用"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        entry = (time.time(), os.path.basename(path), customer_of(path), size)
+        with self._lock:
+            self._entries.append(entry)
+            self._total += size
+            self._write({"time": entry[0], "file": entry[1], "customer": entry[2], "size": entry[3]})
+
+    def _scan(self):
+        """第一次运行（没有索引）时把目录中已有的截图加入索引"""
+        found = []
+        with os.scandir(self.directory) as it:
+            for item in it:
+                if item.is_file() and item.name.lower().endswith(SCREENSHOT_EXTENSIONS):
+                    stat = item.stat()
+                    found.append((stat.st_mtime, item.name, customer_of(item.name), stat.st_size))
+        with self._lock:
+            known = {entry[1] for entry in self._entries}
+            entries = sorted([entry for entry in found if entry[1] not in known] + list(self._entries))
+            self._entries = deque(entries)
+            self._total = sum(entry[3] for entry in entries)
+            self._rewrite_index()
+        if found:
+            print(f"已为截图目录建立索引: {len(found)} 张")
+
+    def _rewrite_index(self):
+        """用有效条目重写索引（调用方持有锁）"""
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for entry in self._entries:
+                f.write(json.dumps({"time": entry[0], "file": entry[1], "customer": entry[2], "size": entry[3]},
+                                   ensure_ascii=False) + "\n")
+        self._index_file.close()
+        os.replace(temp_path, self.index_path)
+        self._index_file = open(self.index_path, "a", encoding="utf-8")
+        self._dead = 0
+        self._watermark = 0.0
+
+    def _peek_batch(self, should_take):
+        """
+        从最旧的开始选出一批满足条件的条目，还不从索引中移除
+        should_take(条目, 移除之前各条目后剩余的总字节数)
+        """
+        with self._lock:
+            batch = []
+            remaining = self._total
+            for entry in self._entries:
+                if len(batch) >= self.batch_size or not should_take(entry, remaining):
+                    break
+                batch.append(entry)
+                remaining -= entry[3]
+        return batch
+
+    def _commit_batch(self, batch):
+        """一批截图已经归档或删除之后，从索引中移除并写入删除水位（进程在此之前退出时下次重新处理这批）"""
+        with self._lock:
+            for _ in batch:
+                entry = self._entries.popleft()
+                self._total -= entry[3]
+            self._dead += len(batch)
+            self._watermark = batch[-1][0]
+            self._write({"removed_until": self._watermark})
+
+    def _remove_files(self, batch):
+        """
+        按从旧到新的顺序删除
+        返回: 已删除（或本来就不存在）的条目数，删除失败时停在该条目，它和之后的条目留在索引中下次再删
+        """
+        for done, entry in enumerate(batch):
+            try:
+                os.remove(os.path.join(self.directory, entry[1]))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"删除截图失败: {str(e)}")
+                return done
+        return len(batch)
+
+    def _archive_batch(self, batch):
+        """
+        把一批截图按保存日期追加到对应的zip，全部写入后再删除原文件
+        返回: 已归档并删除的条目数
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        by_day = {}
+        for entry in batch:
+            by_day.setdefault(datetime.fromtimestamp(entry[0]).strftime("%Y%m%d"), []).append(entry)
+        for day, entries in by_day.items():
+            # PNG/WebP本身已压缩，归档的主要作用是把几千个小文件合成一个
+            with zipfile.ZipFile(os.path.join(self.archive_dir, f"{day}.zip"), "a", zipfile.ZIP_DEFLATED) as archive:
+                for entry in entries:
+                    path = os.path.join(self.directory, entry[1])
+                    if os.path.exists(path):
+                        archive.write(path, arcname=entry[1])
+        return self._remove_files(batch)
+
+    def _archives(self):
+        """返回: [(日期, 路径, 字节数)]，从旧到新；不是按日期命名的zip（不是这里生成的）不处理"""
+        if not os.path.isdir(self.archive_dir):
+            return []
+        archives = []
+        for name in sorted(os.listdir(self.archive_dir)):
+            if not name.endswith(".zip"):
+                continue
+            try:
+                day = datetime.strptime(name[:-4], "%Y%m%d")
+            except ValueError:
+                continue
+            path = os.path.join(self.archive_dir, name)
+            archives.append((day, path, os.path.getsize(path)))
+        return archives
+
+    def _drain(self, should_take, handle):
+        count = 0
+        while True:
+            batch = self._peek_batch(should_take)
+            if not batch:
+                return count
+            # 归档或删除出错时抛出异常或只处理了一部分，水位只推进到已处理的条目
+            done = handle(batch)
+            if done:
+                self._commit_batch(batch[:done])
+            count += done
+            if done < len(batch):
+                return count
+            time.sleep(self.batch_pause)
+
+    def sweep(self):
+        """
+        执行一次清理：删除过期截图和归档、归档旧截图、按总大小配额删除最旧的
+        返回: 处理的截图数量
+        """
+        now = time.time()
+        cutoff = now - self.max_age_seconds
+        count = self._drain(lambda entry, total: entry[0] < cutoff, self._remove_files)
+
+        archives = self._archives()
+        for day, path, size in archives:
+            if day.timestamp() + 86400 < cutoff:
+                os.remove(path)
+        archives = [archive for archive in archives if os.path.exists(archive[1])]
+
+        if self.archive_after_seconds and self.archive_after_seconds < self.max_age_seconds:
+            archive_cutoff = now - self.archive_after_seconds
+            count += self._drain(lambda entry, total: entry[0] < archive_cutoff, self._archive_batch)
+            archives = self._archives()
+
+        if self.max_total_bytes:
+            archive_bytes = sum(size for _, _, size in archives)
+            # 归档比散落的截图更旧，先删归档
+            for _, path, size in archives:
+                if self._total + archive_bytes <= self.max_total_bytes:
+                    break
+                os.remove(path)
+                archive_bytes -= size
+            count += self._drain(lambda entry, total: total + archive_bytes > self.max_total_bytes, self._remove_files)
+
+        with self._lock:
+            if self._dead > max(1000, len(self._entries)):
+                self._rewrite_index()
+        return count
+
+    def _run(self, needs_scan):
+        if needs_scan:
+            try:
+                self._scan()
+            except Exception as e:
+                print(f"建立截图索引失败: {str(e)}")
+        while True:
+            try:
+                count = self.sweep()
+                if count:
+                    print(f"已清理或归档 {count} 张截图")
+            except Exception as e:
+                print(f"清理截图失败: {str(e)}")
+            time.sleep(self.interval_seconds)
+
+    def stats(self):
+        with self._lock:
+            return {"files": len(self._entries), "bytes": self._total}
@@ -0,0 +1,315 @@
+"""
+多店铺进程管理
+按多店铺配置（shops.json）为每个店铺启动一个机器人进程：每个店铺有自己的Dify密钥、工作目录、截图目录、
+模板目录和显示器（Linux下的虚拟显示器DISPLAY）。进程崩溃后按指数退避重启，主循环长时间没有心跳时
+认为界面会话卡死并强制重启；各店铺的日志加上店铺名合并输出，/metrics 端点合并所有店铺的指标（带shop标签）。
+
+用法:
+    python supervisor.py --config shops.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+import urllib.request
+
+from tracing import Metrics, start_metrics_server
+
+BOT_SCRIPTS = {
+    "pyautogui": "qianniu_bot_pyautogui.py",
+    "clicknium": "qianniu_bot.py",
+}
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 写入每个店铺工作目录的合并配置，不覆盖目录中已有的config.json
+WORKER_CONFIG_NAME = "supervisor_config.json"
+# 进程启动后指标端点在该时间内连不上属于正常启动过程，不记录日志
+STARTUP_GRACE_SECONDS = 60
+
+
+def deep_merge(base, override):
+    """店铺配置覆盖基础配置，字典逐层合并，其他值直接替换"""
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def add_label(line, name, value):
+    """给一行Prometheus样本加上标签"""
+    metric, _, rest = line.partition(" ")
+    if "{" in metric:
+        metric = metric.replace("{", f'{{{name}="{value}",', 1)
+    else:
+        metric = f'{metric}{{{name}="{value}"}}'
+    return f"{metric} {rest}"
+
+
+def merge_prometheus(sources):
+    """
+    sources: [(店铺名, Prometheus文本)]
+    同名指标的样本合并到同一个 # TYPE 之下（格式要求同一指标的样本连续出现）
+    """
+    families = {}
+    for shop, text in sources:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# TYPE "):
+                family = line.split()[2]
+                families.setdefault(family, [line])
+            elif line and not line.startswith("#") and family:
+                families[family].append(add_label(line, "shop", shop))
+    return "\n".join(line for lines in families.values() for line in lines) + "\n"
+
+
+class ShopWorker:
+    """一个店铺的机器人进程"""
+
+    def __init__(self, name, script, workdir, env, metrics_port, log,
+                 initial_delay=2, max_delay=300, stable_seconds=600, hang_timeout=300):
+        """
+        metrics_port: 该店铺机器人的 /metrics 端口，用于合并指标和检查心跳
+        log: 输出一行日志的函数，参数为 (店铺名, 内容)
+        initial_delay / max_delay: 重启等待时间，每次连续崩溃翻倍
+        stable_seconds: 进程运行超过该时间后崩溃，重启等待时间重新从initial_delay开始
+        hang_timeout: 主循环心跳停止超过该时间时强制结束进程，0表示不检查；
+                      指标端点连不上时无法判断是否卡死，这段时间不计入
+        """
+        self.name = name
+        self.script = script
+        self.workdir = workdir
+        self.env = env
+        self.metrics_port = metrics_port
+        self.log = log
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.stable_seconds = stable_seconds
+        self.hang_timeout = hang_timeout
+
+        self.process = None
+        self.stopped = False
+        self.restarts = 0
+        self._delay = initial_delay
+        self._next_start = 0.0
+        self._started_at = 0.0
+        self._last_progress = 0.0
+        self._iterations = None
+        self._scrape_error = None
+        self.metrics_text = ""
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-u", self.script],
+            cwd=self.workdir,
+            env=self.env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding="utf-8",
+            errors="replace"
+        )
+        self._started_at = self._last_progress = time.time()
+        self._iterations = None
+        self._scrape_error = None
+        self.log(self.name, f"已启动，进程ID {self.process.pid}")
+        threading.Thread(target=self._pump, args=(self.process,), name=f"log-{self.name}", daemon=True).start()
+
+    def _pump(self, process):
+        for line in process.stdout:
+            self.log(self.name, line.rstrip())
+
+    def _scrape(self):
+        """抓取该店铺的指标并记录心跳，返回: 指标端点是否可以访问"""
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{self.metrics_port}/metrics", timeout=2) as response:
+                self.metrics_text = response.read().decode("utf-8")
+        except Exception as e:
+            # 刚启动时端点还没开始监听；之后连不上（端口被占用、指标服务异常）才记录，每次中断只记录一次
+            started_long_ago = time.time() - self._started_at >= STARTUP_GRACE_SECONDS
+            if self._scrape_error is None and (self._iterations is not None or started_long_ago):
+                self._scrape_error = str(e)
+                self.log(self.name, f"指标端点 127.0.0.1:{self.metrics_port} 无法访问（{str(e)}），暂停卡死检查")
+            return False
+        if self._scrape_error is not None:
+            self._scrape_error = None
+            self.log(self.name, "指标端点已恢复，继续卡死检查")
+        match = re.search(r"^loop_iterations_total (\S+)$", self.metrics_text, re.MULTILINE)
+        if match and match.group(1) != self._iterations:
+            self._iterations = match.group(1)
+            self._last_progress = time.time()
+        return True
+
+    def check(self):
+        """检查进程状态：按时重启、抓取指标、处理卡死"""
+        now = time.time()
+        if self.stopped:
+            return
+        if self.process is None:
+            if now >= self._next_start:
+                self.start()
+            return
+
+        code = self.process.poll()
+        if code is None:
+            if not self._scrape():
+                # 连不上指标端点不等于主循环卡住：暂停计时，恢复后重新开始计算
+                self._last_progress = now
+                return
+            if self.hang_timeout and now - self._last_progress > self.hang_timeout:
+                self.log(self.name, f"主循环 {self.hang_timeout}秒 没有心跳，强制重启")
+                self.process.kill()
+            return
+
+        self.process = None
+        self.metrics_text = ""
+        if code == 0:
+            # 正常退出（缺少模板、在屏幕左上角触发了安全停止等）需要人工处理，不自动重启
+            self.log(self.name, "已退出，不再自动重启")
+            self.stopped = True
+            return
+        if now - self._started_at >= self.stable_seconds:
+            self._delay = self.initial_delay
+        self.restarts += 1
+        self._next_start = now + self._delay
+        self.log(self.name, f"进程异常退出（退出码 {code}），{self._delay:.0f}秒后重启")
+        self._delay = min(self._delay * 2, self.max_delay)
+
+    def up(self):
+        return 1 if self.process is not None and self.process.poll() is None else 0
+
+    def terminate(self):
+        self.stopped = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class Supervisor:
+    """管理所有店铺的进程，合并日志和指标"""
+
+    def __init__(self, config):
+        self.config = config
+        self.check_interval = config.get("check_interval", 5)
+        self._log_lock = threading.Lock()
+        log_path = config.get("log_path")
+        self._log_file = open(log_path, "a", encoding="utf-8") if log_path else None
+        self.metrics = Metrics()
+
+        base_config = {}
+        if config.get("base_config"):
+            with open(config["base_config"], "r", encoding="utf-8") as f:
+                base_config = json.load(f)
+
+        restart = config.get("restart", {})
+        self.workers = []
+        for index, shop in enumerate(config["shops"]):
+            try:
+                self.workers.append(self._create_worker(index, shop, base_config, restart))
+            except ValueError as e:
+                self.log(shop["name"], f"配置错误，不启动该店铺: {str(e)}")
+
+        self.metrics.gauge("workers_up", lambda: sum(worker.up() for worker in self.workers))
+
+    def _create_worker(self, index, shop, base_config, restart):
+        name = shop["name"]
+        workdir = os.path.abspath(shop.get("workdir", os.path.join("shops", name)))
+        os.makedirs(workdir, exist_ok=True)
+
+        # 每个店铺的机器人都开启 /metrics，端口按店铺顺序分配
+        metrics_port = shop.get("metrics_port", self.config.get("worker_metrics_base_port", 9110) + index)
+        worker_config = deep_merge(base_config, shop.get("config", {}))
+        tracing = worker_config.setdefault("tracing", {})
+        # 心跳检查依赖机器人的 /metrics，配置中明确关闭的不能悄悄打开，也不能在没有心跳的情况下运行
+        if tracing.get("enabled") is False:
+            raise ValueError("tracing.enabled 为false，无法检查主循环心跳")
+        if "metrics_port" in tracing and not tracing["metrics_port"]:
+            raise ValueError("tracing.metrics_port 已关闭，无法检查主循环心跳")
+        if not metrics_port:
+            raise ValueError("metrics_port 已关闭，无法检查主循环心跳")
+        tracing.update({"enabled": True, "metrics_port": metrics_port, "metrics_host": "127.0.0.1"})
+        tracing.setdefault("log_path", "traces.jsonl")
+        config_path = os.path.join(workdir, WORKER_CONFIG_NAME)
+        with open(config_path, "w", encoding="utf-8") as f:
+            json.dump(worker_config, f, ensure_ascii=False, indent=4)
+
+        env = dict(os.environ)
+        env.update({key: str(value) for key, value in shop.get("env", {}).items()})
+        if shop.get("display"):
+            env["DISPLAY"] = shop["display"]
+        env["QIANNIU_CONFIG"] = config_path
+        env["QIANNIU_SCREENSHOTS_DIR"] = os.path.abspath(
+            os.path.join(workdir, shop.get("screenshots_dir", "screenshots")))
+        env["QIANNIU_TEMPLATES_DIR"] = os.path.abspath(
+            shop.get("templates_dir", self.config.get("templates_dir", os.path.join(BASE_DIR, "templates"))))
+
+        bot = shop.get("bot", self.config.get("bot", "pyautogui"))
+        return ShopWorker(
+            name,
+            os.path.join(BASE_DIR, BOT_SCRIPTS[bot]),
+            workdir,
+            env,
+            metrics_port,
+            self.log,
+            initial_delay=restart.get("initial_delay", 2),
+            max_delay=restart.get("max_delay", 300),
+            stable_seconds=restart.get("stable_seconds", 600),
+            hang_timeout=restart.get("hang_timeout", 300)
+        )
+
+    def log(self, shop, message):
+        line = f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] [{shop}] {message}"
+        with self._log_lock:
+            print(line, flush=True)
+            if self._log_file:
+                self._log_file.write(line + "\n")
+                self._log_file.flush()
+
+    def render_prometheus(self):
+        """合并所有店铺的指标（各自带shop标签）和supervisor自身的指标"""
+        sources = [(worker.name, worker.metrics_text) for worker in self.workers if worker.metrics_text]
+        for worker in self.workers:
+            sources.append((worker.name, f"# TYPE worker_restarts_total counter\nworker_restarts_total {worker.restarts}\n"))
+        return self.metrics.render_prometheus() + merge_prometheus(sources)
+
+    def run(self):
+        port = self.config.get("metrics_port")
+        if port:
+            host = self.config.get("metrics_host", "127.0.0.1")
+            start_metrics_server(self, port=port, host=host)
+            self.log("supervisor", f"合并指标端点: http://{host}:{port}/metrics")
+        try:
+            while True:
+                for worker in self.workers:
+                    worker.check()
+                if all(worker.stopped for worker in self.workers):
+                    self.log("supervisor", "所有店铺进程都已退出")
+                    return
+                time.sleep(self.check_interval)
+        except KeyboardInterrupt:
+            self.log("supervisor", "正在停止所有店铺进程...")
+        finally:
+            for worker in self.workers:
+                worker.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多店铺进程管理")
+    parser.add_argument("--config", default="shops.json", help="多店铺配置文件")
+    args = parser.parse_args()
+
+    with open(args.config, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    Supervisor(config).run()
+
+
+if __name__ == "__main__":
+    main()
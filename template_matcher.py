@@ -0,0 +1,201 @@
+"""
+模板匹配引擎
+启动时一次性载入模板目录中的所有模板（灰度，并按配置的缩放比例预先生成多尺度版本），
+每次轮询只截一帧屏幕，所有模板都在同一帧上匹配；用cv2.minMaxLoc取得分最高的位置，
+而不是第一个超过阈值的像素。
+千牛窗口布局稳定，RoiTracker记住每个模板上次出现的位置，先在附近的小窗口里找，找不到再全屏搜索
+"""
+import os
+import glob
+import threading
+
+import cv2
+import numpy as np
+
+
+class RoiTracker:
+    """记录每个模板上次出现的位置，给出优先搜索的窗口，并统计命中情况"""
+
+    def __init__(self, padding=80):
+        """padding: 在上次位置四周各扩展的像素数"""
+        self.padding = padding
+        self._lock = threading.Lock()
+        self._locations = {}
+        # 模板名 -> {"roi_hits": 窗口内命中, "full_hits": 全屏搜索命中, "misses": 全屏也没找到}
+        self._stats = {}
+
+    def window(self, name, screen_size=None):
+        """
+        返回: 优先搜索的屏幕区域 (x, y, width, height)，没有记录时返回None
+        screen_size: (宽, 高)，用于把窗口裁剪在屏幕范围内
+        """
+        with self._lock:
+            location = self._locations.get(name)
+        if location is None:
+            return None
+        x, y, w, h = location
+        left = max(0, x - self.padding)
+        top = max(0, y - self.padding)
+        right = x + w + self.padding
+        bottom = y + h + self.padding
+        if screen_size:
+            right = min(right, screen_size[0])
+            bottom = min(bottom, screen_size[1])
+        return (left, top, right - left, bottom - top)
+
+    def update(self, name, location):
+        with self._lock:
+            self._locations[name] = tuple(location[:4])
+
+    def forget(self, name):
+        """界面布局变化后丢弃旧位置"""
+        with self._lock:
+            self._locations.pop(name, None)
+
+    def record(self, name, outcome):
+        with self._lock:
+            counters = self._stats.setdefault(name, {"roi_hits": 0, "full_hits": 0, "misses": 0})
+            counters[outcome] += 1
+
+    def stats(self):
+        """返回每个模板的命中统计，包含窗口命中率"""
+        with self._lock:
+            result = {}
+            for name, counters in self._stats.items():
+                found = counters["roi_hits"] + counters["full_hits"]
+                result[name] = dict(counters, roi_hit_rate=counters["roi_hits"] / found if found else 0.0)
+            return result
+
+
+class TemplateMatcher:
+    """缓存模板并在屏幕帧上查找，线程安全"""
+
+    def __init__(self, templates_dir, grab_func, scales=(1.0,), roi_padding=80):
+        """
+        grab_func: 截屏函数，返回PIL图片；支持region=(x, y, width, height)参数只截取一块区域
+        scales: 模板缩放比例，用于适配显示缩放（DPI）变化，1.0始终优先尝试
+        roi_padding: 上次位置周围的搜索范围，0表示总是全屏搜索
+        """
+        self.templates_dir = templates_dir
+        self.grab_func = grab_func
+        self.scales = sorted(set(scales) | {1.0}, key=lambda scale: abs(scale - 1.0))
+        self.roi = RoiTracker(roi_padding) if roi_padding > 0 else None
+        self._screen_size = None
+
+        self._lock = threading.Lock()
+        # 模板名 -> [(缩放比例, 灰度模板)]
+        self._templates = {}
+        # 模板名 -> 上次匹配成功的缩放比例，下次优先尝试
+        self._last_scale = {}
+        self.load_all()
+
+    def _load(self, name):
+        path = os.path.join(self.templates_dir, name)
+        # 可选模板（如chat_window.png）不存在时OpenCV每次都会打印警告，先检查文件
+        if not os.path.exists(path):
+            return None
+        template = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if template is None:
+            return None
+        variants = []
+        for scale in self.scales:
+            if scale == 1.0:
+                variants.append((scale, template))
+                continue
+            height, width = template.shape
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_CUBIC
+            variants.append((scale, cv2.resize(template, size, interpolation=interpolation)))
+        return variants
+
+    def load_all(self):
+        """载入（或重新载入）模板目录下的全部PNG模板"""
+        templates = {}
+        for path in glob.glob(os.path.join(self.templates_dir, "*.png")):
+            name = os.path.basename(path)
+            variants = self._load(name)
+            if variants:
+                templates[name] = variants
+        with self._lock:
+            self._templates = templates
+            self._last_scale.clear()
+        return len(templates)
+
+    def _get_variants(self, name):
+        with self._lock:
+            variants = self._templates.get(name)
+        if variants is None:
+            # 启动后才补充的模板，第一次用到时载入
+            variants = self._load(name)
+            if variants is None:
+                return None
+            with self._lock:
+                self._templates[name] = variants
+        return variants
+
+    def grab(self):
+        """截取一帧屏幕并转成灰度数组"""
+        frame = np.asarray(self.grab_func().convert("L"))
+        self._screen_size = (frame.shape[1], frame.shape[0])
+        return frame
+
+    def _match(self, name, variants, frame, confidence, offset=(0, 0)):
+        """在一帧（或一块区域）上按各个尺度匹配，返回 (x, y, width, height, score) 或 None"""
+        # 先试上次成功的尺度，命中即返回；否则在所有尺度中取最高分
+        last_scale = self._last_scale.get(name, 1.0)
+        ordered = sorted(variants, key=lambda variant: variant[0] != last_scale)
+
+        best = None
+        for scale, template in ordered:
+            height, width = template.shape
+            if height > frame.shape[0] or width > frame.shape[1]:
+                continue
+            result = cv2.matchTemplate(frame, template, cv2.TM_CCOEFF_NORMED)
+            _, max_val, _, max_loc = cv2.minMaxLoc(result)
+            if best is None or max_val > best[4]:
+                best = (max_loc[0] + offset[0], max_loc[1] + offset[1], width, height, max_val, scale)
+            if scale == last_scale and max_val >= confidence:
+                break
+
+        if best is None or best[4] < confidence:
+            return None
+        self._last_scale[name] = best[5]
+        return best[:5]
+
+    def find(self, name, confidence=0.8, frame=None):
+        """
+        查找模板：先在上次位置附近的窗口里找，找不到再全屏搜索
+        frame: 本次轮询已截取的灰度屏幕帧，为空时按需截屏（有窗口时只截窗口区域）
+        返回: (x, y, width, height, score) 或 None
+        """
+        variants = self._get_variants(name)
+        if variants is None:
+            print(f"无法读取模板图片: {name}")
+            return None
+
+        screen_size = (frame.shape[1], frame.shape[0]) if frame is not None else self._screen_size
+        window = self.roi.window(name, screen_size) if self.roi else None
+        if window:
+            x, y, w, h = window
+            if frame is None:
+                region = np.asarray(self.grab_func(region=window).convert("L"))
+            else:
+                region = frame[y:y + h, x:x + w]
+            location = self._match(name, variants, region, confidence, offset=(x, y))
+            if location:
+                self.roi.record(name, "roi_hits")
+                self.roi.update(name, location)
+                return location
+
+        if frame is None:
+            frame = self.grab()
+        location = self._match(name, variants, frame, confidence)
+        if self.roi:
+            self.roi.record(name, "full_hits" if location else "misses")
+            if location:
+                self.roi.update(name, location)
+        return location
+
+    def stats(self):
+        """每个模板的窗口命中/全屏命中/未找到次数"""
+        return self.roi.stats() if self.roi else {}
@@ -0,0 +1,113 @@
+import time
+
+import pytest
+import requests
+
+from circuit_breaker import CLOSED, HALF_OPEN, MIN_RETRY_SECONDS, OPEN, CircuitBreaker, CircuitOpenError
+
+
+def server_error():
+    response = requests.Response()
+    response.status_code = 503
+    return requests.HTTPError("503", response=response)
+
+
+def fail():
+    raise server_error()
+
+
+def conversation_missing():
+    response = requests.Response()
+    response.status_code = 404
+    raise requests.HTTPError("404", response=response)
+
+
+def breaker(**options):
+    options = dict({"failure_rate": 0.5, "min_calls": 4, "open_seconds": 0.05, "slow_call_seconds": 1}, **options)
+    return CircuitBreaker("chat", **options)
+
+
+def trip(circuit):
+    for _ in range(circuit.min_calls):
+        with pytest.raises(requests.HTTPError):
+            circuit.call(fail)
+    assert circuit.state == OPEN
+
+
+def test_opens_after_failure_rate_reached():
+    circuit = breaker()
+    circuit.call(lambda: "ok")
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            circuit.call(fail)
+    # 窗口内请求数少于min_calls时不断开
+    assert circuit.state == CLOSED
+    with pytest.raises(requests.HTTPError):
+        circuit.call(fail)
+    assert circuit.state == OPEN
+    with pytest.raises(CircuitOpenError) as error:
+        circuit.call(lambda: "ok")
+    # 剩余的断开时间不足最短间隔时按最短间隔
+    assert error.value.retry_in == MIN_RETRY_SECONDS
+    assert circuit.rejected == 1
+
+
+def test_client_errors_do_not_count():
+    circuit = breaker()
+    for _ in range(6):
+        with pytest.raises(requests.HTTPError):
+            circuit.call(conversation_missing)
+    assert circuit.state == CLOSED
+
+
+def test_half_open_lets_one_probe_through_then_closes():
+    circuit = breaker()
+    trip(circuit)
+    time.sleep(0.06)
+    circuit.before_call()
+    assert circuit.state == HALF_OPEN
+    # 探测请求还没有结果时其他请求被拒绝，重新请求的间隔不能是0
+    with pytest.raises(CircuitOpenError) as error:
+        circuit.before_call()
+    assert error.value.retry_in >= MIN_RETRY_SECONDS
+    circuit.record(0.01, False)
+    assert circuit.state == CLOSED
+    assert circuit.call(lambda: "ok") == "ok"
+
+
+def test_failed_probe_opens_again():
+    circuit = breaker()
+    trip(circuit)
+    time.sleep(0.06)
+    with pytest.raises(requests.HTTPError):
+        circuit.call(fail)
+    assert circuit.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        circuit.call(lambda: "ok")
+
+
+def test_half_open_rejection_reports_remaining_probe_time():
+    circuit = breaker(slow_call_seconds=30)
+    trip(circuit)
+    time.sleep(0.06)
+    circuit.before_call()
+    with pytest.raises(CircuitOpenError) as error:
+        circuit.before_call()
+    assert error.value.retry_in == pytest.approx(30, abs=1)
+
+
+def test_slow_calls_count_as_failures():
+    circuit = breaker(slow_call_seconds=0.5)
+    for _ in range(4):
+        circuit.before_call()
+        circuit.record(0.6, False)
+    assert circuit.state == OPEN
+
+
+def test_slow_probe_opens_again():
+    circuit = breaker(slow_call_seconds=0.5)
+    trip(circuit)
+    time.sleep(0.06)
+    circuit.before_call()
+    circuit.record(0.6, False)
+    assert circuit.state == OPEN
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from customer_identity import CustomerIdentityIndex, is_identified, unidentified_customer_id
+
+
+def avatar(seed):
+    pixels = np.random.RandomState(seed).randint(0, 256, (48, 48), dtype=np.uint8)
+    return Image.fromarray(pixels)
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = CustomerIdentityIndex(db_path=str(tmp_path / "customers.db"))
+    yield index
+    index.close()
+
+
+def test_exact_nickname_is_stable(index):
+    assert index.identify(nickname="tb12345678") == index.identify(nickname="ｔｂ12345678 ")
+
+
+def test_similar_nicknames_without_avatar_are_different_customers(index):
+    assert index.identify(nickname="tb12345678") != index.identify(nickname="tb12345679")
+    assert index.identify(nickname="小王的店铺01") != index.identify(nickname="小王的店铺02")
+
+
+def test_similar_nickname_matches_only_with_same_avatar(index):
+    first = index.identify(nickname="tb12345678", avatar=avatar(1))
+    assert index.identify(nickname="tb12345679", avatar=avatar(1)) == first
+    assert index.identify(nickname="tb12345670", avatar=avatar(2)) != first
+
+
+def test_shared_default_avatar_does_not_merge_similar_nicknames(index):
+    default_avatar = Image.new("L", (48, 48), 200)
+    first = index.identify(nickname="tb12345678", avatar=default_avatar)
+    second = index.identify(nickname="tb87654321", avatar=default_avatar)
+    assert first != second
+    # 默认头像同时属于两个客户，不能用来确认近似昵称
+    assert index.identify(nickname="tb12345679", avatar=default_avatar) not in (first, second)
+
+
+def test_avatar_alone_never_identifies(index):
+    index.identify(nickname="tb12345678", avatar=avatar(1))
+    assert index.identify(avatar=avatar(1)) is None
+    assert index.identify(nickname="  ", avatar=avatar(1)) is None
+
+
+def test_index_survives_restart(tmp_path):
+    path = str(tmp_path / "customers.db")
+    index = CustomerIdentityIndex(db_path=path)
+    first = index.identify(nickname="tb12345678", avatar=avatar(1))
+    index.close()
+
+    index = CustomerIdentityIndex(db_path=path)
+    assert index.identify(nickname="tb12345679", avatar=avatar(1)) == first
+    index.close()
+
+
+def test_unidentified_ids_are_never_shared(index):
+    # 同一秒内两个无法识别的客户也不能得到相同的ID
+    first, second = unidentified_customer_id(), unidentified_customer_id()
+    assert first != second
+    assert not is_identified(first)
+    assert is_identified(index.identify(nickname="tb12345678"))
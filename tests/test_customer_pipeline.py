@@ -0,0 +1,23 @@
+from customer_pipeline import CustomerPipeline
+from rate_limiter import RateLimitedError
+
+
+def test_retry_uses_the_completed_stage():
+    calls = []
+
+    def process(customer_id, image, text=None):
+        calls.append((image, text))
+        if len(calls) == 1:
+            # 识别已完成，对话被限流：重新处理时带上识别结果
+            error = RateLimitedError("限流", retry_in=0.01)
+            error.retry_args = (image, "识别出的文本")
+            raise error
+        return text, False
+
+    pipeline = CustomerPipeline(process, max_workers=1, retry_on=(RateLimitedError,), max_retries=2)
+    try:
+        pipeline.submit("c1", "截图")
+        assert pipeline.poll_results(timeout=2) == {"c1": ("识别出的文本", False)}
+        assert calls == [("截图", None), ("截图", "识别出的文本")]
+    finally:
+        pipeline.shutdown()
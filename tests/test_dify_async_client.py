@@ -0,0 +1,194 @@
+import json
+import asyncio
+import threading
+import time
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web
+
+from dify_async_client import SyncDifyFacade
+
+
+class StandIn:
+    """在后台线程运行的aiohttp对话接口，handler由测试设置"""
+
+    def __init__(self):
+        self.handler = None
+        self.calls = []
+        self._loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post("/v1/chat-messages", self._dispatch)
+        self._runner = web.AppRunner(app)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    async def _dispatch(self, request):
+        payload = await request.json()
+        self.calls.append((time.monotonic(), payload["query"]))
+        return await self.handler(request, payload)
+
+    def dify_config(self, **overrides):
+        base_url = f"http://127.0.0.1:{self.port}/v1"
+        config = {
+            "vision_api_url": base_url + "/workflows/run",
+            "chat_api_url": base_url + "/chat-messages",
+            "file_upload_url": base_url + "/files/upload",
+            "api_key": "chat-key",
+            "vision_api_key": "vision-key",
+            "max_retries": 2,
+            "retry_backoff": 0.01,
+        }
+        config.update(overrides)
+        return config
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def answer(text="好的"):
+    return web.json_response({"event": "message", "answer": text, "conversation_id": "c1", "metadata": {}})
+
+
+@pytest.fixture
+def stand_in():
+    stand_in = StandIn()
+    yield stand_in
+    stand_in.stop()
+
+
+@pytest.fixture
+def make_client(stand_in):
+    clients = []
+
+    def make_client(**overrides):
+        client = SyncDifyFacade(stand_in.dify_config(**overrides))
+        clients.append(client)
+        return client
+
+    yield make_client
+    for client in clients:
+        client.close()
+
+
+def chat_in_threads(client, queries):
+    threads = [threading.Thread(target=client.chat, args=(query, "u1")) for query in queries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_semaphore_bounds_concurrency_per_key(stand_in, make_client):
+    in_flight = []
+    peak = []
+
+    async def handler(request, payload):
+        in_flight.append(1)
+        peak.append(len(in_flight))
+        await asyncio.sleep(0.1)
+        in_flight.pop()
+        return answer()
+
+    stand_in.handler = handler
+    chat_in_threads(make_client(max_concurrency_per_key=2), [f"q{i}" for i in range(6)])
+    assert len(peak) == 6
+    assert max(peak) == 2
+
+
+def test_retry_after_pauses_every_request_for_the_key(stand_in, make_client):
+    throttled = []
+
+    async def handler(request, payload):
+        if not throttled:
+            throttled.append(time.monotonic())
+            return web.json_response({"code": "too_many_requests"}, status=429, headers={"Retry-After": "0.5"})
+        return answer()
+
+    stand_in.handler = handler
+    client = make_client()
+    first = threading.Thread(target=client.chat, args=("first", "u1"))
+    first.start()
+    time.sleep(0.1)
+    chat_in_threads(client, ["second", "third"])
+    first.join()
+
+    later = [at for at, query in stand_in.calls[1:]]
+    assert len(later) == 3
+    assert min(later) >= throttled[0] + 0.45
+
+
+def test_backoff_does_not_hold_the_key(stand_in, make_client):
+    async def handler(request, payload):
+        if payload["query"] == "busy":
+            # 没有Retry-After：只有这个请求退避，不占用并发名额，也不暂停其他请求
+            return web.json_response({"code": "unavailable"}, status=503)
+        return answer()
+
+    stand_in.handler = handler
+    client = make_client(max_concurrency_per_key=1, max_retries=1, retry_backoff=2)
+    errors = []
+
+    def busy():
+        try:
+            client.chat("busy", "u1")
+        except aiohttp.ClientResponseError as e:
+            errors.append(e.status)
+
+    thread = threading.Thread(target=busy)
+    thread.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    assert client.chat("other", "u1")["answer"] == "好的"
+    assert time.monotonic() - start < 1
+    thread.join()
+    assert errors == [503]
+
+
+def test_retries_stop_at_max_retries(stand_in, make_client):
+    async def handler(request, payload):
+        return web.json_response({"code": "too_many_requests"}, status=429)
+
+    stand_in.handler = handler
+    with pytest.raises(aiohttp.ClientResponseError) as error:
+        make_client(max_retries=2).chat("q", "u1")
+    assert error.value.status == 429
+    assert len(stand_in.calls) == 3
+
+
+def test_on_need_human_runs_on_caller_thread(stand_in, make_client):
+    async def handler(request, payload):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for event in ({"event": "message", "answer": "这个问题需要转"},
+                      {"event": "message", "answer": "人工"},
+                      {"event": "message_end", "conversation_id": "c1", "metadata": {}}):
+            await response.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+        return response
+
+    stand_in.handler = handler
+    client = make_client(chat_response_mode="streaming")
+    threads = []
+    result = client.chat("退款", "u1", on_need_human=lambda: threads.append(threading.get_ident()))
+    assert threads == [threading.get_ident()]
+    assert result["answer"] == "这个问题需要转人工"
+
+
+def test_429_is_left_to_the_rate_limiter(stand_in, make_client):
+    async def handler(request, payload):
+        return web.json_response({"code": "too_many_requests"}, status=429, headers={"Retry-After": "5"})
+
+    stand_in.handler = handler
+    start = time.monotonic()
+    with pytest.raises(aiohttp.ClientResponseError) as error:
+        make_client(retry_throttled=False).chat("q", "u1")
+    assert error.value.status == 429
+    assert len(stand_in.calls) == 1
+    assert time.monotonic() - start < 1
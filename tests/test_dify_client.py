@@ -0,0 +1,221 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from dify_client import ChatStreamCollector, DifyClient, DifyStreamError
+
+
+def sse(event, **data):
+    return b"data: " + json.dumps(dict(data, event=event), ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+
+class SSEServer:
+    """按脚本返回SSE事件的本地对话接口；hold为True时发完事件后保持连接，直到测试结束"""
+
+    def __init__(self):
+        self.events = []
+        self.hold = False
+        self.release = threading.Event()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                # 和Dify一样按分块编码逐个发送事件
+                for event in server.events:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+                    self.wfile.flush()
+                if server.hold:
+                    server.release.wait(5)
+                self.wfile.write(b"0\r\n\r\n")
+                self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def stop(self):
+        self.release.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    server = SSEServer()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def client(server):
+    client = DifyClient({
+        "vision_api_url": server.url + "/v1/workflows/run",
+        "chat_api_url": server.url + "/v1/chat-messages",
+        "file_upload_url": server.url + "/v1/files/upload",
+        "api_key": "chat-key",
+        "vision_api_key": "vision-key",
+        "chat_response_mode": "streaming",
+        "max_retries": 0,
+    })
+    yield client
+    client.close()
+
+
+def test_marker_split_across_events_fires_once(server, client):
+    server.events = [
+        sse("message", answer="您好，这个问题需要"),
+        sse("message", answer="转"),
+        sse("message", answer="人工处理。"),
+        sse("message", answer="已为您转人工"),
+        sse("message_end", conversation_id="c1", message_id="m1", metadata={}),
+    ]
+    calls = []
+    result = client.chat("退款", "u1", on_need_human=lambda: calls.append(1))
+    assert calls == [1]
+    assert result["answer"] == "您好，这个问题需要转人工处理。已为您转人工"
+    assert result["conversation_id"] == "c1"
+
+
+def test_message_end_returns_without_waiting_for_close(server, client):
+    server.events = [
+        sse("message", answer="好的"),
+        sse("message_end", conversation_id="c1", message_id="m1", metadata={"usage": {"total_tokens": 3}}),
+    ]
+    server.hold = True
+    start = time.monotonic()
+    result = client.chat("在吗", "u1")
+    assert time.monotonic() - start < 2
+    assert result["answer"] == "好的"
+    assert result["metadata"]["usage"]["total_tokens"] == 3
+
+
+def test_error_event_raises(server, client):
+    server.events = [
+        sse("message", answer="好"),
+        sse("error", code="provider_quota_exceeded", message="quota"),
+    ]
+    with pytest.raises(DifyStreamError, match="provider_quota_exceeded"):
+        client.chat("在吗", "u1")
+
+
+def test_stream_closed_before_message_end_raises(server, client):
+    server.events = [sse("message", answer="回复到一半")]
+    with pytest.raises(DifyStreamError):
+        client.chat("在吗", "u1")
+
+
+def test_message_replace_replaces_answer(server, client):
+    server.events = [
+        sse("message", answer="不合适的内容"),
+        sse("message_replace", answer="抱歉，无法回答"),
+        sse("message_end", conversation_id="c1", message_id="m1", metadata={}),
+    ]
+    assert client.chat("在吗", "u1")["answer"] == "抱歉，无法回答"
+
+
+def test_message_replace_resets_marker_detection():
+    calls = []
+    collector = ChatStreamCollector(lambda: calls.append(1))
+    collector.feed_line(sse("message", answer="需要转"))
+    collector.feed_line(sse("message_replace", answer="抱歉，"))
+    # 替换前保留的末尾"需要转"不能和替换后的文本拼出标记
+    collector.feed_line(sse("message", answer="人工客服稍后联系您"))
+    assert not collector.marker_found
+    assert calls == []
+
+    collector.feed_line(sse("message_replace", answer="请稍等，为您转人工"))
+    assert collector.marker_found
+    assert calls == [1]
+    collector.feed_line(sse("message_replace", answer="好的"))
+    assert not collector.marker_found
+    collector.feed_line(sse("message", answer="转人工"))
+    assert calls == [1]
+
+
+class StatusServer:
+    """对每个请求都返回同一个状态码的本地接口，记录收到的请求数"""
+
+    def __init__(self, status):
+        self.calls = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                server.calls += 1
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def retrying_client(base_url):
+    return DifyClient({
+        "vision_api_url": base_url + "/v1/workflows/run",
+        "chat_api_url": base_url + "/v1/chat-messages",
+        "file_upload_url": base_url + "/v1/files/upload",
+        "api_key": "chat-key",
+        "vision_api_key": "vision-key",
+        "max_retries": 2,
+        "retry_backoff": 0.01,
+    })
+
+
+def test_upload_is_not_retried_after_gateway_error():
+    # 网关错误时上传可能已经完成，重试会再保存一份文件
+    server = StatusServer(502)
+    client = retrying_client(server.url)
+    try:
+        with pytest.raises(requests.HTTPError):
+            client.upload_file("chat.png", b"png", "u1")
+        assert server.calls == 1
+    finally:
+        client.close()
+        server.stop()
+
+
+def test_refused_connection_is_retried(capsys):
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    client = retrying_client(f"http://127.0.0.1:{port}")
+    try:
+        with pytest.raises(requests.ConnectionError):
+            client.upload_file("chat.png", b"png", "u1")
+    finally:
+        client.close()
+    assert capsys.readouterr().out.count("重试") == 2
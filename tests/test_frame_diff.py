@@ -0,0 +1,72 @@
+import numpy as np
+from PIL import Image
+
+from frame_diff import FrameDiffCache
+
+WIDTH = 120
+HEIGHT = 240
+MESSAGE_HEIGHT = 16
+GAP = 8
+
+
+def chat(messages):
+    """聊天区域截图：底部对齐的消息气泡（每条是一块随机像素），消息之间是空白行"""
+    rng = np.random.RandomState(0)
+    blocks = [rng.randint(0, 256, size=(MESSAGE_HEIGHT, WIDTH), dtype=np.uint8) for _ in range(messages)]
+    rows = []
+    for block in blocks:
+        rows.append(np.full((GAP, WIDTH), 255, dtype=np.uint8))
+        rows.append(block)
+    content = np.vstack(rows)[-HEIGHT:]
+    frame = np.full((HEIGHT, WIDTH), 255, dtype=np.uint8)
+    frame[HEIGHT - len(content):] = content
+    return Image.fromarray(frame).convert("RGB")
+
+
+def new_rows(cache, customer_id, image):
+    crop = cache.new_content(customer_id, image)
+    return None if crop is None else crop.height
+
+
+def test_unchanged_chat_is_skipped():
+    cache = FrameDiffCache()
+    assert new_rows(cache, "c1", chat(12)) == HEIGHT
+    cache.commit("c1")
+    assert new_rows(cache, "c1", chat(12)) is None
+
+
+def test_only_new_rows_after_commit():
+    cache = FrameDiffCache()
+    new_rows(cache, "c1", chat(12))
+    cache.commit("c1")
+    assert new_rows(cache, "c1", chat(13)) <= MESSAGE_HEIGHT + cache.margin
+
+
+def test_unanswered_turn_is_diffed_again():
+    cache = FrameDiffCache()
+    new_rows(cache, "c1", chat(12))
+    cache.commit("c1")
+    # 这一轮没有发出回复（处理失败、流水线中还有任务、限流），截图不能成为基准
+    new_rows(cache, "c1", chat(13))
+    cache.rollback("c1")
+    # 下一轮仍包含上次没有回复的消息
+    assert new_rows(cache, "c1", chat(14)) >= 2 * MESSAGE_HEIGHT + GAP
+
+
+def test_staged_frame_does_not_replace_baseline_until_commit():
+    cache = FrameDiffCache()
+    new_rows(cache, "c1", chat(12))
+    cache.commit("c1")
+    new_rows(cache, "c1", chat(13))
+    # 还没有commit时再次截图，与原来的基准比较
+    assert new_rows(cache, "c1", chat(13)) <= MESSAGE_HEIGHT + cache.margin
+    cache.commit("c1")
+    assert new_rows(cache, "c1", chat(13)) is None
+
+
+def test_forget_drops_staged_frame():
+    cache = FrameDiffCache()
+    new_rows(cache, "c1", chat(12))
+    cache.forget("c1")
+    cache.commit("c1")
+    assert new_rows(cache, "c1", chat(12)) == HEIGHT
@@ -0,0 +1,124 @@
+import time
+
+import pytest
+import requests
+
+from dify_client import DifyClient, create_dify_client
+from rate_limiter import (
+    BudgetExceededError,
+    DailyBudget,
+    RateLimitedClient,
+    RateLimitedError,
+    TokenBucket,
+)
+
+
+def throttled(retry_after=None):
+    response = requests.Response()
+    response.status_code = 429
+    if retry_after is not None:
+        response.headers["Retry-After"] = str(retry_after)
+    return requests.HTTPError("429", response=response)
+
+
+class StubClient:
+    """按脚本返回结果或抛出异常的内层客户端"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def chat(self, query, user, inputs=None, on_need_human=None, conversation_id=None):
+        self.calls += 1
+        outcome = self.outcomes.pop(0) if self.outcomes else {"answer": "好的", "metadata": {}}
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def close(self):
+        pass
+
+
+def limited(client, **config):
+    config.setdefault("rates", {"chat": {"rate": 10, "burst": 1}})
+    return RateLimitedClient(client, config)
+
+
+def test_bucket_allows_burst_then_spaces_requests():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.02)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.02)
+
+
+def test_bucket_refuses_reservations_beyond_max_wait():
+    bucket = TokenBucket(rate=1, burst=1)
+    bucket.reserve()
+    assert bucket.reserve(max_wait=0.5) is None
+    # 被拒绝的预约不占用名额
+    assert bucket.reserve(max_wait=1.5) == pytest.approx(1.0, abs=0.05)
+
+
+def test_queue_overflow_raises_with_retry_in():
+    client = limited(StubClient(), max_wait=0.05, rates={"chat": {"rate": 2, "burst": 1}})
+    client.chat("q", "u1")
+    with pytest.raises(RateLimitedError) as error:
+        client.chat("q", "u1")
+    assert error.value.retry_in > 0
+
+
+def test_429_pauses_the_bucket_and_raises_rate_limited():
+    stub = StubClient(throttled(retry_after=0.3))
+    client = limited(stub, max_wait=5)
+    with pytest.raises(RateLimitedError) as error:
+        client.chat("q", "u1")
+    assert error.value.retry_in == pytest.approx(0.3)
+    # 暂停期间的请求排到Retry-After之后才发出
+    start = time.monotonic()
+    client.chat("q", "u1")
+    assert time.monotonic() - start >= 0.25
+    assert stub.calls == 2
+
+
+def test_other_errors_pass_through():
+    client = limited(StubClient(ValueError("boom")))
+    with pytest.raises(ValueError):
+        client.chat("q", "u1")
+
+
+def test_budget_persists_for_the_same_day(tmp_path):
+    state_path = str(tmp_path / "usage.json")
+    budget = DailyBudget(token_budget=100, state_path=state_path)
+    budget.record("chat", 60, 0.01)
+    budget.check()
+
+    restarted = DailyBudget(token_budget=100, state_path=state_path)
+    assert restarted.usage()["tokens"] == 60
+    restarted.record("chat", 40, 0.01)
+    with pytest.raises(BudgetExceededError):
+        restarted.check()
+
+
+def test_budget_counts_chat_usage():
+    stub = StubClient({"answer": "好的", "metadata": {"usage": {"total_tokens": 120, "total_price": "0.002"}}})
+    client = limited(stub, daily_token_budget=100)
+    client.chat("q", "u1")
+    assert client.usage()["tokens"] == 120
+    with pytest.raises(BudgetExceededError):
+        client.chat("q", "u1")
+    assert stub.calls == 1
+
+
+def test_inner_client_leaves_429_to_the_limiter():
+    config = {
+        "vision_api_url": "http://127.0.0.1:9/v1/workflows/run",
+        "chat_api_url": "http://127.0.0.1:9/v1/chat-messages",
+        "file_upload_url": "http://127.0.0.1:9/v1/files/upload",
+        "api_key": "chat-key",
+        "vision_api_key": "vision-key",
+    }
+    assert DifyClient(config).retry_throttled
+    client = create_dify_client(dict(config, rate_limit={"enabled": True}))
+    assert isinstance(client, RateLimitedClient)
+    assert not client.client.retry_throttled
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from reply_cache import ReplyCache
+
+
+@pytest.fixture
+def make_cache(tmp_path):
+    caches = []
+
+    def make_cache(allow_list=("什么时候发货", "可以开发票吗"), **options):
+        allow_list_path = tmp_path / "faq_allow_list.json"
+        allow_list_path.write_text(json.dumps(list(allow_list), ensure_ascii=False), encoding="utf-8")
+        cache = ReplyCache(db_path=str(tmp_path / "reply_cache.db"), allow_list_path=str(allow_list_path), **options)
+        caches.append(cache)
+        return cache
+
+    yield make_cache
+    for cache in caches:
+        cache.close()
+
+
+def test_only_allowed_questions_are_cached(make_cache):
+    cache = make_cache()
+    cache.put("什么时候发货？", "48小时内发货")
+    cache.put("我的订单123到哪了", "已经到杭州了")
+    assert cache.get("什么时候发货") == "48小时内发货"
+    assert cache.get("我的订单123到哪了") is None
+
+
+def test_similar_wording_hits(make_cache):
+    cache = make_cache(allow_list=["几天能发货"])
+    cache.put("几天能发货", "48小时内发货")
+    assert cache.get("几天能发货呀") == "48小时内发货"
+
+
+def test_different_numbers_are_not_similar(make_cache):
+    cache = make_cache(allow_list=["3天能发货吗"], min_similarity=0.5)
+    cache.put("3天能发货吗", "可以")
+    assert cache.get("3天能发货吗") == "可以"
+    assert cache.get("5天能发货吗") is None
+
+
+def test_cache_is_bypassed_when_conversation_exists(make_cache):
+    cache = make_cache()
+    cache.put("什么时候发货", "48小时内发货")
+    # 有会话历史时同一句话可能是在接着上文问
+    assert cache.get("什么时候发货", conversation_id="c1") is None
+    cache.put("可以开发票吗", "可以，下单时备注抬头", conversation_id="c1")
+    assert cache.get("可以开发票吗") is None
+
+
+def test_transfer_answers_are_not_stored(make_cache):
+    cache = make_cache()
+    cache.put("可以开发票吗", "这个问题需要转人工处理")
+    assert cache.get("可以开发票吗") is None
+
+
+def test_entries_survive_restart(make_cache):
+    make_cache().put("什么时候发货", "48小时内发货")
+    assert make_cache().get("什么时候发货") == "48小时内发货"
+
+
+def test_expired_entries_are_dropped(make_cache):
+    cache = make_cache(ttl_seconds=-1)
+    cache.put("什么时候发货", "48小时内发货")
+    assert cache.get("什么时候发货") is None
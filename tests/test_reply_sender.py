@@ -0,0 +1,109 @@
+import numpy as np
+from PIL import Image
+
+from reply_sender import INPUT_BOX, SEND_BUTTON, ReplySender, split_reply
+
+CONTROLS = {INPUT_BOX: (0, 0, 200, 40), SEND_BUTTON: (300, 0, 40, 20)}
+
+
+class FakeChatInput:
+    """模拟千牛输入框：粘贴后文字区域出现内容，点击发送按钮后清空；可以模拟粘贴没有生效、发送后没有清空"""
+
+    def __init__(self, ignored_pastes=0, stuck=False):
+        self.clipboard = ""
+        self.text = ""
+        self.ignored_pastes = ignored_pastes
+        self.stuck = stuck
+        self.sent = []
+        self.send_clicks = 0
+
+    def copy(self, text):
+        self.clipboard = text
+
+    def click(self, x, y, _pause=True):
+        if x >= CONTROLS[SEND_BUTTON][0]:
+            self.send_clicks += 1
+            if not self.stuck:
+                self.sent.append(self.text)
+                self.text = ""
+
+    def hotkey(self, *keys, _pause=True):
+        if keys == ("ctrl", "v"):
+            if self.ignored_pastes:
+                self.ignored_pastes -= 1
+            else:
+                self.text += self.clipboard
+
+    def press(self, key, _pause=True):
+        if key == "backspace":
+            self.text = ""
+
+    def screenshot(self, region=None):
+        width, height = region[2], region[3]
+        if not self.text:
+            return Image.new("RGB", (width, height), "white")
+        pixels = np.random.RandomState(len(self.text)).randint(0, 256, size=(height, width), dtype=np.uint8)
+        return Image.fromarray(pixels).convert("RGB")
+
+
+def sender_for(chat, **options):
+    fast = {"settle_timeout": 0.01, "paste_timeout": 0.05, "send_timeout": 0.05, "poll_interval": 0.005,
+            "retry_backoff": 0}
+    return ReplySender(chat, chat.copy, CONTROLS.get, **dict(fast, **options))
+
+
+def test_split_prefers_sentence_ends():
+    text = "第一句话说完了。" + "第二句" * 5
+    assert split_reply(text, 12) == ["第一句话说完了。", "第二句" * 4, "第二句"]
+
+
+def test_split_cuts_by_length_when_punctuation_is_too_early():
+    assert split_reply("好。" + "a" * 20, 10) == ["好。" + "a" * 8, "a" * 10, "aa"]
+
+
+def test_split_without_limit_and_blank_text():
+    assert split_reply("  很长的回复  ", 0) == ["很长的回复"]
+    assert split_reply("   ", 0) == []
+    assert split_reply("   ", 10) == []
+
+
+def test_long_reply_is_sent_in_chunks():
+    chat = FakeChatInput()
+    result = sender_for(chat, max_length=12).send("第一句话说完了。" + "第二句" * 5)
+    assert result["ok"]
+    assert result["chunks"] == 3
+    assert chat.sent == ["第一句话说完了。", "第二句" * 4, "第二句"]
+
+
+def test_retries_when_paste_did_not_take_effect():
+    chat = FakeChatInput(ignored_pastes=2)
+    result = sender_for(chat, max_attempts=3).send("您好")
+    assert result["ok"]
+    assert result["retries"] == 2
+    assert chat.sent == ["您好"]
+
+
+def test_gives_up_after_max_attempts():
+    chat = FakeChatInput(ignored_pastes=5)
+    sender = sender_for(chat, max_attempts=3)
+    result = sender.send("您好")
+    assert not result["ok"]
+    assert result["retries"] == 2
+    assert chat.send_clicks == 0
+    assert sender.stats() == {"sends": 1, "retries": 2, "failures": 1}
+
+
+def test_unconfirmed_send_is_not_retried():
+    # 点击发送后输入框没有清空，可能已经发出，重发会让客户收到两条
+    chat = FakeChatInput(stuck=True)
+    result = sender_for(chat, max_attempts=3).send("您好")
+    assert not result["ok"]
+    assert result["retries"] == 0
+    assert chat.send_clicks == 1
+
+
+def test_empty_reply_is_not_reported_as_sent():
+    chat = FakeChatInput()
+    result = sender_for(chat).send("  ")
+    assert not result["ok"]
+    assert chat.send_clicks == 0
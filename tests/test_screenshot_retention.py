@@ -0,0 +1,92 @@
+import os
+import time
+import zipfile
+
+import pytest
+
+from screenshot_retention import ARCHIVE_DIR_NAME, INDEX_NAME, ScreenshotRetention
+
+
+def screenshot(directory, index, age_days=0.0, size=100):
+    path = directory / f"c1_20240101_{index:06d}.png"
+    path.write_bytes(b"x" * size)
+    saved_at = time.time() - age_days * 86400
+    os.utime(path, (saved_at, saved_at))
+    return path
+
+
+@pytest.fixture
+def make_retention(monkeypatch):
+    # 不启动后台清理，由测试直接调用sweep
+    monkeypatch.setattr(ScreenshotRetention, "_run", lambda self, needs_scan: None)
+    created = []
+
+    def make_retention(directory, **options):
+        needs_scan = not (directory / INDEX_NAME).exists()
+        retention = ScreenshotRetention(str(directory), batch_pause=0, **options)
+        if needs_scan:
+            retention._scan()
+        created.append(retention)
+        return retention
+
+    yield make_retention
+    for retention in created:
+        retention._index_file.close()
+
+
+def test_watermark_survives_restart(tmp_path, make_retention):
+    old = [screenshot(tmp_path, i, age_days=10) for i in range(3)]
+    new = screenshot(tmp_path, 3)
+    retention = make_retention(tmp_path, max_age_days=7, batch_size=2)
+    assert retention.sweep() == 3
+    assert not any(path.exists() for path in old)
+    assert new.exists()
+
+    # 重启后按水位跳过已删除的索引行，不再重新处理
+    restarted = make_retention(tmp_path, max_age_days=7)
+    assert restarted.stats() == {"files": 1, "bytes": 100}
+    assert restarted.sweep() == 0
+
+
+def test_quota_removes_oldest_first(tmp_path, make_retention):
+    paths = [screenshot(tmp_path, i, age_days=(4 - i) / 24, size=1000) for i in range(4)]
+    retention = make_retention(tmp_path, max_total_mb=2500 / (1024 * 1024))
+    assert retention.sweep() == 2
+    assert [path.exists() for path in paths] == [False, False, True, True]
+    assert retention.stats()["bytes"] == 2000
+
+
+def test_old_screenshots_are_archived_by_day(tmp_path, make_retention):
+    path = screenshot(tmp_path, 0, age_days=2)
+    retention = make_retention(tmp_path, max_age_days=7, archive_after_days=1)
+    assert retention.sweep() == 1
+    assert not path.exists()
+    archives = os.listdir(tmp_path / ARCHIVE_DIR_NAME)
+    assert len(archives) == 1
+    with zipfile.ZipFile(tmp_path / ARCHIVE_DIR_NAME / archives[0]) as archive:
+        assert archive.namelist() == [path.name]
+    assert retention.stats()["files"] == 0
+
+
+def test_zips_not_named_by_date_are_left_alone(tmp_path, make_retention):
+    archive_dir = tmp_path / ARCHIVE_DIR_NAME
+    archive_dir.mkdir()
+    (archive_dir / "20000101.zip").write_bytes(b"x" * 1000)
+    (archive_dir / "notes.zip").write_bytes(b"x" * 1000)
+    retention = make_retention(tmp_path, max_age_days=7, max_total_mb=1 / (1024 * 1024))
+    retention.sweep()
+    assert sorted(os.listdir(archive_dir)) == ["notes.zip"]
+
+
+def test_failed_removal_does_not_advance_watermark(tmp_path, make_retention):
+    stuck = screenshot(tmp_path, 0, age_days=10)
+    later = screenshot(tmp_path, 1, age_days=9)
+    retention = make_retention(tmp_path, max_age_days=7)
+    # 同名目录无法用os.remove删除
+    stuck.unlink()
+    stuck.mkdir()
+    assert retention.sweep() == 0
+    assert later.exists()
+
+    restarted = make_retention(tmp_path, max_age_days=7)
+    assert restarted.stats()["files"] == 2
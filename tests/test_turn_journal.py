@@ -0,0 +1,83 @@
+import pytest
+
+from turn_journal import TurnJournal
+
+
+@pytest.fixture
+def make_journal(tmp_path):
+    journals = []
+
+    def make_journal(**options):
+        journal = TurnJournal(db_path=str(tmp_path / "turns.db"), **options)
+        journals.append(journal)
+        return journal
+
+    yield make_journal
+    for journal in journals:
+        journal.close()
+
+
+def test_stages_progress_until_finished(make_journal):
+    journal = make_journal()
+    turn_id = journal.begin("c1", (10, 20))
+    assert journal.stage("c1") == "captured"
+    # 流水线中还没处理完时再次开始，沿用原来的一轮
+    assert journal.begin("c1") == turn_id
+    journal.advance("c1", "extracted", text="什么时候发货")
+    journal.advance("c1", "answered", reply="48小时内发货", need_human=False)
+    assert journal.stage("c1") == "answered"
+    journal.finish("c1", "replied")
+    assert journal.stage("c1") is None
+    journal.advance("c1", "sent")
+    assert journal.stage("c1") is None
+
+
+def test_turns_of_this_process_are_not_resumable(make_journal):
+    journal = make_journal()
+    journal.begin("c1")
+    journal.advance("c1", "extracted", text="什么时候发货")
+    assert journal.resumable("c1") is None
+    assert journal.unfinished() == []
+
+
+def test_restart_resumes_from_last_stage(make_journal):
+    journal = make_journal()
+    journal.begin("c1", (10, 20))
+    journal.advance("c1", "extracted", text="什么时候发货")
+    journal.begin("c2")
+    journal.advance("c2", "extracted", text="可以开发票吗")
+    journal.advance("c2", "answered", reply="可以", need_human=False)
+    journal.close()
+
+    restarted = make_journal()
+    turn = restarted.resumable("c1")
+    assert turn["stage"] == "extracted"
+    assert turn["text"] == "什么时候发货"
+    assert turn["position"] == [10, 20]
+    assert [turn["customer_id"] for turn in restarted.unfinished()] == ["c1", "c2"]
+    assert restarted.resumable("c2")["reply"] == "可以"
+
+
+def test_captured_and_expired_turns_are_abandoned(make_journal):
+    journal = make_journal()
+    journal.begin("c1")
+    journal.close()
+    assert make_journal().resumable("c1") is None
+
+    journal = make_journal()
+    journal.begin("c2")
+    journal.advance("c2", "extracted", text="在吗")
+    journal.close()
+    assert make_journal(resume_seconds=-1).resumable("c2") is None
+
+
+def test_new_turn_replaces_unresumed_turn_from_previous_process(make_journal):
+    journal = make_journal()
+    old_turn = journal.begin("c1")
+    journal.advance("c1", "extracted", text="在吗")
+    journal.close()
+
+    restarted = make_journal()
+    assert restarted.begin("c1") != old_turn
+    assert restarted.stage("c1") == "captured"
+    assert restarted.resumable("c1") is None
@@ -0,0 +1,103 @@
+"""
+本地OCR文本提取
+聊天气泡是清晰的渲染文字，本地CPU上的OCR就能识别；置信度足够时直接使用本地结果，
+不再上传截图、调用视觉工作流，置信度低时由调用方回退到Dify视觉识别。
+OCR后端可插拔，依赖按需导入：
+    rapidocr   pip install rapidocr_onnxruntime
+    tesseract  pip install pytesseract（另需安装tesseract程序和chi_sim语言包）
+"""
+import numpy as np
+
+
+class RapidOcrBackend:
+    """RapidOCR（PaddleOCR模型的ONNX Runtime版本），中文识别效果好，纯CPU运行"""
+
+    def __init__(self, options=None):
+        from rapidocr_onnxruntime import RapidOCR
+
+        self._engine = RapidOCR(**(options or {}))
+
+    def extract(self, image):
+        """
+        返回: [(文字, 置信度, 左上角x, 左上角y)]
+        """
+        # RapidOCR按OpenCV的BGR顺序处理数组
+        array = np.asarray(image.convert("RGB"))[:, :, ::-1]
+        result, _ = self._engine(array)
+        lines = []
+        for box, text, score in result or []:
+            lines.append((text, float(score), box[0][0], box[0][1]))
+        return lines
+
+
+class TesseractBackend:
+    """Tesseract，适合已经部署了tesseract的环境"""
+
+    def __init__(self, options=None):
+        import pytesseract
+
+        options = options or {}
+        self._pytesseract = pytesseract
+        self.lang = options.get("lang", "chi_sim+eng")
+        self.config = options.get("config", "--psm 6")
+
+    def extract(self, image):
+        data = self._pytesseract.image_to_data(
+            image, lang=self.lang, config=self.config, output_type=self._pytesseract.Output.DICT
+        )
+        # 按 (块, 段落, 行) 把单词合并成行，置信度取单词的平均值
+        rows = {}
+        for i, word in enumerate(data["text"]):
+            confidence = float(data["conf"][i])
+            if not word.strip() or confidence < 0:
+                continue
+            key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+            row = rows.setdefault(key, {"words": [], "scores": [], "x": data["left"][i], "y": data["top"][i]})
+            row["words"].append(word)
+            row["scores"].append(confidence / 100)
+        # 中文按字切分，单词之间不加空格
+        return [
+            ("".join(row["words"]), sum(row["scores"]) / len(row["scores"]), row["x"], row["y"])
+            for row in rows.values()
+        ]
+
+
+OCR_BACKENDS = {
+    "rapidocr": RapidOcrBackend,
+    "tesseract": TesseractBackend,
+}
+
+
+class TextExtractor:
+    """调用OCR后端并按置信度决定本地结果是否可用"""
+
+    def __init__(self, backend="rapidocr", min_confidence=0.85, min_chars=1, backend_options=None):
+        """
+        backend: OCR_BACKENDS 中的后端名称
+        min_confidence: 按字数加权的平均置信度低于该值时视为不可靠
+        min_chars: 识别出的字数少于该值时视为不可靠（空白截图、只有表情或图片）
+        """
+        if backend not in OCR_BACKENDS:
+            raise ValueError(f"不支持的OCR后端: {backend}")
+        self.backend_name = backend
+        self.backend = OCR_BACKENDS[backend](backend_options)
+        self.min_confidence = min_confidence
+        self.min_chars = min_chars
+
+    def extract(self, image):
+        """
+        识别截图中的文字，行按从上到下、从左到右排列
+        返回: (文本, 置信度)
+        """
+        lines = self.backend.extract(image)
+        if not lines:
+            return "", 0.0
+        lines.sort(key=lambda line: (line[3], line[2]))
+        total_chars = sum(len(text) for text, _, _, _ in lines)
+        if total_chars == 0:
+            return "", 0.0
+        confidence = sum(len(text) * score for text, score, _, _ in lines) / total_chars
+        return "\n".join(text for text, _, _, _ in lines), confidence
+
+    def is_reliable(self, text, confidence):
+        return confidence >= self.min_confidence and len(text.strip()) >= self.min_chars
@@ -0,0 +1,281 @@
+"""
+耗时追踪与指标
+每个客户的一轮处理（截图 -> 识别 -> 对话 -> 发送）分配一个trace ID，各阶段记录为span，
+阶段耗时汇总成直方图（p50/p95/p99），Dify错误、模板未找到、转人工等记为计数器。
+span逐条写入JSON-lines日志；指标可以通过本地HTTP端点 /metrics 以Prometheus文本格式导出
+"""
+import json
+import math
+import time
+import uuid
+import inspect
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 直方图桶边界（秒），覆盖从模板匹配（毫秒级）到大模型对话（数十秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Histogram:
+    """累计桶计数 + 最近样本（用于计算分位数）"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, sample_size=1000):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+        self.samples = deque(maxlen=sample_size)
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+        self.samples.append(value)
+
+    def percentile(self, percent):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(percent / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+
+class Metrics:
+    """计数器、直方图和按需计算的仪表，线程安全"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, func):
+        """注册一个仪表，导出时调用func()取当前值（例如排队客户数）"""
+        with self._lock:
+            self._gauges[name] = func
+
+    def counters(self, name):
+        """返回: {标签: 计数}，例如 {(("outcome", "replied"),): 12}"""
+        with self._lock:
+            return {label_key: value for (metric, label_key), value in self._counters.items() if metric == name}
+
+    def percentiles(self, name, percents=(50, 95, 99)):
+        """
+        返回: {标签: {百分位: 值}}，例如 {(("stage", "chat"),): {50: 1.2, 95: 3.4, 99: 5.6}}
+        """
+        with self._lock:
+            return {
+                label_key: {percent: histogram.percentile(percent) for percent in percents}
+                for (metric, label_key), histogram in self._histograms.items()
+                if metric == name
+            }
+
+    def render_prometheus(self):
+        """按Prometheus文本格式导出全部指标"""
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (metric, label_key), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_format_labels(label_key)} {value}")
+
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, label_key), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{_format_labels(label_key, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(label_key, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(label_key)} {histogram.total}")
+                    lines.append(f"{name}_count{_format_labels(label_key)} {histogram.count}")
+                # 直方图只能在服务端估算分位数，这里另外按最近样本导出精确的p50/p95/p99
+                lines.append(f"# TYPE {name}_quantile gauge")
+                for (metric, label_key), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for percent in (50, 95, 99):
+                        quantile_labels = _format_labels(label_key, [("quantile", percent / 100)])
+                        lines.append(f"{name}_quantile{quantile_labels} {histogram.percentile(percent)}")
+
+            gauges = list(self._gauges.items())
+
+        for name, func in sorted(gauges):
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class Tracer:
+    """按客户记录一轮处理的trace ID，并把各阶段耗时写入指标和JSON-lines日志"""
+
+    def __init__(self, metrics, log_path=None):
+        """log_path: span日志文件，为空时只记录指标"""
+        self.metrics = metrics
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # 客户ID -> (trace ID, 开始时间)
+        self._turns = {}
+        self._log_file = open(log_path, "a", encoding="utf-8") if log_path else None
+
+    def _write(self, record):
+        if self._log_file is None:
+            return
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._log_file.write(line + "\n")
+            self._log_file.flush()
+
+    def begin_turn(self, customer_id, started=None):
+        """
+        客户开始新的一轮处理，该客户已有进行中的一轮时沿用原来的trace
+        started: 本轮开始时间（检测到新消息的时间），默认为当前时间
+        返回: trace ID
+        """
+        with self._lock:
+            turn = self._turns.get(customer_id)
+            if turn is None:
+                turn = self._turns[customer_id] = (uuid.uuid4().hex[:16], started or time.time())
+        return turn[0]
+
+    def trace_id(self, customer_id):
+        with self._lock:
+            turn = self._turns.get(customer_id)
+        return turn[0] if turn else None
+
+    def end_turn(self, customer_id, outcome):
+        """
+        一轮处理结束，outcome: replied（已回复）、transferred（已转人工）、skipped（没有新消息）、failed
+        """
+        with self._lock:
+            turn = self._turns.pop(customer_id, None)
+        if turn is None:
+            return
+        trace_id, started = turn
+        duration = time.time() - started
+        self.metrics.observe("turn_duration_seconds", duration)
+        self.metrics.inc("turns_total", outcome=outcome)
+        self._write({
+            "trace_id": trace_id,
+            "customer_id": customer_id,
+            "span": "turn",
+            "start": started,
+            "duration_ms": round(duration * 1000, 1),
+            "status": outcome,
+        })
+
+    @contextmanager
+    def span(self, stage, customer_id=None):
+        """
+        记录一个阶段的耗时；没有指定客户时沿用当前线程外层span的客户
+        """
+        previous = getattr(self._local, "customer_id", None)
+        customer_id = customer_id or previous
+        self._local.customer_id = customer_id
+        record = {"status": "ok"}
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record["status"] = "error"
+            record["error"] = str(e)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self._local.customer_id = previous
+            self.metrics.observe("stage_duration_seconds", duration, stage=stage)
+            record.update({
+                "trace_id": self.trace_id(customer_id) if customer_id else None,
+                "customer_id": customer_id,
+                "span": stage,
+                "start": started,
+                "duration_ms": round(duration * 1000, 1),
+            })
+            self._write(record)
+
+    def traced(self, stage):
+        """
+        装饰器：把函数调用记录为一个span；函数有customer_id参数时自动关联到该客户的trace，
+        函数返回None（这些函数出错时返回None）时span状态记为empty
+        """
+        def decorator(func):
+            signature = inspect.signature(func)
+            has_customer = "customer_id" in signature.parameters
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                customer_id = None
+                if has_customer:
+                    customer_id = signature.bind_partial(*args, **kwargs).arguments.get("customer_id")
+                with self.span(stage, customer_id) as record:
+                    result = func(*args, **kwargs)
+                    if result is None:
+                        record["status"] = "empty"
+                    return result
+            return wrapper
+        return decorator
+
+    def close(self):
+        with self._lock:
+            if self._log_file:
+                self._log_file.close()
+                self._log_file = None
+
+
+def start_metrics_server(metrics, port=9108, host="127.0.0.1"):
+    """在后台线程中启动 /metrics HTTP端点，返回服务器对象"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # 不把每次抓取都打印到控制台
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,155 @@
+"""
+客户处理日志（崩溃恢复）
+进程在调用Dify之后、发送回复之前（或发送之后、关闭会话之前）退出时，重启后这个客户要么被漏掉，要么被回复两次。
+每轮处理的阶段变化都追加写入SQLite（WAL模式，synchronous=NORMAL：提交只写WAL，fsync在检查点时批量进行，
+进程崩溃不丢数据）：captured（已截图）-> extracted（已识别文本）-> answered（已生成回复）-> sent（已发送）-> closed。
+重启后未完成的一轮从最后完成的阶段继续：已有文本的只调用对话，已有回复的直接发送，已发送的不再发送。
+每轮记录开始它的进程ID，只恢复之前的进程留下的轮次，本进程中还在处理（流水线、等待限流）的轮次不会被当作需要恢复
+"""
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+# 可以恢复的阶段：captured 只有截图（没有保存），重新截图识别即可
+RESUMABLE_STAGES = ("extracted", "answered", "sent")
+
+
+class TurnJournal:
+    """每个客户最多一个进行中的处理轮次，按客户ID记录阶段，线程安全"""
+
+    def __init__(self, db_path="turns.db", resume_seconds=600, retention_days=7):
+        """
+        resume_seconds: 未完成的一轮超过该时间就不再恢复（太晚的回复没有意义），记为abandoned
+        retention_days: 已结束的记录保留的天数
+        """
+        self.resume_seconds = resume_seconds
+        self.retention_seconds = retention_days * 86400
+        # 本进程的ID，写入每一轮
+        self.process_id = uuid.uuid4().hex
+
+        self._lock = threading.Lock()
+        # 客户ID -> 进行中的一轮 {turn_id, customer_id, process_id, stage, text, reply, need_human, position, updated_at}
+        self._open = {}
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS turn_events ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, turn_id TEXT NOT NULL, customer_id TEXT NOT NULL, "
+            "stage TEXT NOT NULL, state TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS turn_events_turn ON turn_events (turn_id)")
+        self._conn.commit()
+        self._recover()
+
+    def _append(self, turn, stage):
+        """追加一条阶段记录，state保存该轮到目前为止的全部数据，恢复时只需读最后一条"""
+        turn["stage"] = stage
+        turn["updated_at"] = time.time()
+        self._conn.execute(
+            "INSERT INTO turn_events (turn_id, customer_id, stage, state, created_at) VALUES (?, ?, ?, ?, ?)",
+            (turn["turn_id"], turn["customer_id"], stage, json.dumps(turn, ensure_ascii=False), turn["updated_at"])
+        )
+        self._conn.commit()
+
+    def _recover(self):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM turn_events WHERE created_at < ? AND turn_id IN "
+                "(SELECT turn_id FROM turn_events WHERE stage = 'closed')",
+                (now - self.retention_seconds,)
+            )
+            rows = self._conn.execute(
+                "SELECT e.state FROM turn_events e JOIN "
+                "(SELECT turn_id, MAX(id) AS last_id FROM turn_events GROUP BY turn_id) last "
+                "ON e.id = last.last_id WHERE e.stage != 'closed' ORDER BY e.id"
+            ).fetchall()
+            abandoned = 0
+            for (state,) in rows:
+                turn = json.loads(state)
+                if turn["stage"] in RESUMABLE_STAGES and now - turn["updated_at"] <= self.resume_seconds:
+                    self._open[turn["customer_id"]] = turn
+                else:
+                    turn["outcome"] = "abandoned"
+                    self._append(turn, "closed")
+                    abandoned += 1
+            self._conn.commit()
+        if self._open or abandoned:
+            print(f"处理日志: {len(self._open)} 个客户有未完成的回复待恢复，放弃 {abandoned} 个过期的")
+
+    def _from_previous_process(self, turn):
+        return turn.get("process_id") != self.process_id
+
+    def begin(self, customer_id, position=None):
+        """
+        截图完成，开始新的一轮；该客户已有本进程中进行中的一轮（流水线中还没处理完）时沿用原来的，
+        之前的进程留下没有恢复的一轮记为abandoned
+        position: 客户在会话列表中的位置，重启后据此重新打开聊天窗口
+        返回: 轮次ID
+        """
+        with self._lock:
+            turn = self._open.get(customer_id)
+            if turn is not None and self._from_previous_process(turn):
+                turn["outcome"] = "abandoned"
+                self._append(turn, "closed")
+                turn = None
+            if turn is None:
+                turn = self._open[customer_id] = {
+                    "turn_id": uuid.uuid4().hex,
+                    "customer_id": customer_id,
+                    "process_id": self.process_id,
+                    "text": None,
+                    "reply": None,
+                    "need_human": False,
+                    "position": list(position) if position else None,
+                }
+                self._append(turn, "captured")
+            return turn["turn_id"]
+
+    def advance(self, customer_id, stage, **data):
+        """记录该客户当前一轮完成了某个阶段，data为该阶段的结果（text / reply / need_human）"""
+        with self._lock:
+            turn = self._open.get(customer_id)
+            if turn is None:
+                return
+            turn.update(data)
+            self._append(turn, stage)
+
+    def stage(self, customer_id):
+        """返回: 该客户进行中的一轮最后完成的阶段，没有时返回None"""
+        with self._lock:
+            turn = self._open.get(customer_id)
+            return turn["stage"] if turn else None
+
+    def _resumable(self, turn):
+        return turn["stage"] in RESUMABLE_STAGES and self._from_previous_process(turn)
+
+    def resumable(self, customer_id):
+        """返回: 该客户之前的进程留下的可以恢复的一轮（字典副本），没有时返回None"""
+        with self._lock:
+            turn = self._open.get(customer_id)
+            if turn is None or not self._resumable(turn):
+                return None
+            return dict(turn)
+
+    def unfinished(self):
+        """返回: 之前的进程留下的所有可以恢复的轮次，按开始时间排序"""
+        with self._lock:
+            turns = [dict(turn) for turn in self._open.values() if self._resumable(turn)]
+        return sorted(turns, key=lambda turn: turn["updated_at"])
+
+    def finish(self, customer_id, outcome):
+        """该客户的这一轮结束（已回复、已转人工、跳过、失败）"""
+        with self._lock:
+            turn = self._open.pop(customer_id, None)
+            if turn is None:
+                return
+            turn["outcome"] = outcome
+            self._append(turn, "closed")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,150 @@
+"""
+视觉识别结果缓存
+以聊天截图的感知哈希（dHash）为键保存视觉工作流提取的文本，
+相同或几乎相同的截图（重复通知、重新打开会话、发送失败后重试）直接复用结果，
+省掉一次上传和一次工作流调用。缓存按LRU淘汰、按TTL过期，并持久化到SQLite。
+整张聊天截图缩成哈希后，只差几个字的两张图也可能距离很近，所以命中前还要比较逐行/逐列的文字墨迹分布
+"""
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def dhash(image, hash_size=32):
+    """
+    计算差值哈希：缩放成 (hash_size+1) x hash_size 的灰度图，比较相邻像素的明暗
+    返回: hash_size*hash_size 位的整数
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size))
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def ink_profile(image):
+    """二值化后每行、每列的深色像素数，用于确认两张截图的文字内容一致"""
+    ink = np.asarray(image.convert("L")) < 128
+    return np.concatenate([ink.sum(axis=1), ink.sum(axis=0)]).astype(np.uint16)
+
+
+class VisionCache:
+    """感知哈希 -> 识别文本 的缓存，线程安全"""
+
+    def __init__(self, db_path="vision_cache.db", max_entries=2000, ttl_seconds=86400,
+                 max_distance=4, hash_size=32, max_profile_diff=0):
+        """
+        max_distance: 两张截图哈希的汉明距离不超过该值时作为候选，0表示只接受完全相同的哈希
+        hash_size: dHash边长
+        max_profile_diff: 候选与新截图墨迹分布允许不同的行列数，0表示文字像素必须完全一致
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.max_profile_diff = max_profile_diff
+
+        self._lock = threading.Lock()
+        # 哈希 -> (提取结果, 写入时间, 墨迹分布)，按最近使用顺序排列
+        self._entries = OrderedDict()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vision_cache ("
+            "hash TEXT PRIMARY KEY, result TEXT NOT NULL, profile BLOB NOT NULL, "
+            "created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        """启动时载入未过期的缓存，丢弃过期记录"""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            self._conn.execute("DELETE FROM vision_cache WHERE created_at < ?", (cutoff,))
+            rows = self._conn.execute(
+                "SELECT hash, result, profile, created_at FROM vision_cache ORDER BY last_used"
+            ).fetchall()
+            self._conn.commit()
+            for hash_hex, result, profile, created_at in rows:
+                self._entries[int(hash_hex, 16)] = (
+                    json.loads(result), created_at, np.frombuffer(profile, dtype=np.uint16)
+                )
+            self._evict_overflow()
+        if rows:
+            print(f"已载入 {len(self._entries)} 条识别缓存")
+
+    def _evict_overflow(self):
+        while len(self._entries) > self.max_entries:
+            image_hash, _ = self._entries.popitem(last=False)
+            self._conn.execute("DELETE FROM vision_cache WHERE hash = ?", (f"{image_hash:x}",))
+        self._conn.commit()
+
+    def _matches(self, cached_profile, profile):
+        if len(cached_profile) != len(profile):
+            return False
+        return int((cached_profile != profile).sum()) <= self.max_profile_diff
+
+    def _find(self, image_hash, profile):
+        """在汉明距离阈值内按距离从近到远查找，返回第一条文字内容一致的缓存"""
+        candidates = []
+        for cached_hash in self._entries:
+            distance = 0 if cached_hash == image_hash else hamming_distance(image_hash, cached_hash)
+            if distance <= self.max_distance:
+                candidates.append((distance, cached_hash))
+        for _, cached_hash in sorted(candidates):
+            if self._matches(self._entries[cached_hash][2], profile):
+                return cached_hash
+        return None
+
+    def get(self, image):
+        """
+        查询截图对应的识别结果
+        返回: 缓存的提取结果，未命中或已过期时返回None
+        """
+        image_hash = dhash(image, self.hash_size)
+        profile = ink_profile(image)
+        now = time.time()
+        with self._lock:
+            cached_hash = self._find(image_hash, profile)
+            if cached_hash is None:
+                return None
+
+            result, created_at, _ = self._entries[cached_hash]
+            if now - created_at > self.ttl_seconds:
+                del self._entries[cached_hash]
+                self._conn.execute("DELETE FROM vision_cache WHERE hash = ?", (f"{cached_hash:x}",))
+                self._conn.commit()
+                return None
+
+            self._entries.move_to_end(cached_hash)
+            self._conn.execute(
+                "UPDATE vision_cache SET last_used = ? WHERE hash = ?", (now, f"{cached_hash:x}")
+            )
+            self._conn.commit()
+            return result
+
+    def put(self, image, result):
+        """保存截图的识别结果"""
+        image_hash = dhash(image, self.hash_size)
+        profile = ink_profile(image)
+        now = time.time()
+        with self._lock:
+            self._entries[image_hash] = (result, now, profile)
+            self._entries.move_to_end(image_hash)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO vision_cache (hash, result, profile, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (f"{image_hash:x}", json.dumps(result, ensure_ascii=False), profile.tobytes(), now, now)
+            )
+            self._evict_overflow()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()